@@ -1,6 +1,27 @@
+import argparse
+import errno
+import hashlib
+import heapq
+import json
+import os
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+import shutil
+import tempfile
 import time
+from io import BytesIO
+from itertools import islice
 from joblib import Parallel, delayed
+from pandas.io.stata import StataWriter
+
+try:
+    import polars as pl  # optional: polars engine (see pivot_lazy)
+except ImportError:
+    pl = None
 
 
 #######################################################################################################################
@@ -11,20 +32,249 @@ from joblib import Parallel, delayed
 #pd.set_option("display.max_columns", None)
 #pd.set_option("display.max_rows", None)
 
-def day_nr(year: int, month: int) -> int:
+# calendar: first day (days since 1970-01-01) and nr of days of every month from calendar_years[0] to
+# calendar_years[1], indexed by month - calendar_offset (months since 1970-01) - leap years included
+calendar_years = (1850, 2199)
+calendar_offset = (calendar_years[0] - 1970) * 12
+month_first_days = np.arange(np.datetime64(f"{calendar_years[0]}-01"), np.datetime64(f"{calendar_years[1] + 1}-02"),
+                             dtype="datetime64[M]").astype("datetime64[D]").astype(np.int64)
+month_lengths = np.diff(month_first_days)
+month_first_days = month_first_days[:-1]
+
+
+def calendar_index(month):
+    '''
+    :param month: array of months since 1970-01
+    :return: positions in month_first_days / month_lengths
+    '''
+
+    index = np.asarray(month, dtype=np.int64) - calendar_offset
+    if index.size and (index.min() < 0 or index.max() >= len(month_lengths)):
+        raise ValueError(f"months outside of the calendar {calendar_years[0]}-{calendar_years[1]}")
+    return index
+
+
+def month_length(month):
+    '''
+    :param month: array of months since 1970-01
+    :return: nr of days of each month
+    '''
+
+    return month_lengths[calendar_index(month)]
+
+
+def month_tage(month, start_day, end_day):
+    '''
+    nr of days of [start_day, end_day] in month: month length, or partial days in the first / last month of the range
+    :param month: array of months since 1970-01
+    :param start_day: array of first days (days since 1970-01-01 or datetime64[D])
+    :param end_day: array of last days, same format as start_day
+    :return: array of days (int64)
+    '''
+
+    index = calendar_index(month)
+    first_day = month_first_days[index]
+    start_day = np.asarray(start_day, dtype="datetime64[D]").astype(np.int64)
+    end_day = np.asarray(end_day, dtype="datetime64[D]").astype(np.int64)
+    return np.minimum(end_day, first_day + month_lengths[index] - 1) - np.maximum(start_day, first_day) + 1
+
+
+def expand_to_months(start, end):
+    '''
+    expands episodes [start, end] into one entry per (episode, month) in one array-based pass
+    :param start: array of VNZR (datetime)
+    :param end: array of BSZR (datetime)
+    :return: episode (position in start/end), month (months since 1970-01), tage (days of the episode in month)
+    '''
+
+    start_day = np.asarray(start, dtype="datetime64[D]")
+    end_day = np.asarray(end, dtype="datetime64[D]")
+
+    # integer month indices, nr of months touched by each episode
+    first_month = start_day.astype("datetime64[M]").astype(np.int64)
+    n_months = np.maximum(end_day.astype("datetime64[M]").astype(np.int64) - first_month + 1, 0)
+
+    # repeat each episode once per month, count months within each episode via cumsum
+    episode = np.repeat(np.arange(len(start_day)), n_months)
+    episode_offset = np.cumsum(n_months) - n_months
+    month = first_month[episode] + np.arange(len(episode)) - episode_offset[episode]
+
+    # days in month = overlap of [start, end] with [first day, last day] of the month
+    tage = month_tage(month, start_day[episode], end_day[episode])
+
+    return episode, month, tage
+
+
+def expand_episodes(df):
+    '''
+    :param df: episodes (any number of FDZ_IDs) with VNZR, BSZR as datetime and ZREG, EGPT
+    :return: df with one row per episode and month: EPISODE (row position in df), FDZ_ID, JAHR, MONAT, TAGE,
+             EGPT and ZREG share of the month, ZREG_tag (ZREG per day of the episode)
+    '''
+
+    episode, month, tage = expand_to_months(df["VNZR"].values, df["BSZR"].values)
+
+    # ZREG and EGPT per day of each episode
+    nr_of_days = (np.asarray(df["BSZR"].values, dtype="datetime64[D]")
+                  - np.asarray(df["VNZR"].values, dtype="datetime64[D]")).astype(np.int64) + 1
+    zreg_daily = df["ZREG"].to_numpy(dtype="float64") / nr_of_days
+    egpt_daily = df["EGPT"].to_numpy(dtype="float64") / nr_of_days
+
+    return pd.DataFrame({
+        "EPISODE": episode,
+        "FDZ_ID": df["FDZ_ID"].values[episode],
+        "JAHR": month // 12 + 1970,
+        "MONAT": month % 12 + 1,
+        "TAGE": tage,
+        "EGPT": tage * egpt_daily[episode],
+        "ZREG": tage * zreg_daily[episode],
+        "ZREG_tag": zreg_daily[episode]
+    })
+
+
+def resolve_overlaps(start, end, egpt_daily=None, ids=None):
+    '''
+    sweep-line over episodes [start, end]: splits overlapping episodes into disjoint segments, in O(n log n)
+    :param start: array of VNZR (datetime)
+    :param end: array of BSZR (datetime)
+    :param egpt_daily: array of EGPT per day and episode (optional), summed where episodes overlap
+    :param ids: array of FDZ_ID per episode (optional), segments are built per ID - all IDs at once
+    :return: df with one row per disjoint segment covered by at least one episode:
+             (FDZ_ID), VNZR, BSZR, EGPT_daily
+    '''
+
+    start_day = np.asarray(start, dtype="datetime64[D]").astype(np.int64)
+    end_day = np.asarray(end, dtype="datetime64[D]").astype(np.int64)
+    if egpt_daily is None:
+        egpt_daily = np.zeros(len(start_day))
+    egpt_daily = np.asarray(egpt_daily, dtype="float64")
+    id_codes = np.zeros(len(start_day), dtype=np.int64) if ids is None else pd.factorize(ids)[0]
+
+    # events: episode starts at VNZR, ends the day after BSZR - sorted once by (ID, day)
+    event_day = np.concatenate([start_day, end_day + 1])
+    event_id = np.concatenate([id_codes, id_codes])
+    order = np.lexsort((event_day, event_id))
+    event_day = event_day[order]
+    event_id = event_id[order]
+
+    # running coverage count and running sum of EGPT_daily after each event
+    coverage = np.cumsum(np.concatenate([np.ones(len(start_day), dtype=np.int64),
+                                         -np.ones(len(start_day), dtype=np.int64)])[order])
+    egpt_sum = np.cumsum(np.concatenate([egpt_daily, -egpt_daily])[order])
+
+    # restart the EGPT sum wherever coverage drops to 0, so rounding errors don't carry over
+    last_zero = np.maximum.accumulate(np.where(coverage == 0, np.arange(len(coverage)), -1))
+    egpt_sum = egpt_sum - np.where(last_zero >= 0, egpt_sum[np.maximum(last_zero, 0)], 0.0)
+
+    # state after the last event of each (ID, day) holds until the day before the next event
+    last_event = np.ones(len(event_day), dtype=bool)
+    last_event[:-1] = (event_day[1:] != event_day[:-1]) | (event_id[1:] != event_id[:-1])
+    last_event = np.flatnonzero(last_event)
+    covered = last_event[coverage[last_event] > 0]
+    next_event = last_event[np.searchsorted(last_event, covered) + 1]
+
+    segments_df = pd.DataFrame({
+        "VNZR": event_day[covered].astype("datetime64[D]"),
+        "BSZR": (event_day[next_event] - 1).astype("datetime64[D]"),
+        "EGPT_daily": egpt_sum[covered]
+    })
+    if ids is not None:
+        segments_df.insert(0, "FDZ_ID", np.asarray(ids)[order % len(start_day)][covered])
+
+    return segments_df
+
+
+def segments_to_months(segments_df):
+    '''
+    :param segments_df: disjoint segments, output of resolve_overlaps
+    :return: df with TAGE (nr of covered days) and EGPT per (FDZ_ID), JAHR, MONAT
+    '''
+
+    episode, month, tage = expand_to_months(segments_df["VNZR"].values, segments_df["BSZR"].values)
+    months_df = pd.DataFrame({
+        "JAHR": month // 12 + 1970,
+        "MONAT": month % 12 + 1,
+        "TAGE": tage,
+        "EGPT": tage * segments_df["EGPT_daily"].values[episode]
+    })
+    keys = ["JAHR", "MONAT"]
+    if "FDZ_ID" in segments_df:
+        months_df.insert(0, "FDZ_ID", segments_df["FDZ_ID"].values[episode])
+        keys = ["FDZ_ID"] + keys
+
+    return months_df.groupby(keys, as_index=False)[["TAGE", "EGPT"]].sum()
+
+
+class Profile:
     '''
-    returns nr of days in month "month" of year "year"
+    collects time and nr of rows per stage and the slowest IDs. Cheap enough to stay on: one perf_counter call per
+    stage of an ID/block (group-free: the time of a block is split among its IDs by estimated cost, see pivot_chunk).
+    Workers return their Profile with the result, the profiles are merged in the main process and saved as report
+    (see save).
     '''
 
-    if month == 2:
-        # Schaltjahr / leap year
-        is_leap = (year % 4 == 0 and year % 100 != 0) or (year % 400 == 0)
-        return 29 if is_leap else 28
-    month_days = {
-        1: 31, 3: 31, 4: 30, 5: 31, 6: 30,
-        7: 31, 8: 31, 9: 30, 10: 31, 11: 30, 12: 31
-    }
-    return month_days.get(month, 0)
+    def __init__(self, n_slowest=20):
+        self.stages = {}  # stage -> [calls, seconds, rows]
+        self.slowest = []  # heap of (seconds, nr, info dict) - the n_slowest slowest IDs
+        self.n_slowest = n_slowest
+        self._recorded = 0
+        self.start()
+
+    def start(self):
+        self._last = time.perf_counter()
+
+    def lap(self, stage, rows=0):
+        '''
+        adds the time since the last lap (or start) to stage
+        :param stage: str
+        :param rows: int, nr of rows produced in this stage
+        '''
+
+        now = time.perf_counter()
+        entry = self.stages.setdefault(stage, [0, 0.0, 0])
+        entry[0] += 1
+        entry[1] += now - self._last
+        entry[2] += int(rows)
+        self._last = now
+
+    def record(self, seconds, **info):
+        '''
+        keeps info (e.g. FDZ_ID and nr of episodes) if it belongs to one of the n_slowest slowest IDs
+        '''
+
+        self._recorded += 1
+        info = {key: value.item() if hasattr(value, "item") else value for key, value in info.items()}
+        item = (seconds, self._recorded, dict(info, seconds=round(seconds, 6)))
+        if len(self.slowest) < self.n_slowest:
+            heapq.heappush(self.slowest, item)
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, item)
+
+    def merge(self, other):
+        for stage, (calls, seconds, rows) in other.stages.items():
+            entry = self.stages.setdefault(stage, [0, 0.0, 0])
+            entry[0] += calls
+            entry[1] += seconds
+            entry[2] += rows
+        for seconds, _, info in other.slowest:
+            self.record(seconds, **{key: value for key, value in info.items() if key != "seconds"})
+        return self
+
+    def to_df(self):
+        return pd.DataFrame([(stage, calls, seconds, rows) for stage, (calls, seconds, rows) in self.stages.items()],
+                            columns=["STAGE", "CALLS", "SECONDS", "ROWS"])
+
+    def save(self, file_path, chunks=None):
+        '''
+        saves the report as {file_path}.json (stages, slowest IDs, chunks) and {file_path}.csv (stages)
+        :param chunks: list of dicts (optional) - one entry per chunk (e.g. nr, IDs, rows, seconds)
+        '''
+
+        stages_df = self.to_df()
+        write_json({"stages": stages_df.to_dict(orient="records"),
+                    "slowest": [info for _, _, info in sorted(self.slowest, key=lambda item: -item[0])],
+                    "chunks": chunks or []}, file_path + ".json")
+        stages_df.to_csv(file_path + ".csv", index=False)
 
 
 #######################################################################################################################
@@ -32,32 +282,254 @@ def day_nr(year: int, month: int) -> int:
 
 # Loading and preprocessing:
 
-# load factors for ZREG calculations (see status 1)
-anlage10_df = pd.read_stata("D:/projects/soep_rv/VSKT/help/Anlage_10.dta")
-anlage10_df = anlage10_df.rename(columns={"Jahr": "JAHR", "Monat": "MONAT"})
+# factors for ZREG calculations (see status 1): default path, loaded by load_anlage10
+anlage10_path = "D:/projects/soep_rv/VSKT/help/Anlage_10.dta"
+
+# zustände of status 1 with ZREG adjusted by ANLAGE_10
+anlage10_zustaende = {"OSB", "OKN", "OSS", "ATZ_OSB", "ATZ_OKN"}
+
+
+def load_anlage10(file_path=anlage10_path):
+    '''
+    :param file_path: str, path of Anlage_10.dta (Jahr, Monat, ANLAGE_10)
+    :return: factors, first_month: dense array of ANLAGE_10 factors, factors[k] belongs to month first_month + k
+             (months since 1970-01), nan for months without factor
+    '''
+
+    df = pd.read_stata(file_path, columns=["Jahr", "Monat", "ANLAGE_10"])
+    month = (df["Jahr"].values.astype(np.int64) - 1970) * 12 + df["Monat"].values - 1
+    first_month = int(month.min())
+    factors = np.full(month.max() - first_month + 1, np.nan)
+    factors[month - first_month] = df["ANLAGE_10"].values
+    return factors, first_month
+
+
+def anlage10_factors(anlage10, month):
+    '''
+    :param anlage10: output of load_anlage10
+    :param month: array of months since 1970-01
+    :return: ANLAGE_10 factor per month (nan for months without factor)
+    '''
+
+    factors, first_month = anlage10
+    pos = np.asarray(month, dtype=np.int64) - first_month
+    inside = (pos >= 0) & (pos < len(factors))
+    return np.where(inside, factors[np.clip(pos, 0, len(factors) - 1)], np.nan)
+
 
 # ordered list of zustände, required for status 2 and 3 
 zustand_order = ["BRF", "BMP", "VRS", "ALG", "AUF", "ARM", "PFL", "FWB",
                  "SCH", "SON", "PMU", "USV",
                  "RTB", "HRT", "FRG", "FZR", "NJB", "AZ0", "AZ1", "ALH"]
 
+
+# rules for the zustände: zustand -> list of conditions (OR), each condition: column -> allowed values (AND),
+# columns without entry are not restricted. If applicable, a condition on 'Ses_frg' can be added to every rule.
+
+# status 1
+status_1_rules = {
+    "WSB": [{"BYAT": [10], "BYATSO": ["0", "3", "4", "5", "8", "9"], "VSGR": [1, 2, 3, 4], "RTVS": [0, 1]}],
+    "OSB": [{"BYAT": [10], "BYATSO": ["0", "3", "4", "5", "8", "9"], "VSGR": [1, 2, 3, 4], "RTVS": [5, 6]}],
+    "WKN": [{"BYAT": [10], "BYATSO": ["0", "3", "4", "5", "8", "9"], "VSGR": [5, 6], "RTVS": [0, 1]}],
+    "OKN": [{"BYAT": [10], "BYATSO": ["0", "3", "4", "5", "8", "9"], "VSGR": [5, 6], "RTVS": [5, 6]}],
+    "ATZ WSB": [{"BYAT": [9], "VSGR": [1, 2, 3, 4], "RTVS": [0, 1]}],
+    "ATZ OSB": [{"BYAT": [9], "VSGR": [1, 2, 3, 4], "RTVS": [5, 6]}],
+    "ATZ WKN": [{"BYAT": [9], "VSGR": [5, 6], "RTVS": [0, 1]}],
+    "ATZ OKN": [{"BYAT": [9], "VSGR": [5, 6], "RTVS": [5, 6]}],
+    "WSS": [{"BYAT": [17], "VSGR": [1, 2, 3, 4], "RTVS": [0, 1]}],
+    "OSS": [{"BYAT": [17], "VSGR": [1, 2, 3, 4], "RTVS": [5, 6]}]}
+
+# status 2 and 3
+status_23_rules = {
+    "BRF": [{"BYAT": [10], "BYATSO": ["1", "2", "6", "7"]}],
+    "BMP": [{"BYAT": [90]}],
+    "VRS": [{"BYAT": [18]}],
+    "ALG": [{"BYAT": [13]}],
+    "AUF": [{"BYAT": [12]}, {"BYAT": [40, 41, 48], "BYATSO": ["1", "A"]}],
+    "ARM": [{"BYAT": [14]}],
+    "PFL": [{"BYAT": [7]}, {"BYAT": [60], "BYATSO": ["2"]}, {"BYAT": [20, 21], "BYATSO": ["8"]}],
+    "FWB": [{"BYAT": [20, 21], "BYATSO": ["0", "2", "5", "6", "7"]}],
+    "SCH": [{"BYAT": [20, 21], "BYATSO": ["3"]}, {"BYAT": [40, 41, 42, 43, 48], "BYATSO": ["4", "6", "7", "8", "C"]}],
+    "SON": [{"BYAT": [  # 8, 15, 16, 30, 31,
+                      26, 49]},
+            {"BYAT": [40, 41, 48], "BYATSO": ["9", "2"]},
+            # {"BYAT": [60], "BYATSO": ["6", "7"]},
+            {"BYAT": [20, 21], "BYATSO": ["1"]}],
+    "PMU": [{"BYAT": [11]}],
+    "USV": [{"BYAT": [2, 3]}],
+    "RTB": [{"BYAT": [70, 71, 72]}],
+    "HRT": [{"BYAT": [20, 21], "BYATSO": ["4"]}],
+    # "FRG": KZSO not missing and != 0 - todo: may need some finetuning!
+    "FZR": [{"BYAT": [25]}],
+    "AZ0": [{"BYAT": [40, 41, 48], "BYATSO": ["5"], "RTVS": [0]}],
+    "AZ1": [{"BYAT": [40, 41, 48], "BYATSO": ["5"], "RTVS": [1]}],
+    "ALH": [{"BYAT": [4]}, {"BYAT": [40, 41, 48], "BYATSO": ["3", "B", "D"]}]}
+
+# rule sets per berichtsjahr: first berichtsjahr a rule set applies to -> rules for status 1 and status 2/3
+rule_sets = {2011: {"STATUS_1": status_1_rules, "STATUS_23": status_23_rules}}
+
+
+class RuleTable:
+    '''
+    rule set compiled into a lookup table keyed on the code combination (BYAT, BYATSO, VSGR, RTVS): every
+    combination is checked against the rules once, episodes are then classified by a single gather
+    '''
+
+    keys = ["BYAT", "BYATSO", "VSGR", "RTVS"]
+
+    def __init__(self, rule_set):
+        self.rules = {status: dict(rules) for status, rules in rule_set.items()}
+        self.zustaende = {status: list(rules) for status, rules in rule_set.items()}
+        self.lookup = {}  # (BYAT, BYATSO, VSGR, RTVS) -> code per status (-1 = no zustand)
+
+    def evaluate(self, combo):
+        '''
+        :param combo: tuple (BYAT, BYATSO, VSGR, RTVS)
+        :return: tuple with the code of the matching zustand per status, -1 if there is none
+        '''
+
+        values = dict(zip(self.keys, combo))
+        codes = []
+        for status, rules in self.rules.items():
+            matches = [code for code, conditions in enumerate(rules.values())
+                       if any(all(values[col] in allowed for col, allowed in condition.items())
+                              for condition in conditions)]
+            if len(matches) > 1:
+                raise ValueError(f"{combo} matches more than one zustand of {status}: "
+                                 f"{[self.zustaende[status][code] for code in matches]}")
+            codes.append(matches[0] if matches else -1)
+        return tuple(codes)
+
+    def classify(self, data):
+        '''
+        :param data: episodes with BYAT, BYATSO, VSGR, RTVS
+        :return: dict status -> Categorical of zustände (one per episode, missing if no rule applies)
+        '''
+
+        combos = pd.MultiIndex.from_arrays([data[col] for col in self.keys])
+        combo_codes, unique_combos = combos.factorize()
+        for combo in unique_combos:
+            if combo not in self.lookup:
+                self.lookup[combo] = self.evaluate(combo)
+
+        table = np.array([self.lookup[combo] for combo in unique_combos], dtype=np.int8).reshape(-1, len(self.rules))
+        return {status: pd.Categorical.from_codes(table[combo_codes, k], categories=self.zustaende[status])
+                for k, status in enumerate(self.rules)}
+
+
+# compiled rule tables, one per rule set
+_rule_tables = {}
+
+
+def rule_table(berichtsjahr):
+    '''
+    returns the compiled RuleTable of the rule set valid for berichtsjahr
+    '''
+
+    first_year = max((year for year in rule_sets if year <= berichtsjahr), default=min(rule_sets))
+    if first_year not in _rule_tables:
+        _rule_tables[first_year] = RuleTable(rule_sets[first_year])
+    return _rule_tables[first_year]
+
+
+def classify_episodes(df, berichtsjahr):
+    '''
+    adds zustand for status 1 (ZUSTAND_1) and status 2/3 (ZUSTAND_23) to every episode of df
+    '''
+
+    zustaende = rule_table(berichtsjahr).classify(df)
+    df["ZUSTAND_1"] = zustaende["STATUS_1"]
+    df["ZUSTAND_23"] = zustaende["STATUS_23"]
+    return df
+
+
+def status_labels(berichtsjahr):
+    '''
+    shared category table of STATUS_1, STATUS_2 and STATUS_3 (the output stores int8 codes into this list):
+    zustand_order, followed by the zustände of status 1
+    '''
+
+    return zustand_order + [zustand for zustand in rule_table(berichtsjahr).zustaende["STATUS_1"]
+                            if zustand not in zustand_order]
+
+
+# columns of the VAR dataset used by pivot_episodes - all other columns are not loaded
+var_columns = ["FDZ_ID", "VNZR", "BSZR", "BYAT", "BYATSO", "VSGR", "RTVS", "ZREG", "EGPT"]
+
+
+def convert_dates(df):
+    '''
+    transforms time variables VNZR, BSZR (YYYYMMDD) into datetime objects
+    '''
+
+    df["VNZR"] = pd.to_datetime(df["VNZR"], format="%Y%m%d")
+    df["BSZR"] = pd.to_datetime(df["BSZR"], format="%Y%m%d")
+    return df
+
+
 # load data
-def load_and_preprocess(berichtsjahr):
-    load_start = time.time()
+def load_and_preprocess(berichtsjahr, data_path="", chunksize=None, cache_folder=None, group_free=False,
+                        engine="pandas"):
+    '''
+    :param berichtsjahr: int
+    :param data_path: str, folder containing OSV.VVL.{berichtsjahr}.VAR.dta
+    :param chunksize: int (optional) - if given, the file is streamed in chunks of chunksize rows and the ID groups
+                      are yielded lazily (file has to be sorted by FDZ_ID), peak memory scales with chunksize
+    :param cache_folder: str (optional) - if given, the .dta file is converted once to a Parquet cache in
+                         cache_folder (see convert_to_parquet) and read from there in all later runs
+    :param group_free: bool - if True, no per-ID DataFrames are built, the episodes are returned as EpisodeArrays
+                       (sorted by FDZ_ID, processed in blocks of IDs by pivot_block)
+    :param engine: "pandas" or "polars" - polars: the episodes are returned as LazyEpisodes, a lazy query on the
+                   Parquet cache (needs cache_folder), processed by pivot_lazy
+    :return: list of (FDZ_ID, episodes) pairs, generator of these pairs if chunksize is given,
+             EpisodeArrays if group_free, LazyEpisodes if engine == "polars"
+    '''
 
-    data_path = "" todo: adjust
     file_name = f"OSV.VVL.{berichtsjahr}.VAR.dta"
-    print(f"Loading data for {berichtsjahr} from {data_path} ...")
 
-    df = pd.read_stata(data_path + file_name, convert_categoricals=False)
+    if chunksize is not None and group_free:
+        raise ValueError("chunksize (streamed ID groups) and group_free can't be combined.")
+    if engine == "polars":
+        if pl is None:
+            raise ImportError("engine='polars' needs the polars package.")
+        if cache_folder is None or chunksize is not None:
+            raise ValueError("engine='polars' reads the Parquet cache: cache_folder is needed, chunksize is not used.")
+        cache_path = convert_to_parquet(berichtsjahr, data_path, cache_folder)
+        print(f"Scanning data for {berichtsjahr} from {cache_path} (polars) ...")
+        return LazyEpisodes.from_parquet(cache_path, berichtsjahr)
+    if engine != "pandas":
+        raise ValueError(f"Unknown engine {engine}, use 'pandas' or 'polars'.")
+
+    if cache_folder is not None:
+        cache_path = convert_to_parquet(berichtsjahr, data_path, cache_folder)
+        if chunksize is not None:
+            # partitions never split an ID, each one is read as a whole
+            print(f"Streaming data for {berichtsjahr} from {cache_path} by partition ...")
+            return iter_cached_id_groups(cache_path, berichtsjahr)
+        load_start = time.time()
+        print(f"Loading data for {berichtsjahr} from {cache_path} ...")
+        df = read_parquet_cache(cache_path)
+
+    elif chunksize is not None:
+        print(f"Streaming data for {berichtsjahr} from {data_path} in chunks of {chunksize} rows ...")
+        return iter_id_groups(data_path + file_name, chunksize, berichtsjahr)
+
+    else:
+        load_start = time.time()
+        print(f"Loading data for {berichtsjahr} from {data_path} ...")
+        df = pd.read_stata(data_path + file_name, convert_categoricals=False, columns=var_columns)
+        # transform time variables into datetime objects
+        df = convert_dates(df)
 
     load_end = time.time()
     print(f"Dataset loaded in {round(load_end - load_start, 3)} seconds.")
     print(f" Number of episodes: {len(df)}.")
 
-    # transform time variables into datetime objects
-    df["VNZR"] = pd.to_datetime(df["VNZR"], format="%Y%m%d")
-    df["BSZR"] = pd.to_datetime(df["BSZR"], format="%Y%m%d")
+    # classify zustände
+    df = classify_episodes(df, berichtsjahr)
+
+    if group_free:
+        return EpisodeArrays.from_df(df)
 
     # group by FDZ_ID
     grouped_df = df.groupby("FDZ_ID")
@@ -66,6 +538,404 @@ def load_and_preprocess(berichtsjahr):
     return id_groups
 
 
+def iter_id_groups(file_path, chunksize, berichtsjahr):
+    '''
+    reads a VAR dataset (sorted by FDZ_ID) in chunks and yields complete ID groups,
+    IDs straddling the boundary between two chunks are carried over to the next chunk
+    :param file_path: str
+    :param chunksize: int, nr of rows read at once
+    :param berichtsjahr: int, selects the rules for the zustände
+    :return: generator of (FDZ_ID, episodes) pairs
+    '''
+
+    carry_df = None
+
+    with pd.read_stata(file_path, convert_categoricals=False, columns=var_columns, chunksize=chunksize) as reader:
+        for chunk in reader:
+            chunk = classify_episodes(convert_dates(chunk), berichtsjahr)
+            if carry_df is not None:
+                chunk = pd.concat([carry_df, chunk])
+
+            ids = chunk["FDZ_ID"].values
+            if (ids[1:] < ids[:-1]).any():
+                raise ValueError(f"{file_path} is not sorted by FDZ_ID, can't be streamed. Load without chunksize.")
+
+            # the last ID of the chunk may continue in the next chunk: keep its rows back
+            split = np.searchsorted(ids, ids[-1], side="left")
+            carry_df = chunk.iloc[split:]
+
+            for id, group in chunk.iloc[:split].groupby("FDZ_ID", sort=False):
+                yield id, group
+
+    if carry_df is not None and len(carry_df) != 0:
+        yield carry_df["FDZ_ID"].iloc[0], carry_df
+
+
+def file_hash(file_path):
+    '''
+    returns sha256 hex digest of a file, read in blocks of 16 MB
+    '''
+
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(16 * 1024 * 1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def cache_is_valid(source_path, cache_path):
+    '''
+    checks whether the Parquet cache in cache_path was built from the current version of source_path:
+    unchanged size and mtime are accepted directly, otherwise the file hash decides
+    '''
+
+    meta_path = os.path.join(cache_path, "_cache.json")
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+
+    stat = os.stat(source_path)
+    if meta["source_size"] == stat.st_size and meta["source_mtime_ns"] == stat.st_mtime_ns:
+        return True
+    if meta["source_size"] != stat.st_size or meta["source_sha256"] != file_hash(source_path):
+        return False
+
+    # file was touched, but not changed: remember the new mtime (replaced atomically, other processes may read it)
+    meta["source_mtime_ns"] = stat.st_mtime_ns
+    handle, temp_path = tempfile.mkstemp(dir=cache_path, suffix=".tmp")
+    with os.fdopen(handle, "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(temp_path, meta_path)
+    return True
+
+
+def convert_to_parquet(berichtsjahr, data_path, cache_folder, partition_size=5000000, row_group_size=65536,
+                       rename_attempts=10):
+    '''
+    converts OSV.VVL.{berichtsjahr}.VAR.dta once into a typed, FDZ_ID-sorted Parquet dataset, partitioned into files
+    of about partition_size rows (an ID is never split between partitions). VNZR, BSZR are stored as int32 day
+    numbers (days since 1970-01-01), BYATSO as categorical, BYAT, VSGR, RTVS as the smallest integer type.
+    The FDZ_ID index of the dataset (see id_index) is saved with it.
+    Nothing is done if the cache is still valid (see cache_is_valid). The cache is built in a temporary folder next to
+    it and renamed when complete, a valid cache is never changed: processes sharing a cold cache_folder (shards) may
+    convert at the same time, the first complete cache is used by all of them.
+    :param berichtsjahr: int
+    :param data_path: str, folder containing OSV.VVL.{berichtsjahr}.VAR.dta
+    :param cache_folder: str
+    :param partition_size: int, nr of rows per partition
+    :param row_group_size: int, nr of rows per row group - the smallest unit read by read_ids
+    :param rename_attempts: int, nr of attempts to replace an outdated cache (OSError if other processes keep
+                            replacing it)
+    :return: path of the Parquet dataset
+    '''
+
+    source_path = data_path + f"OSV.VVL.{berichtsjahr}.VAR.dta"
+    cache_path = os.path.join(cache_folder, f"OSV.VVL.{berichtsjahr}.VAR.parquet")
+
+    if cache_is_valid(source_path, cache_path):
+        return cache_path
+
+    convert_start = time.time()
+    print(f"Converting {source_path} to {cache_path} ...")
+
+    df = pd.read_stata(source_path, convert_categoricals=False, columns=var_columns)
+    df = convert_dates(df)
+
+    # stable sort keeps the order of the episodes within each ID
+    df = df.sort_values("FDZ_ID", kind="stable", ignore_index=True)
+
+    # compact types
+    for col in ["VNZR", "BSZR"]:
+        df[col] = df[col].values.astype("datetime64[D]").astype(np.int32)
+    df["BYATSO"] = df["BYATSO"].astype("category")
+    for col in ["BYAT", "VSGR", "RTVS"]:
+        df[col] = pd.to_numeric(df[col], downcast="integer")
+
+    # write partitions into a temporary folder - starting rows of partitions are moved to the next new ID
+    os.makedirs(cache_folder, exist_ok=True)
+    build_path = tempfile.mkdtemp(prefix=f"OSV.VVL.{berichtsjahr}.VAR.parquet.", suffix=".tmp", dir=cache_folder)
+
+    ids = df["FDZ_ID"].values
+    id_starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    bounds = np.unique(id_starts[np.searchsorted(id_starts, np.arange(0, len(df), partition_size))])
+    bounds = np.r_[bounds, len(df)]
+
+    for k in range(len(bounds) - 1):
+        part_df = df.iloc[bounds[k]:bounds[k + 1]]
+        pq.write_table(pa.Table.from_pandas(part_df, preserve_index=False),
+                       os.path.join(build_path, f"part_{k:05d}.parquet"), row_group_size=row_group_size)
+
+    stat = os.stat(source_path)
+    with open(os.path.join(build_path, "_cache.json"), "w") as f:
+        json.dump({"source": source_path,
+                   "source_size": stat.st_size,
+                   "source_mtime_ns": stat.st_mtime_ns,
+                   "source_sha256": file_hash(source_path),
+                   "rows": len(df),
+                   "partitions": len(bounds) - 1}, f, indent=2)
+    write_id_index(build_path)
+
+    # rename into place: an outdated cache is moved aside and removed, a cache completed by another process meanwhile
+    # is kept (renaming onto an existing folder fails with EEXIST or ENOTEMPTY, any other error is raised)
+    for _ in range(rename_attempts):
+        try:
+            os.rename(build_path, cache_path)
+            break
+        except OSError as error:
+            if error.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                shutil.rmtree(build_path, ignore_errors=True)
+                raise
+            if cache_is_valid(source_path, cache_path):
+                shutil.rmtree(build_path)
+                break
+            try:
+                os.rename(cache_path, build_path + ".old")
+            except FileNotFoundError:
+                pass  # moved aside by another process
+            shutil.rmtree(build_path + ".old", ignore_errors=True)
+    else:
+        shutil.rmtree(build_path, ignore_errors=True)
+        raise OSError(f"Outdated cache {cache_path} could not be replaced in {rename_attempts} attempts.")
+
+    print(f" Done in {round(time.time() - convert_start, 3)} seconds.")
+
+    return cache_path
+
+
+def read_parquet_partition(file_path):
+    '''
+    reads one partition of the Parquet cache (memory-mapped), day numbers are turned back into datetime objects
+    '''
+
+    df = pq.read_table(file_path, memory_map=True).to_pandas()
+    for col in ["VNZR", "BSZR"]:
+        df[col] = df[col].values.astype("datetime64[D]").astype("datetime64[ns]")
+    return df
+
+
+def read_parquet_cache(cache_path):
+    '''
+    :param cache_path: output of convert_to_parquet
+    :return: df with all episodes, sorted by FDZ_ID
+    '''
+
+    files = sorted(f for f in os.listdir(cache_path) if f.endswith(".parquet"))
+    return pd.concat([read_parquet_partition(os.path.join(cache_path, f)) for f in files], ignore_index=True)
+
+
+def iter_cached_id_groups(cache_path, berichtsjahr):
+    '''
+    :param cache_path: output of convert_to_parquet
+    :param berichtsjahr: int, selects the rules for the zustände
+    :return: generator of (FDZ_ID, episodes) pairs, one partition in memory at a time
+    '''
+
+    for file in sorted(f for f in os.listdir(cache_path) if f.endswith(".parquet")):
+        df = classify_episodes(read_parquet_partition(os.path.join(cache_path, file)), berichtsjahr)
+        for id, group in df.groupby("FDZ_ID", sort=False):
+            yield id, group
+
+
+# FDZ_ID indexes of Parquet caches, loaded once per process
+_id_indexes = {}
+
+
+def id_index(cache_path):
+    '''
+    FDZ_ID index of a Parquet cache: partition and rows of the episodes of every ID. Built once from the FDZ_ID
+    column of the partitions and saved as _index.arrow in cache_path (removed with the partitions when the cache is
+    rebuilt).
+    :param cache_path: output of convert_to_parquet
+    :return: dict with numpy arrays, one entry per ID: FDZ_ID (sorted), PARTITION (position of the file among the
+             sorted partition files), ROW (first row within the partition), N (nr of rows)
+    '''
+
+    index_path = os.path.join(cache_path, "_index.arrow")
+    if not os.path.isfile(index_path):
+        write_id_index(cache_path)  # cache converted before the index existed
+
+    key = (cache_path, os.stat(index_path).st_mtime_ns)
+    if key not in _id_indexes:
+        table = feather.read_table(index_path)
+        _id_indexes[key] = {col: table.column(col).to_numpy() for col in table.column_names}
+    return _id_indexes[key]
+
+
+def write_id_index(cache_path):
+    '''
+    builds the FDZ_ID index of a Parquet cache (see id_index) and saves it atomically as _index.arrow in cache_path
+    '''
+
+    columns = {"FDZ_ID": [], "PARTITION": [], "ROW": [], "N": []}
+    files = sorted(f for f in os.listdir(cache_path) if f.endswith(".parquet"))
+    for partition, file in enumerate(files):
+        ids = pq.read_table(os.path.join(cache_path, file), columns=["FDZ_ID"]).column(0).to_numpy()
+        starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]]) if len(ids) else np.zeros(0, dtype=np.int64)
+        columns["FDZ_ID"].append(ids[starts])
+        columns["PARTITION"].append(np.full(len(starts), partition, dtype=np.int32))
+        columns["ROW"].append(starts.astype(np.int64))
+        columns["N"].append(np.diff(np.r_[starts, len(ids)]).astype(np.int64))
+
+    # unique temporary file: several processes may build the index of the same cache
+    handle, temp_path = tempfile.mkstemp(dir=cache_path, suffix=".tmp")
+    os.close(handle)
+    feather.write_feather(pa.table({col: np.concatenate(values) for col, values in columns.items()}), temp_path)
+    os.replace(temp_path, os.path.join(cache_path, "_index.arrow"))
+
+
+def read_ids(cache_path, ids=None, id_range=None):
+    '''
+    reads the episodes of some IDs from the Parquet cache: the rows are looked up in the FDZ_ID index (see id_index),
+    only the row groups holding them are read
+    :param cache_path: output of convert_to_parquet
+    :param ids: list of FDZ_IDs (optional) - IDs without episodes are left out
+    :param id_range: tuple (first FDZ_ID, last FDZ_ID) (optional) - all IDs from first to last (inclusive)
+    :return: df with the episodes of these IDs, sorted by FDZ_ID (as read_parquet_cache)
+    '''
+
+    index = id_index(cache_path)
+    index_ids = index["FDZ_ID"]
+    if ids is not None:
+        ids = np.unique(np.asarray(ids).astype(index_ids.dtype))
+        positions = np.minimum(np.searchsorted(index_ids, ids), max(len(index_ids) - 1, 0))
+        positions = positions[index_ids[positions] == ids] if len(index_ids) else positions[:0]
+    elif id_range is not None:
+        first, last = np.asarray(id_range).astype(index_ids.dtype)
+        positions = np.arange(np.searchsorted(index_ids, first, side="left"),
+                              np.searchsorted(index_ids, last, side="right"))
+    else:
+        raise ValueError("ids or id_range is needed.")
+
+    files = sorted(f for f in os.listdir(cache_path) if f.endswith(".parquet"))
+    tables = []
+    for partition in np.unique(index["PARTITION"][positions]):
+        selected = positions[index["PARTITION"][positions] == partition]
+        starts, lengths = index["ROW"][selected], index["N"][selected]
+        rows = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+        # row groups holding the rows, rows of the partition -> rows of the row groups read
+        parquet_file = pq.ParquetFile(os.path.join(cache_path, files[partition]), memory_map=True)
+        group_starts = np.cumsum([0] + [parquet_file.metadata.row_group(k).num_rows
+                                        for k in range(parquet_file.num_row_groups)])
+        row_groups = np.unique(np.searchsorted(group_starts, rows, side="right") - 1)
+        read_starts = np.r_[0, np.cumsum(np.diff(group_starts)[row_groups])]
+        group_of_row = np.searchsorted(group_starts, rows, side="right") - 1
+        table_rows = read_starts[np.searchsorted(row_groups, group_of_row)] + rows - group_starts[group_of_row]
+        tables.append(parquet_file.read_row_groups(row_groups.tolist()).take(table_rows))
+
+    if not tables:
+        tables = [pq.read_schema(os.path.join(cache_path, files[0])).empty_table()]
+    df = pa.concat_tables(tables).to_pandas()
+    for col in ["VNZR", "BSZR"]:
+        df[col] = df[col].values.astype("datetime64[D]").astype("datetime64[ns]")
+    return df
+
+
+class EpisodeArrays:
+    '''
+    episodes of many IDs as plain column arrays, sorted by FDZ_ID - the episodes of the k-th ID are the rows
+    offsets[k]:offsets[k+1]. Dates are day numbers (days since 1970-01-01), zustände are codes of the rule table
+    (-1 = no zustand). Blocks of IDs are views on the same arrays, no per-ID DataFrames are needed.
+    If the arrays are memory-mapped files (see to_memmap), only folder and row range are pickled when a block is sent
+    to a worker - the worker maps the same files and reads its rows without a copy.
+    '''
+
+    def __init__(self, columns, offsets, folder=None, row_start=0):
+        self.columns = columns  # dict column name -> np.ndarray
+        self.offsets = offsets  # int64 array of length nr of IDs + 1
+        self.folder = folder  # folder of the memory-mapped .npy files (None = arrays in memory)
+        self.row_start = row_start  # first row of the block within the memory-mapped files
+
+    @classmethod
+    def from_df(cls, df):
+        '''
+        :param df: episodes with classified zustände (see classify_episodes)
+        '''
+
+        # stable sort keeps the order of the episodes within each ID (as df.groupby("FDZ_ID"))
+        df = df.sort_values("FDZ_ID", kind="stable", ignore_index=True)
+
+        columns = {
+            "FDZ_ID": df["FDZ_ID"].values,
+            "VNZR": df["VNZR"].values.astype("datetime64[D]").astype(np.int32),
+            "BSZR": df["BSZR"].values.astype("datetime64[D]").astype(np.int32),
+            "BYAT": df["BYAT"].values,
+            "ZUSTAND_1": df["ZUSTAND_1"].cat.codes.values.astype(np.int8),
+            "ZUSTAND_23": df["ZUSTAND_23"].cat.codes.values.astype(np.int8),
+            "ZREG": df["ZREG"].to_numpy(dtype="float64"),
+            "EGPT": df["EGPT"].to_numpy(dtype="float64")}
+
+        ids = columns["FDZ_ID"]
+        offsets = np.r_[0, np.flatnonzero(ids[1:] != ids[:-1]) + 1, len(ids)].astype(np.int64)
+        if len(ids) == 0:
+            offsets = np.zeros(1, dtype=np.int64)
+
+        return cls(columns, offsets)
+
+    def __len__(self):
+        # nr of IDs
+        return len(self.offsets) - 1
+
+    def ids(self):
+        return self.columns["FDZ_ID"][self.offsets[:-1]]
+
+    def block(self, first, last):
+        '''
+        returns IDs first, ..., last - 1 as EpisodeArrays (views on the same arrays)
+        '''
+
+        rows = slice(self.offsets[first], self.offsets[last])
+        return EpisodeArrays({col: values[rows] for col, values in self.columns.items()},
+                             self.offsets[first:last + 1] - self.offsets[first],
+                             self.folder, self.row_start + self.offsets[first])
+
+    def to_memmap(self, folder):
+        '''
+        saves all columns as .npy files to folder
+        :return: EpisodeArrays on memory-mapped (read-only) views of the files
+        '''
+
+        os.makedirs(folder, exist_ok=True)
+        for col, values in self.columns.items():
+            if values.dtype == object:
+                # object arrays (e.g. string IDs) can't be mapped, use fixed width strings
+                values = values.astype(str)
+            np.save(os.path.join(folder, f"{col}.npy"), values)
+        return EpisodeArrays(open_memmaps(folder, list(self.columns)), self.offsets, folder, 0)
+
+    def __getstate__(self):
+        if self.folder is None:
+            return self.__dict__
+        # memory-mapped: pickle the row range only
+        return {"folder": self.folder, "row_start": self.row_start, "offsets": self.offsets,
+                "column_names": list(self.columns)}
+
+    def __setstate__(self, state):
+        if "column_names" in state:
+            rows = slice(state["row_start"], state["row_start"] + state["offsets"][-1])
+            state = {"columns": {col: values[rows]
+                                 for col, values in open_memmaps(state["folder"], state["column_names"]).items()},
+                     "offsets": state["offsets"], "folder": state["folder"], "row_start": state["row_start"]}
+        self.__dict__.update(state)
+
+
+# memory-mapped columns per folder, opened once per process
+_memmaps = {}
+
+
+def open_memmaps(folder, column_names):
+    '''
+    :return: dict column name -> read-only memory-mapped array of {folder}/{column}.npy
+    '''
+
+    # files rewritten in the same folder get a new key
+    key = (folder, tuple(column_names), os.stat(os.path.join(folder, f"{column_names[0]}.npy")).st_mtime_ns)
+    if key not in _memmaps:
+        _memmaps[key] = {col: np.load(os.path.join(folder, f"{col}.npy"), mmap_mode="r") for col in column_names}
+    return _memmaps[key]
+
+
 '''
 Idea: We loop over all ID's. For a fixed ID we take each Status/Zustand and transform the corresponding episodes 
 into a new df with columns JAHR, MONAT, TAGE, EGPT, ZREG etc. (following each status' specific rules / requirements).
@@ -75,25 +945,34 @@ The result is one big df per ID and these are then concatenated into the final r
 
 
 # wrap all operations in a function, so that we can parallelise at the end:
-def pivot_episodes(id, data, berichtsjahr):
+def pivot_episodes(id, data, berichtsjahr, anlage10, profile=None):
     '''
     :param id: FDZ_ID
     :param data: element of df.groupby("FDZ_ID")
+    :param berichtsjahr: int
+    :param anlage10: output of load_anlage10
+    :param profile: Profile (optional) - time and rows per stage are added
     :return: df in (JAHR,MONAT) format, built from all episodes of FDZ_ID
     '''
 
+    if profile is None:
+        profile = Profile()
+    profile.start()
+
     # define timerange
     min_date = data["VNZR"].min()
     max_date = pd.to_datetime(f"{berichtsjahr}1231", format="%Y%m%d")  # End of Berichtsjahr
 
-    # generate new df in required format - .replace ensures that first month is accounted for
+    # generate new df in required format - all months from the first month with an episode on
+    months = np.arange((min_date.year - 1970) * 12 + min_date.month - 1, (max_date.year - 1970) * 12 + max_date.month)
     data_transformed = pd.DataFrame(
         {"ID": id,
-         "JAHR": pd.date_range(min_date.replace(day=1), max_date, freq="MS").year,
-         "MONAT": pd.date_range(min_date.replace(day=1), max_date, freq="MS").month
+         "JAHR": (months // 12 + 1970).astype(np.int32),
+         "MONAT": (months % 12 + 1).astype(np.int32),
+         "TAGE": month_length(months)
          }
     )
-    data_transformed["TAGE"] = data_transformed.apply(lambda row: day_nr(row["JAHR"], row["MONAT"]), axis=1)
+    profile.lap("grid", len(data_transformed))
 
     # now fill data_transformed with all the data for status 1 to 5, then append to id_df_list
 
@@ -101,94 +980,44 @@ def pivot_episodes(id, data, berichtsjahr):
 
     # STATUS 1:
 
-    # dictionary for Zustände - if applicable, add " & (data['Ses_frg'].isna()) " to every condition
-
-    conditions = {
-        "WSB": (data['BYAT'] == 10) & (data['BYATSO'].isin(["0", "3", "4", "5", "8", "9"])) & (data[
-                                           'VSGR'].isin([1, 2, 3, 4])) & (data['RTVS'].isin([0, 1])),
-        "OSB": (data['BYAT'] == 10) & (data['BYATSO'].isin(["0", "3", "4", "5", "8", "9"])) & (data[
-                                           'VSGR'].isin([1, 2, 3, 4])) & (data['RTVS'].isin([5, 6])),
-        "WKN": (data['BYAT'] == 10) & (data['BYATSO'].isin(["0", "3", "4", "5", "8", "9"])) & (data[
-                                           'VSGR'].isin([5, 6])) & (data['RTVS'].isin([0, 1])),
-        "OKN": (data['BYAT'] == 10) & (data['BYATSO'].isin(["0", "3", "4", "5", "8", "9"])) & (data[
-                                           'VSGR'].isin([5, 6])) & (data['RTVS'].isin([5, 6])),
-        "ATZ WSB": (data['BYAT'] == 9) & (data['VSGR'].isin([1, 2, 3, 4])) & (
-        data['RTVS'].isin(
-            [0, 1])),
-        "ATZ OSB": (data['BYAT'] == 9) & (data['VSGR'].isin([1, 2, 3, 4])) & (
-        data['RTVS'].isin(
-            [5, 6])),
-        "ATZ WKN": (data['BYAT'] == 9) & data['VSGR'].isin([5, 6]) & data['RTVS'].isin([0, 1]),
-        "ATZ OKN": (data['BYAT'] == 9) & data['VSGR'].isin([5, 6]) & data['RTVS'].isin([5, 6]),
-        "WSS": (data['BYAT'] == 17) & data['VSGR'].isin([1, 2, 3, 4]) & data['RTVS'].isin([0, 1]),
-        "OSS": (data['BYAT'] == 17) & data['VSGR'].isin([1, 2, 3, 4]) & data['RTVS'].isin([5, 6])}
+    # zustände per episode (classified once by the compiled rule table, see classify_episodes)
+    zustaende = rule_table(berichtsjahr).zustaende
+    if "ZUSTAND_1" not in data:
+        data = classify_episodes(data.copy(), berichtsjahr)
+    zustand_rows = data.groupby("ZUSTAND_1", observed=True).indices
 
     # list to save all the df's, one per zustand
     zustand_df_liste = []
 
     # for each zustand read the episodes, calculate the required variables and format to merge with data_transformed:
 
-    for zustand, bedingung in conditions.items():
+    for zustand in zustaende["STATUS_1"]:
 
         # isolate zustand
-        zustand_df = data[bedingung]
+        zustand_df = data.iloc[zustand_rows.get(zustand, [])]
 
         if len(zustand_df) != 0:
 
-            # list to save temporary results
-            episode_df_list = []
-
-            # loop over episodes for the current zustand
-            for i in range(len(zustand_df)):
-                row = zustand_df.iloc[i]
-                start_date = row.VNZR
-                end_date = row.BSZR
-                nr_of_days = len(pd.date_range(start_date, end_date, freq="D"))
-
-                # 3 lists: 1 and 2 give (JAHR, MONAT) in the timespan, 3 gives STATUS_1_TAGE for each combo JAHR,MONAT:
-
-                month_list = pd.date_range(start_date.replace(day=1), end_date, freq="MS").month.tolist()
-                year_list = pd.date_range(start_date.replace(day=1), end_date, freq="MS").year.tolist()
-
-                if len(month_list) == 1:
-                    status_tage = [(end_date.date() - start_date.date()).days + 1]
-                else:
-                    next_month = (start_date + pd.offsets.MonthEnd(0)).date()
-                    status_tage = [(next_month - start_date.date()).days + 1]  # first entry = days in first month
-                    if len(month_list) > 2:  # days in the intermediate months
-                        for j in range(1, len(month_list) - 1):
-                            status_tage.append(day_nr(year_list[j], month_list[j]))
-                    status_tage.append(end_date.day)  # days in last month
-
-                # save as new df
-                episode_df = pd.DataFrame({
-                    "JAHR": year_list,
-                    "MONAT": month_list,
-                    "STATUS_1": zustand,
-                    "STATUS_1_TAGE": status_tage
-                })
-
-                # calculate ZREG und EGPT per day (zustände are ordered by zreg_daily)
-                zreg_daily = row.ZREG / nr_of_days
-                egpt_daily = row.EGPT / nr_of_days
-
-                # calculate monthly values
-                episode_df["STATUS_1_ZREG"] = episode_df["STATUS_1_TAGE"] * zreg_daily
-                episode_df["STATUS_1_EGPT"] = episode_df["STATUS_1_TAGE"] * egpt_daily
-                episode_df["ZREG_tag"] = zreg_daily
-
-                # save in list
-                episode_df_list.append(episode_df)
-
-            # concat all results
-            output_df = pd.concat(episode_df_list, ignore_index=True)
-
-            # adjust ZREG values by anlage10_df
-            if zustand in {"OSB", "OKN", "OSS", "ATZ_OSB", "ATZ_OKN"}:
-                output_df = pd.merge(output_df, anlage10_df, on=["JAHR", "MONAT"], how="left")
+            # expand all episodes of the zustand into (JAHR, MONAT) rows at once
+            months_df = expand_episodes(zustand_df)
+            output_df = pd.DataFrame({
+                "JAHR": months_df["JAHR"],
+                "MONAT": months_df["MONAT"],
+                "STATUS_1": zustand,
+                "STATUS_1_TAGE": months_df["TAGE"],
+                "STATUS_1_ZREG": months_df["ZREG"],  # zustände are ordered by ZREG_tag
+                "STATUS_1_EGPT": months_df["EGPT"],
+                "ZREG_tag": months_df["ZREG_tag"]
+            })
+            profile.lap("status_1", len(output_df))
+
+            # adjust ZREG values by ANLAGE_10
+            if zustand in anlage10_zustaende:
+                month = (months_df["JAHR"].values - 1970) * 12 + months_df["MONAT"].values - 1
+                factor = anlage10_factors(anlage10, month)
                 output_df[["STATUS_1_ZREG", "ZREG_tag"]] = output_df[["STATUS_1_ZREG", "ZREG_tag"]].divide(
-                    output_df["ANLAGE_10"], axis=0)
-                output_df = output_df.drop(columns=["ANLAGE_10"])
+                    factor, axis=0)
+                profile.lap("anlage_10", len(output_df))
 
         else:
             output_df = pd.DataFrame(columns=[
@@ -213,8 +1042,11 @@ def pivot_episodes(id, data, berichtsjahr):
     '''
 
     # find duplicates, keep track using "index", take the one with max ZREG_tag, save rest
+    # stable sort: tied maxima keep the order of the rows (by zustand, then by episode), so the same contribution is
+    # kept no matter which other months or episodes are present (incremental update, truncated views). Releases before
+    # used the unstable default sort: tied STATUS_1 values can differ from their results
     alle_zustaende_df = alle_zustaende_df.reset_index(drop=False)
-    max_zustaende_df = alle_zustaende_df.sort_values("ZREG_tag", ascending=False).drop_duplicates(
+    max_zustaende_df = alle_zustaende_df.sort_values("ZREG_tag", ascending=False, kind="stable").drop_duplicates(
         subset=["JAHR", "MONAT"])
     max_ids = set(max_zustaende_df["index"])
     rest_df = alle_zustaende_df[~alle_zustaende_df["index"].isin(max_ids)].drop(columns=["index"])
@@ -224,96 +1056,38 @@ def pivot_episodes(id, data, berichtsjahr):
     nebenjob_df = rest_df.groupby(["JAHR", "MONAT"], as_index=False)[["STATUS_1_TAGE", "STATUS_1_EGPT"]].sum()
     nebenjob_df["STATUS"] = "NJB"
     nebenjob_df = nebenjob_df.rename(columns={"STATUS_1_TAGE": "STATUS_TAGE", "STATUS_1_EGPT": "STATUS_EGPT"})
+    profile.lap("status_1_max", len(max_zustaende_df))
 
     # max_zustaende_df will enter in status 1, hence we merge with data_transformed
     data_transformed = pd.merge(data_transformed, max_zustaende_df, on=["JAHR", "MONAT"], how="left")
+    profile.lap("merge")
 
     ###################################################################################################################
 
     # STATUS 2 UND 3:
 
-    # encode zustände
-    conditions = {"BRF": (data['BYAT'] == 10) & (data['BYATSO'].isin(["1", "2", "6", "7"])),
-                  "BMP": (data['BYAT'] == 90),
-                  "VRS": (data['BYAT'] == 18),
-                  "ALG": (data['BYAT'] == 13),
-                  "AUF": (data['BYAT'] == 12) | ((data['BYAT'].isin([40, 41, 48])) & (data['BYATSO'].isin(["1", 'A']))),
-                  "ARM": (data['BYAT'] == 14),
-                  "PFL": (data['BYAT'] == 7) | ((data['BYAT'] == 60) & (data['BYATSO'] == '2')) |
-                         ((data['BYAT'].isin([20, 21])) & (data['BYATSO'] == '8')),
-                  "FWB": (data['BYAT'].isin([20, 21])) & (data['BYATSO'].isin(["0", "2", "5", "6", "7"])),
-                  "SCH": ((data['BYAT'].isin([20, 21])) & (data['BYATSO'] == '3')) | (
-                          (data['BYAT'].isin([40, 41, 42, 43, 48])) & (data['BYATSO'].isin(["4", "6", "7", "8", 'C']))),
-                  "SON": (data['BYAT'].isin([
-                                             #8,15,16, 30, 31,
-                                              26, 49])) | (
-                          (data['BYAT'].isin([40, 41, 48])) & (data['BYATSO'].isin(["9", "2"]))) | (
-                         #(data['BYAT'] == 60) & (data['BYATSO'].isin(["6", "7"]))) | (
-                                 (data['BYAT'].isin([20, 21])) & (data['BYATSO'] == '1')),
-                  "PMU": (data['BYAT'] == 11),
-                  "USV": (data['BYAT'].isin([2, 3])),
-                  "RTB": (data['BYAT'].isin([70, 71, 72])),
-                  "HRT": (data['BYAT'].isin([20, 21])) & (data['BYATSO'] == '4'),
-                  #"FRG": ((data['KZSO'].notna()) & (data['KZSO'] != 0), # todo: may need some finetuning!
-                  "FZR": (data['BYAT'] == 25),
-                  "AZ0": (data['BYAT'].isin([40, 41, 48])) & (data['BYATSO'] == '5') & (data['RTVS'] == 0),
-                  "AZ1": (data['BYAT'].isin([40, 41, 48])) & (data['BYATSO'] == '5') & (data['RTVS'] == 1),
-                  "ALH": (data['BYAT'] == 4) | (
-                          (data['BYAT'].isin([40, 41, 48])) & (data['BYATSO'].isin(["3", 'B', 'D'])))
-		 }
+    # episodes per zustand
+    zustand_rows = data.groupby("ZUSTAND_23", observed=True).indices
 
     # list to save the df's generated from each zustand
     zustand_df_liste = []
 
-    for zustand, bedingung in conditions.items():
+    for zustand in zustaende["STATUS_23"]:
 
         # isolate zustand
-        zustand_df = data[bedingung]
+        zustand_df = data.iloc[zustand_rows.get(zustand, [])]
 
         if len(zustand_df) != 0:
 
-            # list to save the result for each zustand
-            episode_df_list = []
-
-            # loop over episodes, calculate JAHR,MONAT,STATUS_x_TAGE etc...:
-
-            for i in range(len(zustand_df)):
-                row = zustand_df.iloc[i]
-                start_date = row.VNZR
-                end_date = row.BSZR
-                nr_of_days = len(pd.date_range(start_date, end_date, freq="D"))
-
-                # 3 lists: 1 and 2 for JAHR, MONAT, 3 for STATUS_x_TAGE
-                month_list = pd.date_range(start_date.replace(day=1), end_date, freq="MS").month.tolist()
-                year_list = pd.date_range(start_date.replace(day=1), end_date, freq="MS").year.tolist()
-
-                if len(month_list) == 1:
-                    status_tage = [(end_date.date() - start_date.date()).days + 1]
-                else:
-                    next_month = (start_date + pd.offsets.MonthEnd(0)).date()
-                    status_tage = [(next_month - start_date.date()).days + 1]  # first entry = days in first month
-                    if len(month_list) > 2:  # days in the intermediate months
-                        for j in range(1, len(month_list) - 1):
-                            status_tage.append(day_nr(year_list[j], month_list[j]))
-                    status_tage.append(end_date.day)  # days in last month
-
-                # save as new df
-                episode_df = pd.DataFrame({
-                    "JAHR": year_list,
-                    "MONAT": month_list,
-                    "STATUS": zustand,
-                    "STATUS_TAGE": status_tage
-                })
-
-                # calculate EGPT per day
-                egpt_daily = row.EGPT / nr_of_days
-                episode_df["STATUS_EGPT"] = episode_df["STATUS_TAGE"] * egpt_daily
-
-                # save in list
-                episode_df_list.append(episode_df)
-
-            # concat all episode_df's
-            output_df = pd.concat(episode_df_list, ignore_index=True)
+            # expand all episodes of the zustand into (JAHR, MONAT) rows at once
+            months_df = expand_episodes(zustand_df)
+            output_df = pd.DataFrame({
+                "JAHR": months_df["JAHR"],
+                "MONAT": months_df["MONAT"],
+                "STATUS": zustand,
+                "STATUS_TAGE": months_df["TAGE"],
+                "STATUS_EGPT": months_df["EGPT"]
+            })
 
         else:
             output_df = pd.DataFrame(columns=["JAHR", "MONAT", "STATUS", "STATUS_TAGE", "STATUS_EGPT"])
@@ -377,8 +1151,11 @@ def pivot_episodes(id, data, berichtsjahr):
             "STATUS_EGPT_3": "STATUS_3_EGPT"
         })
 
+    profile.lap("status_23", len(zustaende_pivot_df))
+
     # merge with data_transformed
     data_transformed = pd.merge(data_transformed, zustaende_pivot_df, on=["JAHR", "MONAT"], how="left")
+    profile.lap("merge")
 
     ###################################################################################################################
 
@@ -390,78 +1167,10 @@ def pivot_episodes(id, data, berichtsjahr):
     status_data = data[data["BYAT"] == 5]
 
     if len(status_data) != 0:
-        # sort by VNZR
-        episodes_df = status_data.sort_values(by="VNZR", ignore_index=True)
-
-        # untangle overlapping episodes:
-
-        # loop over rows in status_data, update row nr i and length of loop N dynamically
-        i = 1
-        N = len(episodes_df)
-        while i < N:
-
-            # get rid of overlaps:
-
-            if episodes_df.loc[i, 'VNZR'] <= episodes_df.loc[i - 1, 'BSZR']:
-                # split, update df, start over
-                if episodes_df.loc[i - 1, 'BSZR'] <= episodes_df.loc[i, 'BSZR']:
-                    new_df = pd.DataFrame(
-                        {"VNZR": [episodes_df.loc[i, 'VNZR']],
-                         "BSZR": [episodes_df.loc[i - 1, 'BSZR']]
-                         })
-                    if episodes_df.loc[i - 1, 'VNZR'] < episodes_df.loc[i, 'VNZR']:
-                        new_df.loc[len(new_df)] = [episodes_df.loc[i - 1, 'VNZR'],
-                                                   episodes_df.loc[i, 'VNZR'] - pd.Timedelta("1 day")]
-                    if episodes_df.loc[i, 'BSZR'] > episodes_df.loc[i - 1, 'BSZR']:
-                        new_df.loc[len(new_df)] = [episodes_df.loc[i - 1, 'BSZR'] + pd.Timedelta("1 day"),
-                                                   episodes_df.loc[i, 'BSZR']]
-                    unaltered_rows_df = episodes_df[~episodes_df.index.isin([i - 1, i])]
-                # don't raise i to scan same row again
-                elif episodes_df.loc[i - 1, 'BSZR'] > episodes_df.loc[i, 'BSZR']:
-                    new_df = pd.DataFrame(
-                        {"VNZR": [episodes_df.loc[i, 'VNZR'], episodes_df.loc[i, 'BSZR'] + pd.Timedelta("1 day")],
-                         "BSZR": [episodes_df.loc[i, 'BSZR'], episodes_df.loc[i - 1, 'BSZR']]
-                         })
-                    if episodes_df.loc[i - 1, 'VNZR'] < episodes_df.loc[i, 'VNZR']:
-                        new_df.loc[len(new_df)] = [episodes_df.loc[i - 1, 'VNZR'],
-                                                   episodes_df.loc[i, 'VNZR'] - pd.Timedelta("1 day")]
-                    unaltered_rows_df = episodes_df[~episodes_df.index.isin([i - 1, i])]
-                    # raise i to scan next row
-                    i = i + 1
-
-                # update episodes_df
-                episodes_df = pd.concat([new_df, unaltered_rows_df], ignore_index=True).sort_values(
-                    by="VNZR").reset_index(drop=True)
-
-                # update N
-                N = len(episodes_df)
-            else:
-                i = i + 1
-
-        # create new df with JAHR,MONAT and count nr of days in each pair:
-
-        intermediate_results = []
-
-        for _, row in episodes_df.iterrows():
-            # create date range
-            dates = pd.date_range(start=row["VNZR"], end=row["BSZR"], freq="D")
-
-            # build df
-            temp_df = pd.DataFrame({
-                "JAHR": dates.year,
-                "MONAT": dates.month
-            })
-
-            # count days
-            day_count = temp_df.groupby(["JAHR", "MONAT"]).size().reset_index(name="STATUS_4_TAGE")
-
-            # save in list
-            intermediate_results.append(day_count)
-
-        # put all results together
-        output_df = pd.concat(intermediate_results, ignore_index=True)
-        output_df = output_df.groupby(["JAHR", "MONAT"], as_index=False)["STATUS_4_TAGE"].sum()
-
+        # untangle overlapping episodes (sweep-line), then count nr of covered days in each pair JAHR,MONAT
+        segments_df = resolve_overlaps(status_data["VNZR"].values, status_data["BSZR"].values)
+        output_df = segments_to_months(segments_df).rename(columns={"TAGE": "STATUS_4_TAGE"})[
+            ["JAHR", "MONAT", "STATUS_4_TAGE"]]
 
     else:
         output_df = pd.DataFrame(columns=["JAHR", "MONAT", "STATUS_4_TAGE"])
@@ -479,83 +1188,14 @@ def pivot_episodes(id, data, berichtsjahr):
     status_data = data[data["BYAT"] == 6]
 
     if len(status_data) != 0:
-        # sort by VNZR
-        episodes_df = status_data.sort_values(by="VNZR", ignore_index=True)
-
         # calculate daily EGPT's per episode
-        episodes_df["days"] = (episodes_df["BSZR"] - episodes_df["VNZR"]).dt.days + 1
-        episodes_df["EGPT_daily"] = episodes_df["EGPT"] / episodes_df["days"]
-
-        # untangle episodes: loop over rows in status_data, update row nr i and length of loop N dynamically
-        i = 1
-        N = len(episodes_df)
-        while i < N:
-
-            # get rid of overlaps:
-
-            if episodes_df.loc[i, 'VNZR'] <= episodes_df.loc[i - 1, 'BSZR']:
-                # split, sum daily EGPT's, update, start over
-                if episodes_df.loc[i - 1, 'BSZR'] <= episodes_df.loc[i, 'BSZR']:
-                    new_df = pd.DataFrame(
-                        {"VNZR": [episodes_df.loc[i, 'VNZR']],
-                         "BSZR": [episodes_df.loc[i - 1, 'BSZR']],
-                         "EGPT_daily": [episodes_df.loc[i - 1, 'EGPT_daily'] + episodes_df.loc[i, 'EGPT_daily']]
-                         })
-                    if episodes_df.loc[i - 1, 'VNZR'] < episodes_df.loc[i, 'VNZR']:
-                        new_df.loc[len(new_df)] = [episodes_df.loc[i - 1, 'VNZR'],
-                                                   episodes_df.loc[i, 'VNZR'] - pd.Timedelta("1 day"),
-                                                   episodes_df.loc[i - 1, 'EGPT_daily']]
-
-                    if episodes_df.loc[i, 'BSZR'] > episodes_df.loc[i - 1, 'BSZR']:
-                        new_df.loc[len(new_df)] = [episodes_df.loc[i - 1, 'BSZR'] + pd.Timedelta("1 day"),
-                                                   episodes_df.loc[i, 'BSZR'],
-                                                   episodes_df.loc[i, 'EGPT_daily']]
-                    unaltered_rows_df = episodes_df[~episodes_df.index.isin([i - 1, i])]
-                # do not raise i
-                elif episodes_df.loc[i - 1, 'BSZR'] > episodes_df.loc[i, 'BSZR']:
-                    new_df = pd.DataFrame(
-                        {"VNZR": [episodes_df.loc[i, 'VNZR'], episodes_df.loc[i, 'BSZR'] + pd.Timedelta("1 day")],
-                         "BSZR": [episodes_df.loc[i, 'BSZR'], episodes_df.loc[i - 1, 'BSZR']],
-                         "EGPT_daily": [episodes_df.loc[i - 1, 'EGPT_daily'] + episodes_df.loc[i, 'EGPT_daily'],
-                                        episodes_df.loc[i - 1, "EGPT_daily"]]
-                         })
-                    if episodes_df.loc[i - 1, 'VNZR'] < episodes_df.loc[i, 'VNZR']:
-                        new_df.loc[len(new_df)] = [episodes_df.loc[i - 1, 'VNZR'],
-                                                   episodes_df.loc[i, 'VNZR'] - pd.Timedelta("1 day"),
-                                                   episodes_df.loc[i - 1, 'EGPT_daily']]
-                    unaltered_rows_df = episodes_df[~episodes_df.index.isin([i - 1, i])]
-                    i = i + 1  # raise i
-                episodes_df = pd.concat([new_df, unaltered_rows_df], ignore_index=True).sort_values(
-                    by="VNZR").reset_index(drop=True)
-                # update N
-                N = len(episodes_df)
-            else:
-                i = i + 1
-
-        # create new df with JAHR,MONAT and count nr of days and EGPT's in each pair:
-
-        intermediate_results = []
-
-        for _, row in episodes_df.iterrows():
-            # create date range
-            dates = pd.date_range(start=row["VNZR"], end=row["BSZR"], freq="D")
-
-            # fill a df with all days
-            temp_df = pd.DataFrame({
-                "JAHR": dates.year,
-                "MONAT": dates.month
-            })
-
-            # count days, calculate EGPT per month
-            day_count = temp_df.groupby(["JAHR", "MONAT"]).size().reset_index(name="STATUS_5_TAGE")
-            day_count["STATUS_5_EGPT"] = day_count["STATUS_5_TAGE"] * row["EGPT_daily"]
-
-            # save in list
-            intermediate_results.append(day_count)
+        days = (status_data["BSZR"] - status_data["VNZR"]).dt.days + 1
+        egpt_daily = status_data["EGPT"] / days
 
-        # put all results together
-        output_df = pd.concat(intermediate_results, ignore_index=True)
-        output_df = output_df.groupby(["JAHR", "MONAT"], as_index=False)[["STATUS_5_TAGE", "STATUS_5_EGPT"]].sum()
+        # untangle episodes (sweep-line, daily EGPT's are summed where episodes overlap), then count nr of days and
+        # EGPT's in each pair JAHR,MONAT
+        segments_df = resolve_overlaps(status_data["VNZR"].values, status_data["BSZR"].values, egpt_daily.values)
+        output_df = segments_to_months(segments_df).rename(columns={"TAGE": "STATUS_5_TAGE", "EGPT": "STATUS_5_EGPT"})
 
     else:
         output_df = pd.DataFrame(columns=["JAHR", "MONAT", "STATUS_5_TAGE"])
@@ -567,12 +1207,12 @@ def pivot_episodes(id, data, berichtsjahr):
     # save in status_df_list
     status_df_list.append(output_df)
 
+    profile.lap("status_45", sum(len(element) for element in status_df_list))
+
     # merge all elements of status_df_list with data_transformed
     for element in status_df_list:
         data_transformed = data_transformed.merge(element, on=["JAHR", "MONAT"], how="left")
-
-    process_end = time.time()
-    #print(f" Runtime: {round(process_end - process_start, 3)} seconds.")
+    profile.lap("merge", len(data_transformed))
 
     return data_transformed
 
@@ -580,75 +1220,1683 @@ def pivot_episodes(id, data, berichtsjahr):
 #######################################################################################################################
 
 
-# run the function for each ID in parallel:
+# Group-free processing:
+
+'''
+Same rules as pivot_episodes, but each step runs once over the column arrays of a whole block of IDs (EpisodeArrays).
+Instead of (JAHR, MONAT) per ID, rows are keyed by (ID_POS, MONTH): position of the ID in the block and months
+since 1970-01. The order of the episodes is the same as in pivot_episodes (by zustand, then by episode), so ties are
+resolved the same way. The months of each ID are contiguous, so the output columns are preallocated for the whole
+block and every status result is written to its row by position (see grid_rows) - no merges.
+'''
+
+# columns of the result of pivot_block
+output_columns = ["ID", "JAHR", "MONAT", "TAGE",
+                  "STATUS_1", "STATUS_1_TAGE", "STATUS_1_ZREG", "STATUS_1_EGPT",
+                  "STATUS_2", "STATUS_2_TAGE", "STATUS_2_EGPT",
+                  "STATUS_3", "STATUS_3_TAGE", "STATUS_3_EGPT",
+                  "STATUS_4_TAGE", "STATUS_5_TAGE", "STATUS_5_EGPT"]
+
 
-def run_in_batches_and_save_result(id_groups, batch_size, destination_folder, berichtsjahr):
+def first_of_group(*keys):
     '''
-    :param id_groups: output of load_and_preprocess(berichtsjahr)
-    :param batch_size: int (should be less than 100000)
-    :param destination_folder: str
+    :param keys: arrays, sorted by (keys[0], keys[1], ...)
+    :return: bool array, True for the first row of each group of equal keys
+    '''
+
+    first = np.ones(len(keys[0]), dtype=bool)
+    if len(first) > 1:
+        first[1:] = np.logical_or.reduce([key[1:] != key[:-1] for key in keys])
+    return first
+
+
+def segmented_top_k(group_keys, sort_keys, k):
+    '''
+    ranks the rows within each group of equal group keys by the sort keys, one lexsort over all groups
+    :param group_keys: list of arrays, e.g. [ID_POS, MONTH]
+    :param sort_keys: list of arrays, first key sorts first, ascending - ties keep the order of the rows (stable)
+    :param k: int, nr of rows kept per group
+    :return: rows, group, place, n_groups: positions of the kept rows (sorted by group and place), nr of the group
+             of each kept row (groups numbered in order of the group keys) and place in its group (0, ..., k - 1)
+    '''
+
+    order = np.lexsort(tuple(reversed(list(group_keys) + list(sort_keys))))
+    first = first_of_group(*[key[order] for key in group_keys])
+    group = np.cumsum(first) - 1
+    place = np.arange(len(order)) - np.flatnonzero(first)[group]
+    kept = place < k
+    return order[kept], group[kept], place[kept], int(first.sum())
+
+
+def grid_rows(grid_offsets, grid_first_month, id_pos, month):
+    '''
+    dense (ID, month) grid of a block: the months of the k-th ID are the rows grid_offsets[k]:grid_offsets[k+1],
+    starting with grid_first_month[k]
+    :return: row of each (id_pos, month) in the grid, -1 for months outside of the timerange of the ID
+    '''
+
+    offset = month - grid_first_month[id_pos]
+    inside = (offset >= 0) & (offset < grid_offsets[id_pos + 1] - grid_offsets[id_pos])
+    return np.where(inside, grid_offsets[id_pos] + offset, -1)
+
+
+def scatter(n_rows, rows, values, missing=np.nan, dtype=np.float64):
+    '''
+    :return: column of n_rows entries (missing by default), values written to rows (rows -1 are skipped)
+    '''
+
+    column = np.full(n_rows, missing, dtype=dtype)
+    inside = rows >= 0
+    column[rows[inside]] = values[inside]
+    return column
+
+
+def expand_block_zustaende(block, zustand, id_pos):
+    '''
+    expands all episodes of the block with a zustand (code >= 0) into (ID_POS, MONTH) rows,
+    ordered per ID as in pivot_episodes: by zustand, then by episode
+    :return: rows (episode of each row), month, tage
+    '''
+
+    rows = np.flatnonzero(zustand >= 0)
+    rows = rows[np.lexsort((zustand[rows], id_pos[rows]))]
+    episode, month, tage = expand_to_months(block.columns["VNZR"][rows].astype("datetime64[D]"),
+                                            block.columns["BSZR"][rows].astype("datetime64[D]"))
+    return rows[episode], month, tage
+
+
+def block_status_45(block, id_pos, byat, active):
+    '''
+    untangles the episodes with BYAT == byat of all IDs of the block at once (sweep-line)
+    :param active: bool array, episodes taken into account
+    :return: df with TAGE, EGPT per (ID_POS, MONTH)
+    '''
+
+    rows = np.flatnonzero((block.columns["BYAT"] == byat) & active)
+    nr_of_days = block.columns["BSZR"][rows].astype(np.int64) - block.columns["VNZR"][rows] + 1
+    segments_df = resolve_overlaps(block.columns["VNZR"][rows].astype("datetime64[D]"),
+                                   block.columns["BSZR"][rows].astype("datetime64[D]"),
+                                   block.columns["EGPT"][rows] / nr_of_days, ids=id_pos[rows])
+    months_df = segments_to_months(segments_df)
+    months_df["MONTH"] = (months_df["JAHR"] - 1970) * 12 + months_df["MONAT"] - 1
+    return months_df.rename(columns={"FDZ_ID": "ID_POS"})[["ID_POS", "MONTH", "TAGE", "EGPT"]]
+
+
+def pivot_block(block, berichtsjahr, anlage10, first_month=None, profile=None):
+    '''
+    group-free version of pivot_episodes
+    :param block: EpisodeArrays, any nr of IDs
     :param berichtsjahr: int
-    :return: returns final result and saves it as VVL_{berichtsjahr}_pivot.dta to destination_folder
-    '''
-
-    batches = [id_groups[i:i+batch_size] for i in range(0, len(id_groups), batch_size)]
-    all_files = []
-
-    for i, batch in enumerate(batches):
-        batch_start = time.time()
-        print(f"Processing batch {i+1}/{len(batches)} ...")
-        results = Parallel(n_jobs=8)(
-            delayed(pivot_episodes)(id, group, berichtsjahr) for id, group in batch
-        )
-        result_df = pd.concat(results, ignore_index=True)
-        result_df = result_df.rename(columns={"ID": "FDZ_ID"})
-
-        # save each batch to disk
-        file_path = destination_folder + f"episodes_pivot_part_{i}.parquet"
-        result_df.to_parquet(file_path)
-        all_files.append(file_path)
-        batch_end = time.time()
-        print(f" Done in {round(batch_end - batch_start, 3)} seconds.")
-
-    # recombine from disk
-    final_df = pd.concat([pd.read_parquet(f) for f in all_files], ignore_index=True)
-
-    # final formatting:
-    columns_to_num = ['JAHR', 'MONAT', 'STATUS_1_TAGE',
-                      'STATUS_2_TAGE',
-                      'STATUS_3_TAGE', "STATUS_3_EGPT"]
-    columns_to_str = ["STATUS_1", "STATUS_2", "STATUS_3"]
-
-    for col in columns_to_num:
-        final_df[col] = pd.to_numeric(final_df[col], errors="coerce")
-    for col in columns_to_str:
-        final_df[col] = final_df[col].astype(str)
-
-    # replace "nan" and "None" strings by nan
-    final_df[['STATUS_1', 'STATUS_2', 'STATUS_3']] = final_df[['STATUS_1', 'STATUS_2', 'STATUS_3']].replace(
-        ["nan","None"], "")
-
-    # optional: downcast dtypes to save space
-    final_df["JAHR"] = final_df["JAHR"].astype("int16")
-    final_df["MONAT"] = final_df["MONAT"].astype("int8")
-    final_df["STATUS_4_TAGE"] = final_df["STATUS_4_TAGE"].astype("float32")
-    final_df["STATUS_5_TAGE"] = final_df["STATUS_5_TAGE"].astype("float32")
-    
-    # optional: fill numeric nan's by 0
-    # final_df[final_df.select_dtypes(include="number").columns] = final_df.select_dtypes(include="number").fillna(0)
+    :param anlage10: output of load_anlage10
+    :param first_month: int or array with one entry per ID (optional) - months since 1970-01, rows before first_month
+                        are skipped and episodes ending before first_month are not expanded (truncated view, the
+                        rows from first_month on are the same as without first_month)
+    :param profile: Profile (optional) - time and rows per stage are added
+    :return: df in (ID, JAHR, MONAT) format with output_columns, built from all episodes of all IDs of the block
+    '''
+
+    if profile is None:
+        profile = Profile()
+    profile.start()
+    cols = block.columns
+    zustaende = rule_table(berichtsjahr).zustaende
+    n_ids = len(block)
+    id_pos = np.repeat(np.arange(n_ids), np.diff(block.offsets))
+    nr_of_days = cols["BSZR"].astype(np.int64) - cols["VNZR"] + 1
+
+    # timerange per ID: first month with an episode up to December of berichtsjahr
+    first_day = np.minimum.reduceat(cols["VNZR"], block.offsets[:-1]) if n_ids else cols["VNZR"][:0]
+    first_day = first_day.astype("datetime64[D]").astype("datetime64[M]").astype("datetime64[D]")
+    active = np.ones(len(id_pos), dtype=bool)
+    if first_month is not None:
+        first_month = np.broadcast_to(np.asarray(first_month, dtype=np.int64), (n_ids,))
+        first_day = np.maximum(first_day, first_month.astype("datetime64[M]").astype("datetime64[D]"))
+        active = cols["BSZR"].astype("datetime64[D]").astype("datetime64[M]").astype(np.int64) >= first_month[id_pos]
+        # IDs with first_month after berichtsjahr (truncated view, see run_years): nothing to compute
+        active &= first_month[id_pos] <= (berichtsjahr - 1970) * 12 + 11
+    grid_pos, grid_month, grid_tage = expand_to_months(
+        first_day, np.full(n_ids, np.datetime64(f"{berichtsjahr}-12-31")))
+    grid_offsets = np.r_[0, np.cumsum(np.bincount(grid_pos, minlength=n_ids))].astype(np.int64)
+    grid_first_month = first_day.astype("datetime64[M]").astype(np.int64)
+    n_rows = len(grid_pos)
+    output = {"ID": block.ids()[grid_pos], "JAHR": grid_month // 12 + 1970, "MONAT": grid_month % 12 + 1,
+              "TAGE": grid_tage}
+    profile.lap("grid", n_rows)
+
+    ###################################################################################################################
+
+    # STATUS 1:
+
+    rows, month, tage = expand_block_zustaende(block, np.where(active, cols["ZUSTAND_1"], -1), id_pos)
+    zreg_tag = cols["ZREG"][rows] / nr_of_days[rows]
+    egpt_daily = cols["EGPT"][rows] / nr_of_days[rows]
+    status_1_df = pd.DataFrame({
+        "ID_POS": id_pos[rows],
+        "MONTH": month,
+        "STATUS_1": cols["ZUSTAND_1"][rows],
+        "STATUS_1_TAGE": tage,
+        "STATUS_1_ZREG": tage * zreg_tag,
+        "STATUS_1_EGPT": tage * egpt_daily,
+        "ZREG_tag": zreg_tag})
+    profile.lap("status_1", len(status_1_df))
+
+    # adjust ZREG values by ANLAGE_10 - one gather over all expanded rows of the adjusted zustände
+    adjusted = np.isin(status_1_df["STATUS_1"].values, [code for code, zustand in enumerate(zustaende["STATUS_1"])
+                                                        if zustand in anlage10_zustaende])
+    factor = anlage10_factors(anlage10, month[adjusted])
+    status_1_df.loc[adjusted, "STATUS_1_ZREG"] = status_1_df["STATUS_1_ZREG"].values[adjusted] / factor
+    status_1_df.loc[adjusted, "ZREG_tag"] = status_1_df["ZREG_tag"].values[adjusted] / factor
+    profile.lap("anlage_10", adjusted.sum())
+
+    # per (ID, month) keep the contribution with max ZREG_tag, rest enters NJB - tied maxima: the first row by
+    # zustand, then by episode (stable, as pivot_episodes). Earlier releases kept any of the tied rows (unstable sort),
+    # so tied STATUS_1 values can differ from them
+    id_values = status_1_df["ID_POS"].values
+    rows, _, _, _ = segmented_top_k([id_values, month], [-status_1_df["ZREG_tag"].values], 1)
+    is_winner = np.zeros(len(status_1_df), dtype=bool)
+    is_winner[rows] = True
+
+    nebenjob_df = status_1_df[~is_winner].groupby(["ID_POS", "MONTH"], as_index=False)[
+        ["STATUS_1_TAGE", "STATUS_1_EGPT"]].sum()
+    winners = np.flatnonzero(is_winner)
+    winner_rows = grid_rows(grid_offsets, grid_first_month, id_values[winners], month[winners])
+    output["STATUS_1"] = scatter(n_rows, winner_rows, status_1_df["STATUS_1"].values[winners], -1, np.int8)
+    for col in ["STATUS_1_TAGE", "STATUS_1_ZREG", "STATUS_1_EGPT"]:
+        output[col] = scatter(n_rows, winner_rows, status_1_df[col].values[winners])
+    profile.lap("status_1_max", len(winners))
+
+    ###################################################################################################################
+
+    # STATUS 2 UND 3:
+
+    rows, month, tage = expand_block_zustaende(block, np.where(active, cols["ZUSTAND_23"], -1), id_pos)
+    rank = np.array([zustand_order.index(zustand) for zustand in zustaende["STATUS_23"]], dtype=np.int8)
+    alle_zustaende_df = pd.concat([
+        pd.DataFrame({
+            "ID_POS": id_pos[rows],
+            "MONTH": month,
+            "RANK": rank[cols["ZUSTAND_23"][rows]],
+            "STATUS_TAGE": tage,
+            "STATUS_EGPT": tage * (cols["EGPT"][rows] / nr_of_days[rows])}),
+        pd.DataFrame({
+            "ID_POS": nebenjob_df["ID_POS"],
+            "MONTH": nebenjob_df["MONTH"],
+            "RANK": zustand_order.index("NJB"),
+            "STATUS_TAGE": nebenjob_df["STATUS_1_TAGE"],
+            "STATUS_EGPT": nebenjob_df["STATUS_1_EGPT"]})], ignore_index=True)
+
+    # sort according to zustand_order (stable: ties keep the order of the episodes), keep top 2 entries and write
+    # them into the row of their (ID, month): place 0 -> status 2, place 1 -> status 3
+    rows, _, place, _ = segmented_top_k(
+        [alle_zustaende_df["ID_POS"].values, alle_zustaende_df["MONTH"].values], [alle_zustaende_df["RANK"].values], 2)
+    for status, rang in [("STATUS_2", 0), ("STATUS_3", 1)]:
+        selected = rows[place == rang]
+        status_rows = grid_rows(grid_offsets, grid_first_month, alle_zustaende_df["ID_POS"].values[selected],
+                                alle_zustaende_df["MONTH"].values[selected])
+        for col, values, missing, dtype in [(status, "RANK", -1, np.int8),
+                                            (f"{status}_TAGE", "STATUS_TAGE", np.nan, np.float64),
+                                            (f"{status}_EGPT", "STATUS_EGPT", np.nan, np.float64)]:
+            output[col] = scatter(n_rows, status_rows, alle_zustaende_df[values].values[selected], missing, dtype)
+    profile.lap("status_23", (place < 2).sum())
 
-    # export result
-    save_as = f"VVL_{berichtsjahr}_pivot.dta"
-    final_df.to_stata(destination_folder + save_as, write_index=False)
+    ###################################################################################################################
+
+    # STATUS 4 and 5:
 
-    print(f"\n Output saved to {destination_folder + save_as}.")
+    n_contributions = 0
+    for byat, status in [(5, "STATUS_4"), (6, "STATUS_5")]:
+        months_df = block_status_45(block, id_pos, byat, active)
+        status_rows = grid_rows(grid_offsets, grid_first_month, months_df["ID_POS"].values, months_df["MONTH"].values)
+        output[f"{status}_TAGE"] = scatter(n_rows, status_rows, months_df["TAGE"].values)
+        if status == "STATUS_5":
+            output["STATUS_5_EGPT"] = scatter(n_rows, status_rows, months_df["EGPT"].values)
+        n_contributions += len(months_df)
+    profile.lap("status_45", n_contributions)
+
+    # codes of the rule table to codes of the shared category table (status 2/3: zustand_order comes first)
+    labels = status_labels(berichtsjahr)
+    status_1_codes = np.array([labels.index(zustand) for zustand in zustaende["STATUS_1"]] + [-1], dtype=np.int8)
+    output["STATUS_1"] = pd.Categorical.from_codes(status_1_codes[output["STATUS_1"]], categories=labels)
+    for status in ["STATUS_2", "STATUS_3"]:
+        output[status] = pd.Categorical.from_codes(output[status], categories=labels)
+    data_transformed = pd.DataFrame({col: output[col] for col in output_columns})
+    profile.lap("labels", n_rows)
 
-    return final_df
+    return data_transformed
 
 
 #######################################################################################################################
 
 
+# Polars engine (optional, needs polars):
+
+'''
+Same rules as pivot_block, expressed as one lazy polars query over all IDs of a chunk (expansion into months,
+ranking, joins on (FDZ_ID, MONTH), sums). Polars runs the query multi-threaded with its streaming engine, so chunks
+are processed one after another in the main process instead of by joblib workers.
+Tied STATUS_1 maxima are resolved by (zustand, episode) as in pivot_episodes. Difference to pivot_block: status 5
+EGPT is summed per episode (not per disjoint segment, equal up to rounding).
+'''
+
+
+class LazyEpisodes:
+    '''
+    episodes for the polars engine: lazy query with the columns of EpisodeArrays and EPISODE (position of the episode
+    in the input), id_stats with FDZ_ID (sorted), N (nr of episodes) and FIRST_DAY (first VNZR) per ID.
+    Blocks are ID ranges of the query (same interface as EpisodeArrays: len, ids, block).
+    '''
+
+    def __init__(self, query, id_stats):
+        self.query = query  # polars LazyFrame
+        self.id_stats = id_stats  # polars DataFrame
+
+    @classmethod
+    def from_parquet(cls, cache_path, berichtsjahr):
+        '''
+        :param cache_path: output of convert_to_parquet
+        :param berichtsjahr: int, selects the rules for the zustände
+        '''
+
+        query = (pl.scan_parquet(os.path.join(cache_path, "*.parquet")).with_row_index("EPISODE")
+                 .with_columns(pl.col("BYATSO").cast(pl.String)))
+
+        # zustände: every code combination is classified once (see RuleTable), episodes get them by a join
+        combos = query.select(RuleTable.keys).unique().collect()
+        zustaende = rule_table(berichtsjahr).classify(combos.to_pandas())
+        combos = combos.with_columns(pl.Series("ZUSTAND_1", zustaende["STATUS_1"].codes, dtype=pl.Int8),
+                                     pl.Series("ZUSTAND_23", zustaende["STATUS_23"].codes, dtype=pl.Int8))
+        query = query.join(combos.lazy(), on=RuleTable.keys, how="left", nulls_equal=True).select(
+            ["EPISODE", "FDZ_ID", "VNZR", "BSZR", "BYAT", "ZUSTAND_1", "ZUSTAND_23", "ZREG", "EGPT"])
+
+        return cls(query, cls.stats(query))
+
+    @classmethod
+    def from_arrays(cls, episodes):
+        '''
+        :param episodes: EpisodeArrays
+        '''
+
+        query = pl.LazyFrame({"EPISODE": np.arange(episodes.offsets[-1]), **episodes.columns})
+        return cls(query, cls.stats(query))
+
+    @staticmethod
+    def stats(query):
+        return (query.group_by("FDZ_ID").agg(pl.len().alias("N"), pl.col("VNZR").min().alias("FIRST_DAY"))
+                .sort("FDZ_ID").collect())
+
+    def __len__(self):
+        # nr of IDs
+        return len(self.id_stats)
 
+    def ids(self):
+        return self.id_stats["FDZ_ID"].to_numpy()
 
+    def block(self, first, last):
+        '''
+        returns IDs first, ..., last - 1 as LazyEpisodes (filter on the same query)
+        '''
 
+        id_stats = self.id_stats[first:last]
+        if len(id_stats) == 0:
+            return LazyEpisodes(self.query.head(0), id_stats)
+        return LazyEpisodes(self.query.filter(pl.col("FDZ_ID").is_between(id_stats["FDZ_ID"][0],
+                                                                           id_stats["FDZ_ID"][-1])), id_stats)
+
+
+def lazy_month(day):
+    '''
+    :param day: polars expression of day numbers (days since 1970-01-01)
+    :return: polars expression of months since 1970-01
+    '''
+
+    date = day.cast(pl.Int32).cast(pl.Date)
+    return (date.dt.year().cast(pl.Int64) - 1970) * 12 + date.dt.month().cast(pl.Int64) - 1
+
+
+def lazy_expand(query, calendar):
+    '''
+    expands the episodes [VNZR, BSZR] of query into one row per (episode, month): MONTH, TAGE (days in month)
+    :param calendar: LazyFrame with MONTH, FIRST_DAY, LENGTH (see month_lengths)
+    '''
+
+    return (query.with_columns(pl.int_ranges(lazy_month(pl.col("VNZR")), lazy_month(pl.col("BSZR")) + 1)
+                               .alias("MONTH"))
+            .explode("MONTH").filter(pl.col("MONTH").is_not_null())
+            .join(calendar, on="MONTH", how="left")
+            .with_columns((pl.min_horizontal(pl.col("BSZR"), pl.col("FIRST_DAY") + pl.col("LENGTH") - 1)
+                           - pl.max_horizontal(pl.col("VNZR"), pl.col("FIRST_DAY")) + 1).cast(pl.Int64).alias("TAGE"))
+            .drop(["FIRST_DAY", "LENGTH"]))
+
+
+def lazy_first_per_group(query, keys, sort_keys):
+    '''
+    adds PLACE: position of each row within its group of keys after sorting by sort_keys (0 = first)
+    '''
+
+    # groups start where a key changes (cheaper than a window over the groups)
+    new_group = pl.any_horizontal([pl.col(key) != pl.col(key).shift(1) for key in keys]).fill_null(True)
+    row = pl.int_range(pl.len())
+    return (query.sort(keys + sort_keys, nulls_last=True)
+            .with_columns((row - pl.when(new_group).then(row).forward_fill()).alias("PLACE")))
+
+
+def pivot_lazy(episodes, berichtsjahr, anlage10):
+    '''
+    polars version of pivot_block
+    :param episodes: LazyEpisodes, any nr of IDs
+    :param berichtsjahr: int
+    :param anlage10: output of load_anlage10
+    :return: LazyFrame in (ID, JAHR, MONAT) format with output_columns
+    '''
+
+    query = episodes.query.with_columns((pl.col("BSZR").cast(pl.Int64) - pl.col("VNZR") + 1).alias("NR_OF_DAYS"))
+    zustaende = rule_table(berichtsjahr).zustaende
+    calendar = pl.LazyFrame({"MONTH": np.arange(len(month_lengths)) + calendar_offset,
+                             "FIRST_DAY": month_first_days, "LENGTH": month_lengths})
+    keys = ["FDZ_ID", "MONTH"]
+
+    # timerange per ID: first month with an episode up to December of berichtsjahr
+    grid = (query.group_by("FDZ_ID").agg(lazy_month(pl.col("VNZR").min()).alias("FIRST_MONTH"))
+            .with_columns(pl.int_ranges(pl.col("FIRST_MONTH"), (berichtsjahr - 1970) * 12 + 12).alias("MONTH"))
+            .explode("MONTH").filter(pl.col("MONTH").is_not_null())
+            .join(calendar, on="MONTH", how="left").select(keys + [pl.col("LENGTH").cast(pl.Int64).alias("TAGE")]))
+
+    ###################################################################################################################
+
+    # STATUS 1: ZREG per day adjusted by ANLAGE_10, max ZREG_tag per (ID, month), rest enters NJB
+
+    factors, first_month = anlage10
+    adjusted = [code for code, zustand in enumerate(zustaende["STATUS_1"]) if zustand in anlage10_zustaende]
+    status_1 = (lazy_expand(query.filter(pl.col("ZUSTAND_1") >= 0), calendar)
+                .join(pl.LazyFrame({"MONTH": np.arange(len(factors)) + first_month, "FACTOR": factors}),
+                      on="MONTH", how="left")
+                .with_columns(pl.when(pl.col("ZUSTAND_1").is_in(adjusted))
+                              .then(pl.col("FACTOR").fill_null(np.nan)).otherwise(1.0).alias("FACTOR"),
+                              (pl.col("ZREG") / pl.col("NR_OF_DAYS")).alias("ZREG_tag"))
+                .select(keys + ["EPISODE",
+                                pl.col("ZUSTAND_1").alias("STATUS_1"),
+                                pl.col("TAGE").cast(pl.Float64).alias("STATUS_1_TAGE"),
+                                (pl.col("TAGE") * pl.col("ZREG_tag") / pl.col("FACTOR")).alias("STATUS_1_ZREG"),
+                                (pl.col("TAGE") * (pl.col("EGPT") / pl.col("NR_OF_DAYS"))).alias("STATUS_1_EGPT"),
+                                (pl.col("ZREG_tag") / pl.col("FACTOR")).fill_nan(None).alias("ZREG_tag")]))
+    status_1 = lazy_first_per_group(status_1.with_columns(pl.col("ZREG_tag").neg().alias("ORDER")), keys,
+                                    ["ORDER", "STATUS_1", "EPISODE"])
+    max_zustaende = status_1.filter(pl.col("PLACE") == 0).select(
+        keys + ["STATUS_1", "STATUS_1_TAGE", "STATUS_1_ZREG", "STATUS_1_EGPT"])
+    nebenjob = status_1.filter(pl.col("PLACE") > 0).group_by(keys).agg(
+        pl.col("STATUS_1_TAGE").sum().alias("STATUS_TAGE"), pl.col("STATUS_1_EGPT").sum().alias("STATUS_EGPT"))
+
+    ###################################################################################################################
+
+    # STATUS 2 UND 3: top 2 per (ID, month) according to zustand_order (ties: order of the episodes)
+
+    rank = pl.LazyFrame({"ZUSTAND_23": np.arange(len(zustaende["STATUS_23"]), dtype=np.int8),
+                         "RANK": np.array([zustand_order.index(zustand) for zustand in zustaende["STATUS_23"]],
+                                          dtype=np.int8)})
+    alle_zustaende = pl.concat([
+        lazy_expand(query.filter(pl.col("ZUSTAND_23") >= 0), calendar).join(rank, on="ZUSTAND_23", how="left")
+        .select(keys + ["RANK", "EPISODE", pl.col("TAGE").cast(pl.Float64).alias("STATUS_TAGE"),
+                        (pl.col("TAGE") * (pl.col("EGPT") / pl.col("NR_OF_DAYS"))).alias("STATUS_EGPT")]),
+        nebenjob.select(keys + [pl.lit(zustand_order.index("NJB"), dtype=pl.Int8).alias("RANK"),
+                                pl.lit(0, dtype=pl.UInt32).alias("EPISODE"), "STATUS_TAGE", "STATUS_EGPT"])],
+        how="vertical_relaxed")
+    alle_zustaende = lazy_first_per_group(alle_zustaende, keys, ["RANK", "EPISODE"])
+    status_23 = [alle_zustaende.filter(pl.col("PLACE") == place).select(
+        keys + [pl.col("RANK").alias(status), pl.col("STATUS_TAGE").alias(f"{status}_TAGE"),
+                pl.col("STATUS_EGPT").alias(f"{status}_EGPT")])
+        for place, status in enumerate(["STATUS_2", "STATUS_3"])]
+
+    ###################################################################################################################
+
+    # STATUS 4 and 5: days covered by at least one episode (overlaps merged), EGPT summed over all episodes
+
+    status_45 = []
+    for byat, status in [(5, "STATUS_4"), (6, "STATUS_5")]:
+        byat_episodes = query.filter(pl.col("BYAT") == byat)
+        segments = (byat_episodes.sort(["FDZ_ID", "VNZR"])
+                    .with_columns(pl.col("BSZR").cum_max().shift(1).over("FDZ_ID").alias("COVERED"))
+                    .with_columns((pl.col("COVERED").is_null() | (pl.col("VNZR") > pl.col("COVERED")))
+                                  .cum_sum().alias("SEGMENT"))
+                    .group_by(["FDZ_ID", "SEGMENT"]).agg(pl.col("VNZR").min(), pl.col("BSZR").max()))
+        months = lazy_expand(segments, calendar).group_by(keys).agg(
+            pl.col("TAGE").sum().cast(pl.Float32).alias(f"{status}_TAGE"))
+        if status == "STATUS_5":
+            months = months.join(lazy_expand(byat_episodes, calendar).group_by(keys).agg(
+                (pl.col("TAGE") * (pl.col("EGPT") / pl.col("NR_OF_DAYS"))).sum().alias("STATUS_5_EGPT")),
+                on=keys, how="left")
+        status_45.append(months)
+
+    ###################################################################################################################
+
+    # merge all status with the grid, codes to the shared category table, (FDZ_ID, MONTH) to (ID, JAHR, MONAT)
+
+    result = grid
+    for element in [max_zustaende] + status_23 + status_45:
+        result = result.join(element, on=keys, how="left")
+
+    labels = status_labels(berichtsjahr)
+    label_type = pl.Enum(labels)
+    return result.sort(keys).select(
+        pl.col("FDZ_ID").alias("ID"),
+        (pl.col("MONTH") // 12 + 1970).cast(pl.Int16).alias("JAHR"),
+        (pl.col("MONTH") % 12 + 1).cast(pl.Int8).alias("MONAT"),
+        "TAGE",
+        pl.col("STATUS_1").replace_strict(list(range(len(zustaende["STATUS_1"]))), zustaende["STATUS_1"],
+                                          return_dtype=label_type),
+        "STATUS_1_TAGE", "STATUS_1_ZREG", "STATUS_1_EGPT",
+        pl.col("STATUS_2").replace_strict(list(range(len(zustand_order))), zustand_order, return_dtype=label_type),
+        "STATUS_2_TAGE", "STATUS_2_EGPT",
+        pl.col("STATUS_3").replace_strict(list(range(len(zustand_order))), zustand_order, return_dtype=label_type),
+        "STATUS_3_TAGE", "STATUS_3_EGPT",
+        "STATUS_4_TAGE", "STATUS_5_TAGE", "STATUS_5_EGPT")
+
+
+#######################################################################################################################
+
+
+# output: every chunk is formatted on its own (same dtypes for all chunks), the final files are written chunk by chunk
+
+# dtypes of the output columns (all other numeric columns: float64)
+output_dtypes = {"JAHR": "int16", "MONAT": "int8", "TAGE": "int64",
+                 "STATUS_4_TAGE": "float32", "STATUS_5_TAGE": "float32"}
+label_columns = ["STATUS_1", "STATUS_2", "STATUS_3"]
+
+
+def format_result(df, berichtsjahr):
+    '''
+    final formatting of the result of a chunk
+    :param df: output of pivot_episodes or pivot_block
+    :param berichtsjahr: int
+    :return: df with FDZ_ID and the output columns, zustände as Categorical with the shared categories of
+             status_labels (int8 codes, missing if empty), numbers as in output_dtypes
+    '''
+
+    df = df.rename(columns={"ID": "FDZ_ID"}).reindex(columns=["FDZ_ID"] + output_columns[1:])
+    labels = status_labels(berichtsjahr)
+    for col in output_columns[1:]:
+        if col in label_columns:
+            if not (isinstance(df[col].dtype, pd.CategoricalDtype) and list(df[col].cat.categories) == labels):
+                df[col] = pd.Categorical(df[col], categories=labels)
+            df[col] = df[col].cat.as_unordered()  # polars Enums arrive as ordered categoricals
+        else:
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype(output_dtypes.get(col, "float64"))
+
+    # optional: fill numeric nan's by 0
+    # df[df.select_dtypes(include="number").columns] = df.select_dtypes(include="number").fillna(0)
+
+    return df.reset_index(drop=True)
+
+
+def concat_results(results):
+    '''
+    concatenates unformatted results (e.g. one per ID): all-NA columns of a df are left out, so that the dtypes come
+    from the other dfs (as before pandas' FutureWarning on all-NA entries), format_result restores the columns
+    :param results: list of outputs of pivot_episodes or pivot_block
+    '''
+
+    return pd.concat([result_df.dropna(axis=1, how="all") for result_df in results], ignore_index=True)
+
+
+class StataStreamWriter(StataWriter):
+    '''
+    writes a .dta file (same format as DataFrame.to_stata) from batches of rows, only one batch is held in memory.
+    Header, variable types and value labels are taken from template, the rows of all batches are converted to the
+    record layout of the template and appended. Categoricals are written as codes with value labels, so all batches
+    need the categories of the template. The variable types must fit the values of all batches (e.g. template with
+    the smallest and largest value of every integer column, see save_result), a batch that doesn't fit raises a
+    ValueError.
+    '''
+
+    def __init__(self, fname, template, batches, nobs, str_widths=None):
+        '''
+        :param fname: str, path of the .dta file
+        :param template: df with the columns and dtypes of the batches, at least one row (rows are not written, but
+                         their values decide the variable types)
+        :param batches: iterable of dfs
+        :param nobs: int, total nr of rows of all batches (written to the header before the rows)
+        :param str_widths: dict column -> max length of the strings in this column over all batches
+        '''
+
+        super().__init__(fname, template, write_index=False)
+        self.nobs = nobs
+        self._batches = batches
+        for col, width in (str_widths or {}).items():
+            k = self.varlist.index(col)
+            self.typlist[k] = max(int(width), 1)
+            self.fmtlist[k] = f"%{self.typlist[k]}s"
+
+        # record layout of the header: types of the template, strings with the widths of all batches
+        template_records = StataWriter(BytesIO(), template, write_index=False)._prepare_data()
+        self._record_dtype = np.dtype([(name, f"S{typ}" if typ <= self._max_string_length else
+                                        template_records.dtype[name])
+                                       for name, typ in zip(template_records.dtype.names, self.typlist)])
+
+    def _prepare_data(self):
+        # rows are prepared batch by batch in _write_data
+        return None
+
+    def _write_data(self, records):
+        written = 0
+        for batch in self._batches:
+            batch_records = StataWriter(BytesIO(), batch, write_index=False)._prepare_data()
+            converted = batch_records.astype(self._record_dtype)
+            for name in batch_records.dtype.names:
+                # numbers must survive the conversion to the type of the header
+                if (converted.dtype[name].kind in "iuf" and not np.array_equal(
+                        converted[name].astype(batch_records.dtype[name]), batch_records[name], equal_nan=True)):
+                    raise ValueError(f"Values of {name} in rows {written} to {written + len(batch_records) - 1} don't "
+                                     f"fit the Stata type {converted.dtype[name]} of the header.")
+            self._write_bytes(converted.tobytes())
+            written += len(batch_records)
+        if written != self.nobs:
+            raise ValueError(f"{written} rows written, but {self.nobs} rows expected.")
+
+
+def save_result(part_files, destination_folder, berichtsjahr, str_widths=None, suffix="", stata=True):
+    '''
+    appends the part files (in the given order) to VVL_{berichtsjahr}_pivot{suffix}.parquet (one row group per
+    part) and exports it to VVL_{berichtsjahr}_pivot{suffix}.dta, row group by row group
+    :param part_files: list of paths of parquet files, output of format_result
+    :param destination_folder: str
+    :param berichtsjahr: int
+    :param str_widths: dict column -> max length of the strings in this column (see StataStreamWriter)
+    :param suffix: str, e.g. "_sparse"
+    :param stata: bool - False: the .dta file is not written
+    :return: path of the parquet file
+    '''
+
+    parquet_path = destination_folder + f"VVL_{berichtsjahr}_pivot{suffix}.parquet"
+    schema = (pq.read_schema(part_files[0]) if part_files else
+              pa.Schema.from_pandas(format_result(pd.DataFrame(columns=output_columns), berichtsjahr),
+                                    preserve_index=False))
+    with pq.ParquetWriter(parquet_path, schema) as writer:
+        for file_path in part_files:
+            writer.write_table(pq.read_table(file_path, schema=schema))
+
+    parquet_file = pq.ParquetFile(parquet_path)
+    row_groups = [k for k in range(parquet_file.num_row_groups) if parquet_file.metadata.row_group(k).num_rows]
+    stata_path = destination_folder + f"VVL_{berichtsjahr}_pivot{suffix}.dta"
+    if not stata:
+        print(f"\n Output saved to {parquet_path}.")
+        return parquet_path
+    if not row_groups:
+        print(f"\n Output saved to {parquet_path}, no rows - {stata_path} not written.")
+        return parquet_path
+
+    # template: first row (not written, the .dta can't be built from an empty df with categoricals), repeated with the
+    # smallest and largest value of every integer column of all parts - the Stata types fit all rows
+    template = parquet_file.read_row_group(row_groups[0]).to_pandas().head(1)
+    int_cols = [col for col in template.columns if pd.api.types.is_integer_dtype(template[col])]
+    extremes = {col: [] for col in int_cols}
+    for k in row_groups:
+        table = parquet_file.read_row_group(k, columns=int_cols)
+        for col in int_cols:
+            min_max = pc.min_max(table.column(col))
+            extremes[col] += [min_max["min"].as_py(), min_max["max"].as_py()]
+    template = pd.concat([template] * 3, ignore_index=True)
+    for col in int_cols:
+        values = [value for value in extremes[col] if value is not None] or [template[col].iloc[0]]
+        template[col] = pd.array([template[col].iloc[0], min(values), max(values)], dtype=template[col].dtype)
+    batches = (parquet_file.read_row_group(k).to_pandas() for k in row_groups)
+    StataStreamWriter(stata_path, template, batches, parquet_file.metadata.num_rows, str_widths).write_file()
+
+    print(f"\n Output saved to {parquet_path} and {stata_path}.")
+
+    return parquet_path
+
+
+#######################################################################################################################
+
+
+# summary: standard tables of the result per JAHR, computed by the workers from their chunks - the summaries of the
+# chunks are sums and counts, merge_summaries adds them up to the summary of the whole result
+
+summary_keys = ["JAHR", "STATUS", "ZUSTAND"]
+summary_values = ["MONTHS", "TAGE", "ZREG", "EGPT"]
+
+
+def summarize_result(result_df):
+    '''
+    :param result_df: output of format_result (a chunk or the whole result, dense or sparse)
+    :return: df with summary_keys and summary_values: per JAHR and zustand of STATUS_1, STATUS_2 and STATUS_3 (e.g.
+             NJB) the nr of person-months and the sums of STATUS_x_TAGE, STATUS_1_ZREG and STATUS_x_EGPT, per JAHR the
+             person-months and day totals of STATUS_4 and STATUS_5 (ZUSTAND "") and the sum of STATUS_5_EGPT.
+             Sums of columns that don't exist for a status are missing.
+    '''
+
+    summaries = []
+    for status in ["STATUS_1", "STATUS_2", "STATUS_3", "STATUS_4", "STATUS_5"]:
+        columns = {value: f"{status}_{value}" for value in summary_values[1:] if f"{status}_{value}" in result_df}
+        if status in label_columns:
+            rows = result_df[result_df[status].notna().values]
+            groups = [rows["JAHR"], rows[status]]
+        else:
+            rows = result_df[result_df[columns["TAGE"]].notna().values]
+            groups = [rows["JAHR"]]
+        summary_df = rows.groupby(groups, observed=True).agg(
+            MONTHS=(columns["TAGE"], "size"), **{value: (col, "sum") for value, col in columns.items()}).reset_index()
+        summary_df["ZUSTAND"] = summary_df[status].astype(str) if status in label_columns else ""
+        summary_df["STATUS"] = status
+        summaries.append(summary_df.reindex(columns=summary_keys + summary_values))
+    return merge_summaries(summaries)
+
+
+def merge_summaries(summaries):
+    '''
+    :param summaries: list of outputs of summarize_result (e.g. of all chunks)
+    :return: summary of all of them, sorted by summary_keys
+    '''
+
+    summaries = [summary_df for summary_df in summaries if len(summary_df)]
+    if not summaries:
+        return pd.DataFrame(columns=summary_keys + summary_values)
+    summary_df = pd.concat(summaries, ignore_index=True)
+    return summary_df.groupby(summary_keys, as_index=False)[summary_values].sum(min_count=1)
+
+
+def summary_path(folder, berichtsjahr):
+    return folder + f"VVL_{berichtsjahr}_pivot_summary.csv"
+
+
+def read_summary(file_path):
+    '''
+    reads a saved summary: ZUSTAND "" (STATUS_4, STATUS_5) stays a string, empty sums are missing
+    '''
+
+    return pd.read_csv(file_path, keep_default_na=False, na_values={"ZREG": [""], "EGPT": [""]},
+                       dtype={"ZUSTAND": str})
+
+
+#######################################################################################################################
+
+
+# sparse output (optional): only months with at least one non-empty status, plus the span (first and last month) of
+# every ID - the dense grid is restored on demand by read_sparse_result
+
+def sparse_rows(result_df):
+    '''
+    :param result_df: output of format_result
+    :return: rows of result_df with at least one non-empty status column
+    '''
+
+    status_columns = [col for col in result_df.columns if col not in ("FDZ_ID", "JAHR", "MONAT", "TAGE")]
+    return result_df[result_df[status_columns].notna().any(axis=1).values].reset_index(drop=True)
+
+
+def chunk_spans(chunk, berichtsjahr):
+    '''
+    :param chunk: EpisodeArrays, LazyEpisodes or list of (FDZ_ID, episodes) pairs
+    :param berichtsjahr: int
+    :return: df with FDZ_ID, FIRST_JAHR, FIRST_MONAT, LAST_JAHR, LAST_MONAT: months of the dense result of each ID
+             (first month with an episode up to December of berichtsjahr), IDs without rows are left out
+    '''
+
+    ids, _, first_days = id_sizes(chunk)
+    first_month = first_days.astype("datetime64[M]").astype(np.int64)
+    last_month = (berichtsjahr - 1970) * 12 + 11
+    keep = first_month <= last_month
+    return pd.DataFrame({"FDZ_ID": ids[keep],
+                         "FIRST_JAHR": (first_month[keep] // 12 + 1970).astype(np.int16),
+                         "FIRST_MONAT": (first_month[keep] % 12 + 1).astype(np.int8),
+                         "LAST_JAHR": np.full(keep.sum(), berichtsjahr, dtype=np.int16),
+                         "LAST_MONAT": np.full(keep.sum(), 12, dtype=np.int8)})
+
+
+def spans_path(folder, berichtsjahr):
+    return folder + f"VVL_{berichtsjahr}_pivot_spans.parquet"
+
+
+def expand_sparse(sparse_df, spans_df):
+    '''
+    re-expands sparse rows to the dense grid (one row per month of the span of every ID)
+    :param sparse_df: rows of the sparse result (sorted by FDZ_ID, JAHR, MONAT)
+    :param spans_df: spans of the IDs of sparse_df (sorted by FDZ_ID), see chunk_spans
+    :return: df with the same columns and dtypes as the dense result
+    '''
+
+    first_month = (spans_df["FIRST_JAHR"].values.astype(np.int64) - 1970) * 12 + spans_df["FIRST_MONAT"].values - 1
+    last_month = (spans_df["LAST_JAHR"].values.astype(np.int64) - 1970) * 12 + spans_df["LAST_MONAT"].values - 1
+    n_months = np.maximum(last_month - first_month + 1, 0)
+    offsets = np.r_[0, np.cumsum(n_months)].astype(np.int64)
+    id_pos = np.repeat(np.arange(len(spans_df)), n_months)
+    month = first_month[id_pos] + np.arange(len(id_pos)) - offsets[id_pos]
+
+    # row of every sparse row in the dense grid
+    ids = spans_df["FDZ_ID"].values
+    sparse_pos = np.searchsorted(ids, sparse_df["FDZ_ID"].values)
+    sparse_month = (sparse_df["JAHR"].values.astype(np.int64) - 1970) * 12 + sparse_df["MONAT"].values - 1
+    rows = grid_rows(offsets, first_month, np.minimum(sparse_pos, max(len(ids) - 1, 0)), sparse_month)
+
+    dense = {"FDZ_ID": ids[id_pos],
+             "JAHR": (month // 12 + 1970).astype(sparse_df["JAHR"].dtype),
+             "MONAT": (month % 12 + 1).astype(sparse_df["MONAT"].dtype),
+             "TAGE": month_length(month).astype(sparse_df["TAGE"].dtype)}
+    for col in sparse_df.columns:
+        if col in dense:
+            continue
+        values = sparse_df[col]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            codes = scatter(len(id_pos), rows, values.cat.codes.values, -1, values.cat.codes.dtype)
+            dense[col] = pd.Categorical.from_codes(codes, categories=values.cat.categories)
+        else:
+            dense[col] = scatter(len(id_pos), rows, values.values, np.nan, values.dtype)
+    return pd.DataFrame(dense)[list(sparse_df.columns)]
+
+
+def read_sparse_result(folder, berichtsjahr, ids=None):
+    '''
+    reads the sparse result of berichtsjahr from folder and restores the dense grid
+    :param folder: str, destination_folder of a run with sparse=True
+    :param berichtsjahr: int
+    :param ids: list of FDZ_IDs (optional) - only these IDs are read
+    :return: df as the dense VVL_{berichtsjahr}_pivot.parquet
+    '''
+
+    filters = None if ids is None else [("FDZ_ID", "in", list(ids))]
+    sparse_df = pq.read_table(folder + f"VVL_{berichtsjahr}_pivot_sparse.parquet", filters=filters).to_pandas()
+    spans_df = pq.read_table(spans_path(folder, berichtsjahr), filters=filters).to_pandas()
+    return expand_sparse(sparse_df, spans_df)
+
+
+#######################################################################################################################
+
+
+# incremental update: IDs with the same episodes as in the run of the previous berichtsjahr keep their rows of the
+# previous result, only the months of the new berichtsjahr are computed for them
+
+# columns of EpisodeArrays that determine the result of an ID
+hash_columns = ["VNZR", "BSZR", "BYAT", "ZUSTAND_1", "ZUSTAND_23", "ZREG", "EGPT"]
+
+
+def episode_hashes(episodes, berichtsjahr, last_day=None):
+    '''
+    :param episodes: EpisodeArrays
+    :param berichtsjahr: int
+    :param last_day: datetime64[D] (optional) - only episodes starting on or before last_day are hashed
+    :return: uint64 hash per ID over its episodes (hash_columns, in the order of the episodes) and the rule set of
+             berichtsjahr - equal hashes: equal result up to December of the earlier berichtsjahr (up to last_day)
+    '''
+
+    cols = episodes.columns
+    row_hash = pd.util.hash_pandas_object(pd.DataFrame({col: cols[col] for col in hash_columns}), index=False).values
+    keep = np.ones(len(row_hash), dtype=bool)
+    if last_day is not None:
+        keep = cols["VNZR"] <= np.datetime64(last_day, "D").astype(np.int64)
+
+    # position of the episode within its ID (order of the episodes matters for ties) and rule set
+    kept_before = np.cumsum(keep) - keep
+    position = kept_before - np.repeat(kept_before[episodes.offsets[:-1]], np.diff(episodes.offsets))
+    rules = pd.util.hash_array(np.array([repr(rule_table(berichtsjahr).rules)], dtype=object))[0]
+    row_hash = np.where(keep, pd.util.hash_array(row_hash ^ position.astype(np.uint64) ^ rules), np.uint64(0))
+
+    if len(episodes) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    return np.add.reduceat(row_hash, episodes.offsets[:-1])
+
+
+def hashes_path(folder, berichtsjahr):
+    return folder + f"VVL_{berichtsjahr}_pivot_hashes.parquet"
+
+
+def unchanged_ids(episodes, hashes, previous_folder, berichtsjahr):
+    '''
+    :param episodes: EpisodeArrays
+    :param hashes: output of episode_hashes(episodes, berichtsjahr)
+    :param previous_folder: str, destination_folder of the run for berichtsjahr - 1
+    :param berichtsjahr: int
+    :return: bool per ID, True if the ID has the same hash as in the previous run
+    '''
+
+    previous = pd.read_parquet(hashes_path(previous_folder, berichtsjahr - 1))
+    return same_hashes(episodes.ids(), hashes, previous["FDZ_ID"].values, previous["HASH"].values)
+
+
+def same_hashes(ids, hashes, other_ids, other_hashes):
+    '''
+    :param ids: sorted array of FDZ_IDs, hashes: hash per ID
+    :param other_ids: sorted array of FDZ_IDs, other_hashes: hash per ID
+    :return: bool per ID of ids, True if the ID is in other_ids with the same hash
+    '''
+
+    if len(other_ids) == 0:
+        return np.zeros(len(ids), dtype=bool)
+    pos = np.minimum(np.searchsorted(other_ids, ids), len(other_ids) - 1)
+    return (other_ids[pos] == ids) & (other_hashes[pos] == hashes)
+
+
+def read_previous_rows(file_path, ids, last_year=None):
+    '''
+    :param file_path: str, previous result (parquet, sorted by FDZ_ID)
+    :param ids: sorted array of FDZ_IDs
+    :param last_year: int (optional) - only rows up to December of last_year
+    :return: df with the rows of ids (formatted, see format_result)
+    '''
+
+    filters = [("FDZ_ID", ">=", ids[0]), ("FDZ_ID", "<=", ids[-1]), ("FDZ_ID", "in", ids.tolist())]
+    if last_year is not None:
+        filters.append(("JAHR", "<=", last_year))
+    return pq.read_table(file_path, filters=filters).to_pandas()
+
+
+#######################################################################################################################
+
+
+# checkpoints: every completed part is recorded in a manifest (ID range, nr of rows, checksum), a restarted run with
+# the same input skips the recorded parts
+
+def manifest_path(folder, berichtsjahr):
+    return folder + f"VVL_{berichtsjahr}_pivot_manifest.json"
+
+
+def write_json(obj, file_path):
+    '''
+    writes obj as json to file_path atomically (temporary file, then renamed): the file is never half-written
+    '''
+
+    with open(file_path + ".tmp", "w") as f:
+        json.dump(obj, f, indent=2)
+    os.replace(file_path + ".tmp", file_path)
+
+
+def write_part(result_df, file_path):
+    '''
+    saves a part atomically (temporary file, then renamed)
+    :return: sha256 hex digest of the file
+    '''
+
+    result_df.to_parquet(file_path + ".tmp")
+    os.replace(file_path + ".tmp", file_path)
+    return file_hash(file_path)
+
+
+def load_manifest(destination_folder, berichtsjahr, run):
+    '''
+    :param destination_folder: str, prefix of the manifest and part files (as in run_in_batches_and_save_result)
+    :param berichtsjahr: int
+    :param run: dict, parameters and input signature of the run
+    :return: manifest of an earlier run with the same run dict (None if there is none), parts with missing or
+             modified files are dropped
+    '''
+
+    file_path = manifest_path(destination_folder, berichtsjahr)
+    if not os.path.isfile(file_path):
+        return None
+    with open(file_path) as f:
+        manifest = json.load(f)
+    if manifest.get("run") != run:
+        return None
+
+    # part files are named destination_folder + file, as they were written
+    manifest["parts"] = {i: part for i, part in manifest["parts"].items()
+                         if os.path.isfile(destination_folder + part["file"])
+                         and file_hash(destination_folder + part["file"]) == part["sha256"]}
+    return manifest
+
+
+def content_signature(id_groups):
+    '''
+    checksum of the input of a run (see load_manifest): IDs and episodes (all columns, in the order of the episodes)
+    :param id_groups: list of (FDZ_ID, episodes) pairs or LazyEpisodes (EpisodeArrays: see episode_hashes)
+    :return: str
+    '''
+
+    if isinstance(id_groups, LazyEpisodes):
+        # polars hash of every episode (fixed seed), high 32 bits summed - the summation can't overflow
+        total = id_groups.query.select((pl.struct(pl.all()).hash(seed=0) // 2 ** 32).sum()).collect().item()
+        return hashlib.sha256(pd.util.hash_array(id_groups.ids()).tobytes() + str(total).encode()).hexdigest()
+
+    checksum = hashlib.sha256()
+    for id, group in id_groups:
+        checksum.update(repr(id).encode())
+        checksum.update(pd.util.hash_pandas_object(group[var_columns[1:]], index=False).values.tobytes())
+    return checksum.hexdigest()
+
+
+def chunk_id_range(chunk):
+    '''
+    :param chunk: EpisodeArrays, LazyEpisodes or list of (FDZ_ID, episodes) pairs
+    :return: [first FDZ_ID, last FDZ_ID] of the chunk (json-compatible)
+    '''
+
+    ids = chunk.ids() if hasattr(chunk, "ids") else [id for id, _ in chunk]
+    if len(ids) == 0:
+        return [None, None]
+    return [ids[k].item() if hasattr(ids[k], "item") else ids[k] for k in (0, -1)]
+
+
+#######################################################################################################################
+
+
+# scheduling: IDs are split into chunks of about equal cost, estimated from nr of episodes and nr of output months
+
+# relative cost of an episode and of an output month (one row per ID and month up to December of berichtsjahr)
+cost_per_episode = 1.0
+cost_per_month = 0.1
+
+# estimated peak memory of a worker per output month of its chunk, in bytes
+memory_per_month = 600
+
+# nr of blocks per chunk whose most expensive IDs are timed one by one with time_ids (see pivot_chunk)
+n_slowest_blocks = 2
+
+
+def id_sizes(id_groups):
+    '''
+    :param id_groups: EpisodeArrays, LazyEpisodes or list of (FDZ_ID, episodes) pairs
+    :return: FDZ_IDs, nr of episodes per ID, first VNZR per ID (datetime64[D])
+    '''
+
+    if isinstance(id_groups, EpisodeArrays):
+        first_days = (np.minimum.reduceat(id_groups.columns["VNZR"], id_groups.offsets[:-1]) if len(id_groups)
+                      else id_groups.columns["VNZR"][:0])
+        return id_groups.ids(), np.diff(id_groups.offsets), first_days.astype("datetime64[D]")
+    if isinstance(id_groups, LazyEpisodes):
+        return (id_groups.ids(), id_groups.id_stats["N"].to_numpy(),
+                id_groups.id_stats["FIRST_DAY"].to_numpy().astype("datetime64[D]"))
+    return (np.array([id for id, _ in id_groups]), np.array([len(group) for _, group in id_groups], dtype=np.int64),
+            np.array([group["VNZR"].min() for _, group in id_groups], dtype="datetime64[D]"))
+
+
+def id_costs(n_episodes, first_days, berichtsjahr):
+    '''
+    :param n_episodes: array, nr of episodes per ID
+    :param first_days: array, first VNZR per ID (datetime)
+    :param berichtsjahr: int
+    :return: estimated cost per ID, nr of output months per ID
+    '''
+
+    first_month = np.asarray(first_days, dtype="datetime64[M]").astype(np.int64)
+    n_months = np.maximum((berichtsjahr - 1970) * 12 + 11 - first_month + 1, 0)
+    return n_episodes * cost_per_episode + n_months * cost_per_month, n_months
+
+
+def plan_chunks(costs, n_chunks):
+    '''
+    splits consecutive IDs into at most n_chunks chunks of about equal total cost
+    :param costs: array, cost per ID
+    :param n_chunks: int
+    :return: array of chunk boundaries: chunk k holds the IDs bounds[k]:bounds[k+1]
+    '''
+
+    cumulated = np.cumsum(costs)
+    targets = cumulated[-1] * np.arange(1, n_chunks) / n_chunks if len(costs) else []
+    inner = np.searchsorted(cumulated, targets, side="right")
+    return np.unique(np.r_[0, inner, len(costs)]).astype(np.int64)
+
+
+def available_memory():
+    '''
+    returns available memory in bytes (None if unknown)
+    '''
+
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def choose_n_jobs(n_jobs=None, memory_per_job=None):
+    '''
+    :param n_jobs: int (optional) - used as is if given
+    :param memory_per_job: int (optional) - estimated peak memory of one worker in bytes
+    :return: nr of workers: available cores, reduced so that all workers fit into the available memory
+    '''
+
+    if n_jobs is not None and n_jobs > 0:
+        return n_jobs
+
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    memory = available_memory()
+    if memory is not None and memory_per_job:
+        cores = min(cores, int(memory // memory_per_job))
+    return max(1, cores)
+
+
+def pivot_chunk(i, chunk, berichtsjahr, block_size, anlage10, first_month=None, previous=None, sparse=False,
+                time_ids=False):
+    '''
+    task of a worker
+    :param i: int, nr of the chunk
+    :param chunk: EpisodeArrays, LazyEpisodes (one polars query for the whole chunk) or list of (FDZ_ID, episodes)
+                  pairs
+    :param berichtsjahr: int
+    :param block_size: int, EpisodeArrays are processed in blocks of block_size IDs
+    :param anlage10: output of load_anlage10
+    :param first_month: array, first month per ID of the chunk (optional, incremental update, see pivot_block)
+    :param previous: tuple (file path, FDZ_IDs, last year) (optional, incremental update or truncated view) - rows of
+                     these IDs before first_month (up to December of last year) are taken from the previous result
+    :param sparse: bool - only rows with at least one non-empty status are returned (see sparse_rows)
+    :param time_ids: bool - EpisodeArrays: the most expensive IDs of the n_slowest_blocks slowest blocks are pivoted
+                     once more one by one and timed (slow, for profiling runs). By default the time of every block is
+                     split among its IDs by estimated cost (see id_costs), marked as estimated in the report.
+    :return: i, df with the pivoted episodes of all IDs of the chunk (formatted, see format_result), Profile,
+             summary of the chunk (see summarize_result)
+    '''
+
+    profile = Profile()
+    results = []
+    if isinstance(chunk, EpisodeArrays):
+        block_seconds = []
+        for first in range(0, len(chunk), block_size):
+            block_start = time.perf_counter()
+            block = chunk.block(first, min(first + block_size, len(chunk)))
+            results.append(pivot_block(block, berichtsjahr, anlage10,
+                                       None if first_month is None else first_month[first:first + block_size],
+                                       profile))
+            seconds = time.perf_counter() - block_start
+            block_seconds.append((seconds, first))
+            if not time_ids:
+                # slowest IDs: a block is timed as a whole, its time is split among the IDs by estimated cost
+                ids, n_episodes, first_days = id_sizes(block)
+                costs = id_costs(n_episodes, first_days, berichtsjahr)[0]
+                for j in np.argsort(-costs, kind="stable")[:profile.n_slowest]:
+                    profile.record(float(seconds * costs[j] / costs.sum()), id=ids[j], episodes=n_episodes[j],
+                                   estimated=True)
+
+        if time_ids:
+            # slowest IDs: the most expensive IDs of the slowest blocks are pivoted once more one by one
+            profile.start()
+            for _, first in sorted(block_seconds)[-n_slowest_blocks:]:
+                ids, n_episodes, first_days = id_sizes(chunk.block(first, min(first + block_size, len(chunk))))
+                costs = id_costs(n_episodes, first_days, berichtsjahr)[0]
+                for j in np.argsort(-costs, kind="stable")[:profile.n_slowest]:
+                    id_start = time.perf_counter()
+                    pivot_block(chunk.block(first + j, first + j + 1), berichtsjahr, anlage10,
+                                None if first_month is None else first_month[first + j:first + j + 1])
+                    profile.record(time.perf_counter() - id_start, id=ids[j], episodes=n_episodes[j])
+            profile.lap("slowest_ids")
+    elif isinstance(chunk, LazyEpisodes):
+        profile.start()
+        if len(chunk):
+            results.append(pivot_lazy(chunk, berichtsjahr, anlage10).collect(engine="streaming").to_pandas())
+        profile.lap("polars", sum(len(result_df) for result_df in results))
+    else:
+        for id, group in chunk:
+            id_start = time.perf_counter()
+            results.append(pivot_episodes(id, group, berichtsjahr, anlage10, profile))
+            profile.record(time.perf_counter() - id_start, id=id, episodes=len(group))
+
+    profile.start()
+    if previous is not None and len(previous[1]):
+        results = [format_result(result_df, berichtsjahr) for result_df in results] + [read_previous_rows(*previous)]
+        result_df = format_result(pd.concat(results, ignore_index=True), berichtsjahr)
+        result_df = result_df.sort_values(["FDZ_ID", "JAHR", "MONAT"], kind="stable", ignore_index=True)
+    elif not results:
+        result_df = format_result(pd.DataFrame(columns=output_columns), berichtsjahr)
+    else:
+        result_df = format_result(concat_results(results), berichtsjahr)
+    if sparse:
+        result_df = sparse_rows(result_df)
+    profile.lap("format", len(result_df))
+    summary_df = summarize_result(result_df)
+    profile.lap("summary", len(summary_df))
+
+    return i, result_df, profile, summary_df
+
+
+def run_tasks(tasks, n_jobs, backend):
+    '''
+    runs delayed tasks, results are yielded as soon as a task is done (in order of completion)
+    :param tasks: iterable of delayed(...) tasks, consumed lazily
+    :param n_jobs: int
+    :param backend: "processes" (loky), "threads" or "serial" (no joblib, for debugging)
+    '''
+
+    if backend == "serial":
+        for function, args, kwargs in tasks:
+            yield function(*args, **kwargs)
+    elif backend in ("processes", "threads"):
+        yield from Parallel(n_jobs=n_jobs, backend="loky" if backend == "processes" else "threading",
+                            return_as="generator_unordered")(tasks)
+    else:
+        raise ValueError(f"Unknown backend {backend}, use 'processes', 'threads' or 'serial'.")
+
+
+# run the function for each ID in parallel:
+
+def run_in_batches_and_save_result(id_groups, batch_size, destination_folder, berichtsjahr, block_size=2000,
+                                   memmap_folder=None, n_jobs=None, backend="processes", anlage10=None,
+                                   previous_folder=None, resume=None, view_of=None, sparse=False, stata=True,
+                                   time_ids=False):
+    '''
+    :param id_groups: output of load_and_preprocess(berichtsjahr), list or generator of (FDZ_ID, episodes) pairs,
+                      EpisodeArrays (group_free) or LazyEpisodes (engine="polars": chunks are run one after another
+                      by polars with all cores, n_jobs and backend are not used)
+    :param batch_size: int, average nr of IDs per chunk (= task of a worker and part file), chunks of lists and
+                       EpisodeArrays are balanced by estimated cost (see id_costs), at least 4 chunks per worker.
+                       A generator (chunksize) is cut into chunks of batch_size IDs.
+    :param destination_folder: str
+    :param berichtsjahr: int
+    :param block_size: int, EpisodeArrays are processed by pivot_block in blocks of block_size IDs
+    :param memmap_folder: str (optional) - EpisodeArrays are written once as memory-mapped files to a temporary
+                          folder in memmap_folder (default: /dev/shm if available), workers read zero-copy views
+    :param n_jobs: int (optional) - nr of workers, by default chosen from available cores and memory
+    :param backend: "processes", "threads" or "serial"
+    :param anlage10: output of load_anlage10 (optional) - loaded from anlage10_path by default
+    :param previous_folder: str (optional) - incremental update from the result of berichtsjahr - 1 in
+                            previous_folder (needs EpisodeArrays): IDs with the same episodes (see episode_hashes) keep
+                            their previous rows, only the months of berichtsjahr are computed for them.
+                            Assumes that ANLAGE_10 of earlier years did not change.
+    :param view_of: tuple (result path, FDZ_IDs, hashes) of the run of a later berichtsjahr (optional, needs
+                    EpisodeArrays), hashes of its episodes up to December of berichtsjahr (see episode_hashes): IDs
+                    with the same hashes take their rows up to December of berichtsjahr from that result (truncated
+                    view), nothing is computed for them. Used by run_years.
+    :param sparse: bool - sparse output: only months with at least one non-empty status are saved, to
+                   VVL_{berichtsjahr}_pivot_sparse.parquet/.dta, with the first and last month of every ID in
+                   VVL_{berichtsjahr}_pivot_spans.parquet/.dta (dense grid: see read_sparse_result). Previous results
+                   (previous_folder, view_of) are read from the sparse files as well.
+    :param stata: bool - False: only the parquet files are written, no .dta (e.g. shards, see run_shard)
+    :param time_ids: bool - slowest IDs of the profiling report timed one by one (slow, see pivot_chunk)
+    :param resume: bool or None - completed parts are recorded in VVL_{berichtsjahr}_pivot_manifest.json, a
+                   restarted run with the same parameters, input, ANLAGE_10 and rules skips them (checked by ID range
+                   and checksum). A list, EpisodeArrays or LazyEpisodes is identified by its IDs and the content of
+                   its episodes (see content_signature, episode_hashes). A generator only by the ID range of each
+                   chunk, so it is resumed only with resume=True. None (default): resume unless id_groups is a
+                   generator. False: all parts are computed again.
+    :return: path of the final result, saved as VVL_{berichtsjahr}_pivot.parquet and VVL_{berichtsjahr}_pivot.dta
+             to destination_folder. The chunks are appended one by one, the whole result is never held in memory.
+             For EpisodeArrays the episode hashes per ID are saved as VVL_{berichtsjahr}_pivot_hashes.parquet.
+             The summary of the result (see summarize_result), merged from the summaries of the chunks, is saved as
+             VVL_{berichtsjahr}_pivot_summary.csv.
+    '''
+
+    temp_folder = None
+    first_month = None
+    suffix = "_sparse" if sparse else ""
+    if anlage10 is None:
+        anlage10 = load_anlage10()
+    if (previous_folder is not None or view_of is not None) and not isinstance(id_groups, EpisodeArrays):
+        raise ValueError("The incremental update (previous_folder) and truncated views (view_of) need EpisodeArrays, "
+                         "use load_and_preprocess(..., group_free=True).")
+    if previous_folder is not None and view_of is not None:
+        raise ValueError("previous_folder and view_of can't be combined.")
+
+    try:
+        if isinstance(id_groups, EpisodeArrays):
+            # group-free: chunks are ranges of IDs (views on the column arrays)
+            episodes = id_groups
+            if episodes.folder is None:
+                if memmap_folder is None:
+                    memmap_folder = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+                temp_folder = tempfile.mkdtemp(prefix="episodes_pivot_", dir=memmap_folder)
+                episodes = episodes.to_memmap(temp_folder)
+            _, n_episodes, first_days = id_sizes(episodes)
+            costs, n_months = id_costs(n_episodes, first_days, berichtsjahr)
+            hashes = episode_hashes(episodes, berichtsjahr)
+
+            if previous_folder is not None:
+                # unchanged IDs: months of berichtsjahr only (cost), memory is still needed for all months
+                unchanged = unchanged_ids(episodes, hashes, previous_folder, berichtsjahr)
+                first_month = first_days.astype("datetime64[M]").astype(np.int64)
+                first_month[unchanged] = np.maximum(first_month[unchanged], (berichtsjahr - 1970) * 12)
+                costs = id_costs(n_episodes, first_month.astype("datetime64[M]"), berichtsjahr)[0]
+                previous_path = previous_folder + f"VVL_{berichtsjahr - 1}_pivot{suffix}.parquet"
+                print(f"Incremental update: {unchanged.sum()} of {len(episodes)} IDs unchanged since "
+                      f"{berichtsjahr - 1}.")
+            elif view_of is not None:
+                # unchanged IDs: first_month after berichtsjahr, all their rows come from the later result
+                previous_path, view_ids, view_hashes = view_of
+                unchanged = same_hashes(episodes.ids(), episode_hashes(episodes, berichtsjahr, f"{berichtsjahr}-12-31"),
+                                        view_ids, view_hashes)
+                first_month = first_days.astype("datetime64[M]").astype(np.int64)
+                first_month[unchanged] = (berichtsjahr - 1970) * 12 + 12
+                costs[unchanged] = n_months[unchanged] * cost_per_month  # rows are copied only
+                print(f"Truncated view: {unchanged.sum()} of {len(episodes)} IDs taken from {previous_path}.")
+            signature = hashlib.sha256(pd.util.hash_array(episodes.ids()).tobytes() + hashes.tobytes()).hexdigest()
+            if view_of is not None:
+                signature = hashlib.sha256((signature + previous_path).encode() + view_hashes.tobytes()).hexdigest()
+        elif isinstance(id_groups, LazyEpisodes):
+            ids, n_episodes, first_days = id_sizes(id_groups)
+            costs, n_months = id_costs(n_episodes, first_days, berichtsjahr)
+            signature = content_signature(id_groups)
+            n_jobs, backend = 1, "serial"
+        elif hasattr(id_groups, "__len__"):
+            ids, n_episodes, first_days = id_sizes(id_groups)
+            costs, n_months = id_costs(n_episodes, first_days, berichtsjahr)
+            signature = content_signature(id_groups)
+        else:
+            signature = None
+
+        # manifest of an earlier run with the same parameters, input, ANLAGE_10 and rules: its chunks and completed
+        # parts are reused. A generator can't be checked up front, it is resumed with resume=True only.
+        run = {"berichtsjahr": berichtsjahr, "batch_size": batch_size, "block_size": block_size, "input": signature,
+               "previous_folder": previous_folder, "sparse": sparse,
+               "anlage10": hashlib.sha256(anlage10[0].tobytes() + str(anlage10[1]).encode()).hexdigest(),
+               "rules": hashlib.sha256(repr(rule_table(berichtsjahr).rules).encode()).hexdigest()}
+        if resume is None:
+            resume = signature is not None
+        manifest = load_manifest(destination_folder, berichtsjahr, run) if resume else None
+        if manifest is None:
+            manifest = {"run": run, "bounds": None, "parts": {}}
+
+        if hasattr(id_groups, "__len__"):
+            # cost-balanced chunks, nr of workers from cores and memory needed for the largest chunk
+            n_chunks = -(-len(id_groups) // batch_size)
+            if manifest["bounds"] is None:
+                manifest["bounds"] = plan_chunks(costs, max(n_chunks, 4 * choose_n_jobs(n_jobs))).tolist()
+            bounds = np.array(manifest["bounds"], dtype=np.int64)
+            chunk_months = np.add.reduceat(n_months, bounds[:-1]) if len(bounds) > 1 else np.zeros(1)
+            n_jobs = choose_n_jobs(n_jobs, chunk_months.max() * memory_per_month)
+            n_chunks = len(bounds) - 1
+            if isinstance(id_groups, LazyEpisodes):
+                chunks = (id_groups.block(bounds[k], bounds[k + 1]) for k in range(n_chunks))
+            elif isinstance(id_groups, EpisodeArrays):
+                chunks = (episodes.block(bounds[k], bounds[k + 1]) for k in range(n_chunks))
+                if first_month is not None:
+                    ids = episodes.ids()
+                    updates = [(first_month[bounds[k]:bounds[k + 1]],
+                                (previous_path, ids[bounds[k]:bounds[k + 1]][unchanged[bounds[k]:bounds[k + 1]]],
+                                 berichtsjahr))
+                               for k in range(n_chunks)]
+            else:
+                chunks = (id_groups[bounds[k]:bounds[k + 1]] for k in range(n_chunks))
+        else:
+            # generator: consumed chunk by chunk, so that streamed groups (chunksize) are never held in memory at once
+            n_jobs = choose_n_jobs(n_jobs)
+            n_chunks = "?"
+            id_groups = iter(id_groups)
+            chunks = iter(lambda: list(islice(id_groups, batch_size)), [])
+
+        print(f"Processing {n_chunks} chunks with {n_jobs} workers ({backend}) ...")
+        if manifest["parts"]:
+            print(f" {len(manifest['parts'])} parts of an earlier run are reused.")
+        run_start = time.time()
+        id_ranges = {}
+        spans = {}
+        profile = Profile()  # stages of all workers and of the main process
+        chunk_reports = []
+
+        def pending_tasks():
+            # chunks with a recorded part of the same ID range are skipped
+            for i, chunk in enumerate(chunks):
+                id_ranges[i] = chunk_id_range(chunk)
+                if sparse:
+                    spans[i] = chunk_spans(chunk, berichtsjahr)
+                part = manifest["parts"].get(str(i))
+                if part is not None and part["ids"] == id_ranges[i]:
+                    continue
+                yield delayed(pivot_chunk)(i, chunk, berichtsjahr, block_size, anlage10,
+                                           *(updates[i] if first_month is not None else (None, None)), sparse=sparse,
+                                           time_ids=time_ids)
+
+        # completed chunks are saved to disk right away, no waiting for other chunks
+        n_done = 0
+        for i, result_df, chunk_profile, summary_df in run_tasks(pending_tasks(), n_jobs, backend):
+            profile.merge(chunk_profile)
+            chunk_reports.append({"chunk": i, "ids": id_ranges[i], "rows": len(result_df),
+                                  "seconds": round(sum(seconds for _, seconds, _ in chunk_profile.stages.values()), 6),
+                                  "stages": {stage: round(seconds, 6)
+                                             for stage, (_, seconds, _) in chunk_profile.stages.items()}})
+            profile.start()
+            file_name = f"VVL_{berichtsjahr}_pivot_part_{i}.parquet"
+            part = {"file": file_name, "ids": id_ranges[i], "rows": len(result_df),
+                    "sha256": write_part(result_df, destination_folder + file_name), "str_widths": {},
+                    "summary": f"VVL_{berichtsjahr}_pivot_part_{i}_summary.parquet"}
+            summary_df.to_parquet(destination_folder + part["summary"])
+            for col in result_df.columns[result_df.dtypes == object]:
+                # string columns (e.g. string IDs) are written with the max width over all chunks to the .dta
+                part["str_widths"][col] = int(result_df[col].str.len().max()) if len(result_df) else 0
+            manifest["parts"][str(i)] = part
+            write_json(manifest, manifest_path(destination_folder, berichtsjahr))
+            profile.lap("write_part", len(result_df))
+            n_done += 1
+            print(f" Chunk {i+1}/{n_chunks} done ({n_done} after {round(time.time() - run_start, 3)} seconds).")
+
+        # parts of this run (chunks of an earlier run with more chunks are left out)
+        parts = [manifest["parts"][str(i)] for i in sorted(id_ranges)]
+        all_files = [destination_folder + part["file"] for part in parts]
+        str_widths = {}
+        for part in parts:
+            for col, width in part["str_widths"].items():
+                str_widths[col] = max(str_widths.get(col, 1), width)
+
+        # episode hashes for the incremental update of the next berichtsjahr
+        if isinstance(id_groups, EpisodeArrays):
+            pd.DataFrame({"FDZ_ID": episodes.ids(), "HASH": hashes}).to_parquet(
+                hashes_path(destination_folder, berichtsjahr))
+    finally:
+        # memory-mapped copy of the episodes is removed also when the run fails
+        if temp_folder is not None:
+            shutil.rmtree(temp_folder, ignore_errors=True)
+
+    # summary: summaries of the parts (parts of a run without summaries are summarized now)
+    profile.start()
+    summaries = [pd.read_parquet(destination_folder + part["summary"])
+                 if os.path.isfile(destination_folder + part.get("summary", "")) else
+                 summarize_result(pd.read_parquet(destination_folder + part["file"])) for part in parts]
+    summary_df = merge_summaries(summaries)
+    summary_df.to_csv(summary_path(destination_folder, berichtsjahr), index=False)
+    profile.lap("summary", len(summary_df))
+
+    # export result: parts are appended in order
+    profile.start()
+    result_path = save_result(all_files, destination_folder, berichtsjahr, str_widths, suffix, stata)
+    profile.lap("save_result", sum(part["rows"] for part in parts))
+    if sparse:
+        spans_df = pd.concat([spans[i] for i in sorted(spans)] or [chunk_spans([], berichtsjahr)], ignore_index=True)
+        spans_df.to_parquet(spans_path(destination_folder, berichtsjahr))
+        if stata:
+            spans_df.to_stata(spans_path(destination_folder, berichtsjahr)[:-len(".parquet")] + ".dta",
+                              write_index=False)
+        profile.lap("save_spans", len(spans_df))
+
+    # profiling report: time and rows per stage (summed over all workers), slowest IDs, chunks
+    report_path = destination_folder + f"VVL_{berichtsjahr}_pivot_profile"
+    profile.save(report_path, chunk_reports)
+    print(f" Profile saved to {report_path}.json/.csv.")
+
+    return result_path
+
+
+#######################################################################################################################
+
+
+# multi-year mode: the latest berichtsjahr is computed once, the results of the earlier berichtsjahre are truncated
+# views on it - only IDs with other episodes up to December of an earlier berichtsjahr are computed again
+
+def run_years(berichtsjahre, data_path, destination_folder, batch_size, cache_folder=None, anlage10=None, **kwargs):
+    '''
+    :param berichtsjahre: list of int
+    :param data_path: str, folder containing OSV.VVL.{berichtsjahr}.VAR.dta of every berichtsjahr
+    :param destination_folder: str, VVL_{berichtsjahr}_pivot.parquet/.dta are saved for every berichtsjahr
+    :param batch_size: int, see run_in_batches_and_save_result
+    :param cache_folder: str (optional) - Parquet cache of the VAR files (see load_and_preprocess)
+    :param anlage10: output of load_anlage10 (optional) - loaded once from anlage10_path by default
+    :param kwargs: further arguments of run_in_batches_and_save_result (block_size, n_jobs, backend, ...)
+    :return: dict berichtsjahr -> path of the result
+    '''
+
+    berichtsjahre = sorted(set(berichtsjahre))
+    latest = berichtsjahre[-1]
+    if anlage10 is None:
+        anlage10 = load_anlage10()
+
+    # latest berichtsjahr: all months of all IDs, hashes of the episodes up to December of every earlier berichtsjahr
+    episodes = load_and_preprocess(latest, data_path, cache_folder=cache_folder, group_free=True)
+    ids = episodes.ids()
+    view_hashes = {berichtsjahr: episode_hashes(episodes, latest, f"{berichtsjahr}-12-31")
+                   for berichtsjahr in berichtsjahre[:-1]}
+    result_paths = {latest: run_in_batches_and_save_result(episodes, batch_size, destination_folder, latest,
+                                                           anlage10=anlage10, **kwargs)}
+    del episodes
+
+    # earlier berichtsjahre: every VAR file is read once, unchanged IDs are truncated views on the latest result
+    for berichtsjahr in reversed(berichtsjahre[:-1]):
+        episodes = load_and_preprocess(berichtsjahr, data_path, cache_folder=cache_folder, group_free=True)
+        result_paths[berichtsjahr] = run_in_batches_and_save_result(
+            episodes, batch_size, destination_folder, berichtsjahr, anlage10=anlage10,
+            view_of=(result_paths[latest], ids, view_hashes[berichtsjahr]), **kwargs)
+        del episodes
+
+    return result_paths
+
+
+#######################################################################################################################
+
+
+# sharded mode: the IDs are split into n_shards ranges of about equal cost - the same split in every process with the
+# same input - each shard can be run by another process or machine (run_shard), merge_shards checks the shards and
+# stitches them together to the final result
+
+def shard_path(folder, berichtsjahr, shard, n_shards):
+    return folder + f"VVL_{berichtsjahr}_pivot_shard_{shard}_of_{n_shards}"
+
+
+def shard_bounds(costs, n_shards):
+    '''
+    :param costs: array, cost per ID (see id_costs)
+    :param n_shards: int
+    :return: array of n_shards + 1 boundaries: shard k holds the IDs bounds[k]:bounds[k+1] (can be empty)
+    '''
+
+    cumulated = np.cumsum(costs)
+    targets = (cumulated[-1] if len(costs) else 0) * np.arange(1, n_shards) / n_shards
+    return np.r_[0, np.searchsorted(cumulated, targets, side="right"), len(costs)].astype(np.int64)
+
+
+def run_shard(id_groups, shard, n_shards, batch_size, destination_folder, berichtsjahr, **kwargs):
+    '''
+    pivots the IDs of shard k of n_shards (see run_in_batches_and_save_result) to the folder
+    VVL_{berichtsjahr}_pivot_shard_{shard}_of_{n_shards}/ in destination_folder: parquet files only, with its own
+    parts, manifest and profile (a restarted shard resumes). The shard is described (input, ID range, rows, checksum)
+    in VVL_{berichtsjahr}_pivot_shard_{shard}_of_{n_shards}.json, written when the shard is complete.
+    :param id_groups: output of load_and_preprocess(berichtsjahr): list, EpisodeArrays or LazyEpisodes - the whole
+                      input in every shard (streamed ID groups can't be split)
+    :param shard: int, 0, ..., n_shards - 1
+    :param n_shards: int
+    :param batch_size: int, see run_in_batches_and_save_result
+    :param destination_folder: str, the same folder for all shards (e.g. a shared drive)
+    :param berichtsjahr: int
+    :param kwargs: further arguments of run_in_batches_and_save_result (block_size, n_jobs, sparse, ...)
+    :return: path of the description of the shard
+    '''
+
+    if not hasattr(id_groups, "__len__"):
+        raise ValueError("Shards need the whole input: use a list, EpisodeArrays or LazyEpisodes, "
+                         "not streamed ID groups (chunksize).")
+    if not 0 <= shard < n_shards:
+        raise ValueError(f"shard has to be one of 0, ..., {n_shards - 1}, got {shard}.")
+
+    # IDs of the shard: ranges of about equal cost of the IDs sorted by FDZ_ID
+    ids, n_episodes, first_days = id_sizes(id_groups)
+    costs = id_costs(n_episodes, first_days, berichtsjahr)[0]
+    signature = hashlib.sha256(pd.util.hash_array(ids).tobytes() + costs.tobytes()).hexdigest()
+    bounds = shard_bounds(costs, n_shards)
+    first, last = bounds[shard], bounds[shard + 1]
+    shard_groups = id_groups.block(first, last) if hasattr(id_groups, "block") else id_groups[first:last]
+    print(f"Shard {shard + 1}/{n_shards}: {last - first} of {len(ids)} IDs.")
+
+    folder = shard_path(destination_folder, berichtsjahr, shard, n_shards) + "/"
+    os.makedirs(folder, exist_ok=True)
+    result_path = run_in_batches_and_save_result(shard_groups, batch_size, folder, berichtsjahr, stata=False,
+                                                 **kwargs)
+
+    # string columns (e.g. string IDs) are written with the max width over all shards to the .dta
+    str_widths = {}
+    for field in pq.read_schema(result_path):
+        if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+            lengths = pq.read_table(result_path, columns=[field.name]).column(0).to_pandas().str.len()
+            str_widths[field.name] = int(lengths.max()) if len(lengths) else 0
+
+    sparse = bool(kwargs.get("sparse", False))
+    description = {"berichtsjahr": berichtsjahr, "shard": shard, "n_shards": n_shards, "input": signature,
+                   "sparse": sparse, "n_ids": int(last - first), "ids": chunk_id_range(shard_groups),
+                   "file": os.path.relpath(result_path, destination_folder),
+                   "rows": pq.ParquetFile(result_path).metadata.num_rows, "sha256": file_hash(result_path),
+                   "str_widths": str_widths,
+                   "hashes": (os.path.relpath(hashes_path(folder, berichtsjahr), destination_folder)
+                              if isinstance(shard_groups, EpisodeArrays) else None),
+                   "spans": os.path.relpath(spans_path(folder, berichtsjahr), destination_folder) if sparse else None,
+                   "summary": os.path.relpath(summary_path(folder, berichtsjahr), destination_folder)}
+    description_path = shard_path(destination_folder, berichtsjahr, shard, n_shards) + ".json"
+    write_json(description, description_path)
+    print(f" Shard {shard + 1}/{n_shards} described in {description_path}.")
+
+    return description_path
+
+
+def merge_shards(destination_folder, berichtsjahr, n_shards, stata=True):
+    '''
+    checks that all shards of a sharded run are complete and belong together (same input, berichtsjahr and output
+    format, unmodified files, ID ranges in order) and stitches them together in order: the same files as
+    run_in_batches_and_save_result for the whole input (result, hashes, spans, summary)
+    :param destination_folder: str, destination_folder of run_shard
+    :param berichtsjahr: int
+    :param n_shards: int
+    :param stata: bool - False: the .dta files are not written
+    :return: path of the final result
+    '''
+
+    descriptions, missing = [], []
+    for shard in range(n_shards):
+        description_path = shard_path(destination_folder, berichtsjahr, shard, n_shards) + ".json"
+        if not os.path.isfile(description_path):
+            missing.append(shard)
+            continue
+        with open(description_path) as f:
+            descriptions.append(json.load(f))
+    if missing:
+        raise FileNotFoundError(f"Shards {missing} of {n_shards} are missing or not complete in {destination_folder}.")
+
+    last_id = None
+    for shard, description in enumerate(descriptions):
+        for key, value in {"berichtsjahr": berichtsjahr, "shard": shard, "n_shards": n_shards,
+                           "input": descriptions[0]["input"], "sparse": descriptions[0]["sparse"]}.items():
+            if description[key] != value:
+                raise ValueError(f"Shard {shard} doesn't belong to this run: {key} is {description[key]}, "
+                                 f"expected {value}.")
+        file_path = destination_folder + description["file"]
+        if not os.path.isfile(file_path) or file_hash(file_path) != description["sha256"]:
+            raise ValueError(f"Result of shard {shard} ({file_path}) is missing or was modified.")
+        if description["n_ids"]:
+            if last_id is not None and not description["ids"][0] > last_id:
+                raise ValueError(f"IDs of shard {shard} don't follow the IDs of the shards before.")
+            last_id = description["ids"][1]
+    print(f"Merging {n_shards} shards ({sum(description['n_ids'] for description in descriptions)} IDs) ...")
+
+    # result: shards are appended in order (shards without rows are left out, their schema may differ)
+    str_widths = {}
+    for description in descriptions:
+        for col, width in description["str_widths"].items():
+            str_widths[col] = max(str_widths.get(col, 1), width)
+    result_path = save_result([destination_folder + description["file"]
+                               for description in descriptions if description["rows"]],
+                              destination_folder, berichtsjahr, str_widths,
+                              "_sparse" if descriptions[0]["sparse"] else "", stata)
+
+    # episode hashes (incremental update) and spans (sparse output) of all IDs
+    for key, path_of in (("hashes", hashes_path), ("spans", spans_path)):
+        files = [destination_folder + description[key] for description in descriptions
+                 if description[key] is not None and description["n_ids"]]
+        if not files:
+            continue
+        merged_df = pd.concat([pd.read_parquet(file_path) for file_path in files], ignore_index=True)
+        merged_df.to_parquet(path_of(destination_folder, berichtsjahr))
+        if key == "spans" and stata:
+            merged_df.to_stata(path_of(destination_folder, berichtsjahr)[:-len(".parquet")] + ".dta",
+                               write_index=False)
+
+    # summary: the summaries of the shards are added up
+    summary_df = merge_summaries([read_summary(destination_folder + description["summary"])
+                                  for description in descriptions])
+    summary_df.to_csv(summary_path(destination_folder, berichtsjahr), index=False)
+
+    return result_path
+
+
+#######################################################################################################################
+
+
+# single IDs and subsets: only the episodes of the requested IDs are read from the Parquet cache (FDZ_ID index)
+
+def pivot_ids(berichtsjahr, data_path, cache_folder, ids=None, id_range=None, anlage10=None, group_free=True):
+    '''
+    pivots some IDs only, e.g. to check single timelines or rerun disputed IDs - the rest of the VAR file is not read
+    :param berichtsjahr: int
+    :param data_path: str, folder containing OSV.VVL.{berichtsjahr}.VAR.dta - not needed if cache_folder holds a
+                      complete cache of it
+    :param cache_folder: str, Parquet cache of the VAR file (built once, see convert_to_parquet)
+    :param ids: list of FDZ_IDs (optional)
+    :param id_range: tuple (first FDZ_ID, last FDZ_ID) (optional), see read_ids
+    :param anlage10: output of load_anlage10 (optional) - loaded from anlage10_path by default
+    :param group_free: bool - True: pivot_block, False: pivot_episodes per ID (reference)
+    :return: df in the format of the final result (see format_result)
+    '''
+
+    if anlage10 is None:
+        anlage10 = load_anlage10()
+
+    # a complete cache (with its FDZ_ID index) is used as it is without the VAR file, e.g. when only the cache was
+    # copied - otherwise it is checked against the VAR file and built or rebuilt if needed
+    cache_path = os.path.join(cache_folder, f"OSV.VVL.{berichtsjahr}.VAR.parquet")
+    is_complete = all(os.path.isfile(os.path.join(cache_path, name)) for name in ["_cache.json", "_index.arrow"])
+    if not is_complete or os.path.exists(data_path + f"OSV.VVL.{berichtsjahr}.VAR.dta"):
+        cache_path = convert_to_parquet(berichtsjahr, data_path, cache_folder)
+    df = read_ids(cache_path, ids, id_range)
+
+    if len(df) == 0:
+        result_df = pd.DataFrame(columns=output_columns)
+    elif group_free:
+        result_df = pivot_block(EpisodeArrays.from_df(classify_episodes(df, berichtsjahr)), berichtsjahr, anlage10)
+    else:
+        result_df = concat_results([pivot_episodes(id, group, berichtsjahr, anlage10)
+                                    for id, group in classify_episodes(df, berichtsjahr).groupby("FDZ_ID")])
+    return format_result(result_df, berichtsjahr)
+
+
+#######################################################################################################################
+
+
+# command line: python episodes_pivot.py shard|merge|ids ... (see --help), e.g. one shard per job of a batch
+# scheduler
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pivots VAR episodes into monthly timelines.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    convert_parser = commands.add_parser("convert", help="build the Parquet cache of a VAR file (convert_to_parquet)")
+    convert_parser.add_argument("--berichtsjahr", type=int, required=True)
+    convert_parser.add_argument("--data-path", required=True, help="folder containing OSV.VVL.{berichtsjahr}.VAR.dta")
+    convert_parser.add_argument("--cache-folder", required=True)
+
+    shard_parser = commands.add_parser("shard", help="pivot shard k of n (run_shard)")
+    shard_parser.add_argument("--berichtsjahr", type=int, required=True)
+    shard_parser.add_argument("--data-path", required=True, help="folder containing OSV.VVL.{berichtsjahr}.VAR.dta")
+    shard_parser.add_argument("--destination", required=True, help="output folder, the same for all shards")
+    shard_parser.add_argument("--shard", type=int, required=True, help="0, ..., n_shards - 1")
+    shard_parser.add_argument("--n-shards", type=int, required=True)
+    shard_parser.add_argument("--batch-size", type=int, default=10000)
+    shard_parser.add_argument("--block-size", type=int, default=2000)
+    shard_parser.add_argument("--cache-folder", help="Parquet cache of the VAR file (see convert_to_parquet)")
+    shard_parser.add_argument("--group-free", action="store_true", help="EpisodeArrays and pivot_block")
+    shard_parser.add_argument("--engine", default="pandas", choices=["pandas", "polars"])
+    shard_parser.add_argument("--sparse", action="store_true")
+    shard_parser.add_argument("--n-jobs", type=int)
+    shard_parser.add_argument("--backend", default="processes", choices=["processes", "threads", "serial"])
+    shard_parser.add_argument("--anlage10", default=anlage10_path, help="path of Anlage_10.dta")
+
+    merge_parser = commands.add_parser("merge", help="check the shards and stitch them together (merge_shards)")
+    merge_parser.add_argument("--berichtsjahr", type=int, required=True)
+    merge_parser.add_argument("--destination", required=True)
+    merge_parser.add_argument("--n-shards", type=int, required=True)
+    merge_parser.add_argument("--no-stata", action="store_true", help="parquet files only")
+
+    ids_parser = commands.add_parser("ids", help="pivot some IDs only (pivot_ids)")
+    ids_parser.add_argument("--berichtsjahr", type=int, required=True)
+    ids_parser.add_argument("--data-path", required=True, help="folder containing OSV.VVL.{berichtsjahr}.VAR.dta")
+    ids_parser.add_argument("--cache-folder", required=True, help="Parquet cache of the VAR file")
+    id_selection = ids_parser.add_mutually_exclusive_group(required=True)
+    id_selection.add_argument("--ids", nargs="+", help="FDZ_IDs")
+    id_selection.add_argument("--range", nargs=2, metavar=("FIRST", "LAST"), help="all FDZ_IDs from FIRST to LAST")
+    ids_parser.add_argument("--reference", action="store_true", help="pivot_episodes per ID instead of pivot_block")
+    ids_parser.add_argument("--output", help="file (.parquet, .csv or .dta) - printed by default")
+    ids_parser.add_argument("--anlage10", default=anlage10_path, help="path of Anlage_10.dta")
+    args = parser.parse_args()
+
+    # folders are used as prefixes of the file names
+    if args.command == "convert":
+        convert_to_parquet(args.berichtsjahr, os.path.join(args.data_path, ""), args.cache_folder)
+    elif args.command == "shard":
+        id_groups = load_and_preprocess(args.berichtsjahr, os.path.join(args.data_path, ""),
+                                        cache_folder=args.cache_folder, group_free=args.group_free, engine=args.engine)
+        run_shard(id_groups, args.shard, args.n_shards, args.batch_size, os.path.join(args.destination, ""),
+                  args.berichtsjahr, block_size=args.block_size, n_jobs=args.n_jobs, backend=args.backend,
+                  anlage10=load_anlage10(args.anlage10), sparse=args.sparse)
+    elif args.command == "merge":
+        merge_shards(os.path.join(args.destination, ""), args.berichtsjahr, args.n_shards, stata=not args.no_stata)
+    else:
+        result_df = pivot_ids(args.berichtsjahr, os.path.join(args.data_path, ""), args.cache_folder, args.ids,
+                              args.range, load_anlage10(args.anlage10), group_free=not args.reference)
+        if args.output is None:
+            print(result_df.to_string())
+        elif args.output.endswith(".parquet"):
+            result_df.to_parquet(args.output)
+        elif args.output.endswith(".csv"):
+            result_df.to_csv(args.output, index=False)
+        else:
+            result_df.to_stata(args.output, write_index=False)
@@ -0,0 +1,331 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import numpy as np
+import pandas as pd
+import episodes_pivot
+
+
+#######################################################################################################################
+
+
+# synthetic VAR datasets: same columns and codes as OSV.VVL.{berichtsjahr}.VAR.dta, no real data needed
+
+# code combinations (BYAT, BYATSO, VSGR, RTVS) per group of zustände, drawn with the weights below
+var_codes = {
+    "status_1": [(10, "0", 1, 0), (10, "3", 2, 5), (10, "9", 5, 1), (10, "8", 6, 6), (9, "0", 3, 0), (9, "0", 5, 6),
+                 (17, "0", 1, 1), (17, "0", 4, 5)],
+    "status_23": [(10, "1", 0, 0), (10, "6", 0, 0), (90, "0", 0, 0), (18, "0", 0, 0), (13, "0", 0, 0),
+                  (12, "0", 0, 0), (40, "A", 0, 0), (14, "0", 0, 0), (7, "0", 0, 0), (60, "2", 0, 0),
+                  (20, "8", 0, 0), (21, "5", 0, 0), (20, "3", 0, 0), (42, "C", 0, 0), (26, "0", 0, 0),
+                  (41, "9", 0, 0), (11, "0", 0, 0), (2, "0", 0, 0), (71, "0", 0, 0), (20, "4", 0, 0),
+                  (25, "0", 0, 0), (40, "5", 0, 0), (48, "5", 0, 1), (4, "0", 0, 0), (41, "B", 0, 0)],
+    "status_4": [(5, "0", 0, 0)],
+    "status_5": [(6, "0", 0, 0)],
+    "other": [(99, "0", 0, 0), (10, "0", 9, 9)]}
+code_weights = {"status_1": 0.45, "status_23": 0.3, "status_4": 0.1, "status_5": 0.1, "other": 0.05}
+
+
+def generate_var(n_ids, episodes_per_id=8, overlap_density=0.3, span_days=(1, 1500), first_year=1980,
+                 berichtsjahr=2015, open_share=0.02, seed=0):
+    '''
+    generates a synthetic VAR dataset (sorted by FDZ_ID)
+    :param n_ids: int, nr of IDs
+    :param episodes_per_id: float, mean nr of episodes per ID (at least 1 per ID)
+    :param overlap_density: float between 0 and 1, share of BYAT 5/6 episodes that start within the previous
+                            episode of the same BYAT (overlapping episodes, see resolve_overlaps)
+    :param span_days: (min, max), length of the episodes in days (log-uniform, many short and some long episodes)
+    :param first_year: int, first year of the first episode of an ID
+    :param berichtsjahr: int
+    :param open_share: float, share of episodes ending after berichtsjahr
+    :param seed: int
+    :return: df with FDZ_ID, VNZR, BSZR (YYYYMMDD), BYAT, BYATSO, VSGR, RTVS, ZREG, EGPT
+    '''
+
+    rng = np.random.default_rng(seed)
+    n_episodes = 1 + rng.poisson(max(episodes_per_id - 1, 0), n_ids)
+    n = int(n_episodes.sum())
+    ids = np.repeat(1000 + np.arange(n_ids) * 7, n_episodes)
+
+    # codes: group of zustände, then code combination within the group
+    groups = list(var_codes)
+    group = rng.choice(len(groups), n, p=[code_weights[name] for name in groups])
+    codes = np.empty((n, 4), dtype=object)
+    for k, name in enumerate(groups):
+        rows = np.flatnonzero(group == k)
+        codes[rows] = np.array(var_codes[name], dtype=object)[rng.integers(len(var_codes[name]), size=len(rows))]
+
+    # dates: start of the ID, then episodes within the following years
+    last_day = np.datetime64(f"{berichtsjahr}-12-31")
+    id_start = np.datetime64(f"{first_year}-01-01") + rng.integers(
+        0, (last_day - np.datetime64(f"{first_year}-01-01")).astype(int) - 365, n_ids)
+    start = np.repeat(id_start, n_episodes) + rng.integers(0, 365 * 8, n)
+    length = np.exp(rng.uniform(np.log(span_days[0]), np.log(span_days[1]), n)).astype(np.int64) - 1
+    start = np.minimum(start, last_day)
+
+    # BYAT 5/6: a share of the episodes starts within the previous episode of the same ID and BYAT
+    for byat_group in (groups.index("status_4"), groups.index("status_5")):
+        rows = np.flatnonzero(group == byat_group)
+        overlapping = (ids[rows[1:]] == ids[rows[:-1]]) & (rng.random(max(len(rows) - 1, 0)) < overlap_density)
+        previous, current = rows[:-1][overlapping], rows[1:][overlapping]
+        start[current] = start[previous] + rng.integers(0, length[previous] + 1)
+    end = start + length
+    end[rng.random(n) < open_share] = np.datetime64(f"{berichtsjahr + 1}-03-31")
+
+    def yyyymmdd(days):
+        return pd.DatetimeIndex(days).strftime("%Y%m%d").astype(np.int64)
+
+    return pd.DataFrame({
+        "FDZ_ID": ids.astype(np.int32),
+        "VNZR": yyyymmdd(start),
+        "BSZR": yyyymmdd(end),
+        "BYAT": codes[:, 0].astype(np.int16),
+        "BYATSO": codes[:, 1].astype(str),
+        "VSGR": codes[:, 2].astype(np.int16),
+        "RTVS": codes[:, 3].astype(np.int16),
+        "ZREG": np.round(rng.uniform(0, 5000, n), 2),
+        "EGPT": np.round(rng.uniform(0, 2, n), 4)})
+
+
+def generate_anlage10(first_year=1930, last_year=2030, seed=0):
+    '''
+    :return: synthetic ANLAGE_10 factors in the format of episodes_pivot.load_anlage10
+    '''
+
+    rng = np.random.default_rng(seed)
+    n_months = (last_year - first_year + 1) * 12
+    return np.round(rng.uniform(0.5, 1.5, n_months), 4), (first_year - 1970) * 12
+
+
+def write_var(df, data_path, berichtsjahr):
+    '''
+    saves df as {data_path}OSV.VVL.{berichtsjahr}.VAR.dta (input of load_and_preprocess)
+    '''
+
+    file_path = data_path + f"OSV.VVL.{berichtsjahr}.VAR.dta"
+    df.to_stata(file_path, write_index=False)
+    return file_path
+
+
+#######################################################################################################################
+
+
+# benchmarks: runtime, throughput and peak memory of the loading, the per-ID reference and the full run
+
+def tree_rss(pid=None):
+    '''
+    resident memory of a process and all its living descendants (e.g. loky workers) in bytes - pages shared between
+    the processes (memmap) are counted once per process
+    :param pid: int (optional) - this process by default
+    '''
+
+    pid = os.getpid() if pid is None else pid
+    try:
+        import psutil
+        process = psutil.Process(pid)
+        total = 0
+        for member in [process] + process.children(recursive=True):
+            try:
+                total += member.memory_info().rss
+            except psutil.Error:
+                pass  # finished meanwhile
+        return total
+    except ImportError:
+        pass
+
+    # Linux without psutil: parents from /proc/{pid}/stat, resident pages from /proc/{pid}/statm
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    parents[int(entry)] = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                pass
+    tree = [pid]
+    for member in tree:
+        tree += [child for child, parent in parents.items() if parent == member]
+    total = 0
+    for member in tree:
+        try:
+            with open(f"/proc/{member}/statm") as f:
+                total += int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, IndexError, ValueError):
+            pass
+    return total
+
+
+class PeakMemory:
+    '''
+    peak resident memory of this process and its child processes while a step runs, sampled by a thread every
+    interval seconds (ru_maxrss is a lifetime high-water mark and leaves out living workers):
+        with PeakMemory() as memory:
+            ...
+        memory.peak_mb
+    '''
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while True:
+            self.peak = max(self.peak, tree_rss())
+            if self._stop.wait(self.interval):
+                break
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, tree_rss())
+
+    @property
+    def peak_mb(self):
+        return self.peak / 2 ** 20
+
+
+def run_benchmark(n_ids, work_folder, berichtsjahr=2015, episodes_per_id=8, n_reference_ids=100, n_jobs=None,
+                  backend="processes", seed=0):
+    '''
+    generates a dataset with n_ids IDs and times load_and_preprocess, pivot_episodes (per stage, on a sample of IDs)
+    and run_in_batches_and_save_result (group-free)
+    :param n_ids: int
+    :param work_folder: str, folder for the dataset and the results (ends with "/")
+    :param n_reference_ids: int, nr of IDs for the per-ID reference pivot_episodes (slow)
+    :return: list of dicts, one per measurement: STEP, SECONDS, IDS, EPISODES, IDS_PER_S, EPISODES_PER_S,
+             PEAK_RSS_MB (peak during the step, this process and its workers, see PeakMemory) and the stages of the step
+    '''
+
+    anlage10 = generate_anlage10(seed=seed)
+    df = generate_var(n_ids, episodes_per_id=episodes_per_id, berichtsjahr=berichtsjahr, seed=seed)
+    write_var(df, work_folder, berichtsjahr)
+    n_episodes = len(df)
+    del df
+    results = []
+
+    def measure(step, seconds, ids, episodes, memory, profile=None):
+        results.append({"SCALE": n_ids, "STEP": step, "SECONDS": round(seconds, 4), "IDS": ids, "EPISODES": episodes,
+                        "IDS_PER_S": round(ids / seconds, 1) if seconds else None,
+                        "EPISODES_PER_S": round(episodes / seconds, 1) if seconds else None,
+                        "PEAK_RSS_MB": round(memory.peak_mb, 1),
+                        "STAGES": {} if profile is None else {stage: round(seconds, 4) for stage, (_, seconds, _)
+                                                              in profile.stages.items()}})
+
+    with PeakMemory() as memory:
+        start = time.perf_counter()
+        id_groups = episodes_pivot.load_and_preprocess(berichtsjahr, work_folder)
+        seconds = time.perf_counter() - start
+    measure("load_and_preprocess", seconds, len(id_groups), n_episodes, memory)
+
+    # per-ID reference: sample of IDs, time per stage
+    sample = id_groups[:n_reference_ids]
+    profile = episodes_pivot.Profile()
+    with PeakMemory() as memory:
+        start = time.perf_counter()
+        for id, group in sample:
+            episodes_pivot.pivot_episodes(id, group, berichtsjahr, anlage10, profile)
+        seconds = time.perf_counter() - start
+    measure("pivot_episodes", seconds, len(sample), sum(len(group) for _, group in sample), memory, profile)
+    del id_groups, sample
+
+    with PeakMemory() as memory:
+        start = time.perf_counter()
+        episodes = episodes_pivot.load_and_preprocess(berichtsjahr, work_folder, group_free=True)
+        seconds = time.perf_counter() - start
+    measure("load_and_preprocess (group_free)", seconds, len(episodes), n_episodes, memory)
+
+    # full run, stages from the profile of the run - memory of the workers included while they live
+    with PeakMemory() as memory:
+        start = time.perf_counter()
+        episodes_pivot.run_in_batches_and_save_result(episodes, 10000, work_folder, berichtsjahr, n_jobs=n_jobs,
+                                                      backend=backend, anlage10=anlage10, resume=False)
+        seconds = time.perf_counter() - start
+    profile = episodes_pivot.Profile()
+    stages_df = pd.read_csv(work_folder + f"VVL_{berichtsjahr}_pivot_profile.csv")
+    profile.stages = {row.STAGE: [row.CALLS, row.SECONDS, row.ROWS] for row in stages_df.itertuples()}
+    measure("run_in_batches_and_save_result", seconds, len(episodes), n_episodes, memory, profile)
+
+    return results
+
+
+def compare_to_baseline(results_df, baseline_path, tolerance=0.2):
+    '''
+    compares the runtimes with a saved benchmark (same scales and steps)
+    :param results_df: output of main (all measurements)
+    :param baseline_path: str, json saved by an earlier benchmark
+    :param tolerance: float, a step is reported as regression if it is slower by more than this share
+    :return: df of the regressions
+    '''
+
+    baseline_df = pd.read_json(baseline_path)
+    merged = results_df.merge(baseline_df, on=["SCALE", "STEP"], suffixes=("", "_BASELINE"))
+    merged["CHANGE"] = merged["SECONDS"] / merged["SECONDS_BASELINE"] - 1
+    regressions = merged[merged["CHANGE"] > tolerance][["SCALE", "STEP", "SECONDS_BASELINE", "SECONDS", "CHANGE"]]
+    for row in regressions.itertuples():
+        print(f" Regression: {row.STEP} ({row.SCALE} IDs) {row.SECONDS_BASELINE} -> {row.SECONDS} seconds "
+              f"({round(100 * row.CHANGE)} %).")
+    return regressions
+
+
+def main(scales=(1000, 10000, 100000), berichtsjahr=2015, work_folder=None, output_path=None, baseline_path=None,
+         n_jobs=None, backend="processes", seed=0, keep=False):
+    '''
+    runs the benchmark for every scale (nr of IDs), prints the results and saves them as json (see compare_to_baseline)
+    :param work_folder: str, folder for the datasets and results (created if missing, kept) - default: temporary
+                        folder, removed at the end unless keep
+    :param keep: bool - keep the temporary folder
+    :return: df with one row per scale and step
+    '''
+
+    temporary = work_folder is None
+    work_folder = os.path.join(tempfile.mkdtemp(prefix="episodes_pivot_bench_") if temporary else work_folder, "")
+    os.makedirs(work_folder, exist_ok=True)
+    results = []
+    try:
+        for n_ids in scales:
+            print(f"\nBenchmark with {n_ids} IDs ...")
+            results += run_benchmark(n_ids, work_folder, berichtsjahr, n_jobs=n_jobs, backend=backend, seed=seed)
+    finally:
+        if temporary and not keep:
+            shutil.rmtree(work_folder, ignore_errors=True)
+        elif temporary:
+            print(f"\n Datasets and results kept in {work_folder}.")
+
+    results_df = pd.DataFrame(results)
+    print("\n" + results_df.drop(columns=["STAGES"]).to_string(index=False))
+
+    if output_path is not None:
+        with open(output_path, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\n Benchmark saved to {output_path}.")
+    if baseline_path is not None:
+        compare_to_baseline(results_df, baseline_path)
+
+    return results_df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of episodes_pivot on synthetic VAR datasets.")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1000, 10000, 100000], help="nr of IDs per run")
+    parser.add_argument("--berichtsjahr", type=int, default=2015)
+    parser.add_argument("--work-folder", help="folder for the datasets and results (default: temporary folder)")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary folder")
+    parser.add_argument("--output", help="save the results as json")
+    parser.add_argument("--baseline", help="json of an earlier benchmark, slower steps are reported")
+    parser.add_argument("--n-jobs", type=int)
+    parser.add_argument("--backend", default="processes", choices=["processes", "threads", "serial"])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    main(args.scales, args.berichtsjahr, args.work_folder, args.output, args.baseline, args.n_jobs, args.backend,
+         args.seed, args.keep)
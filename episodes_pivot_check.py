@@ -0,0 +1,637 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+import warnings
+import numpy as np
+import pandas as pd
+import episodes_pivot
+import episodes_pivot_original
+from episodes_pivot_bench import var_codes, generate_anlage10, write_var
+
+
+#######################################################################################################################
+
+
+# engines: function(episodes df, berichtsjahr, anlage10) -> result in the format of episodes_pivot.format_result.
+# "reference" is the per-ID pivot_episodes, every other engine has to match it cell by cell
+
+def run_reference(df, berichtsjahr, anlage10):
+    results = [episodes_pivot.format_result(episodes_pivot.pivot_episodes(id, group, berichtsjahr, anlage10),
+                                            berichtsjahr) for id, group in df.groupby("FDZ_ID")]
+    with warnings.catch_warnings():
+        # all-NA columns of single IDs: dtypes are set by format_result anyway
+        warnings.simplefilter("ignore", FutureWarning)
+        return episodes_pivot.format_result(pd.concat(results, ignore_index=True), berichtsjahr)
+
+
+def run_block(df, berichtsjahr, anlage10, block_size=7):
+    episodes = episodes_pivot.EpisodeArrays.from_df(df)
+    results = [episodes_pivot.pivot_block(episodes.block(first, min(first + block_size, len(episodes))),
+                                          berichtsjahr, anlage10)
+               for first in range(0, len(episodes), block_size)]
+    return episodes_pivot.format_result(pd.concat(results, ignore_index=True), berichtsjahr)
+
+
+def run_polars(df, berichtsjahr, anlage10):
+    episodes = episodes_pivot.LazyEpisodes.from_arrays(episodes_pivot.EpisodeArrays.from_df(df))
+    return episodes_pivot.format_result(
+        episodes_pivot.pivot_lazy(episodes, berichtsjahr, anlage10).collect(engine="streaming").to_pandas(),
+        berichtsjahr)
+
+
+engines = {"reference": run_reference, "block": run_block}
+if episodes_pivot.pl is not None:
+    engines["polars"] = run_polars
+
+
+def run_original(df, berichtsjahr, anlage10):
+    '''
+    frozen original implementation (episodes_pivot_original), output in the format of format_result
+    '''
+
+    factors, first_month = anlage10
+    months = first_month + np.arange(len(factors))
+    episodes_pivot_original.anlage10_df = pd.DataFrame({"JAHR": months // 12 + 1970, "MONAT": months % 12 + 1,
+                                                        "ANLAGE_10": factors})
+    results = [episodes_pivot_original.pivot_episodes(id, group, berichtsjahr) for id, group in df.groupby("FDZ_ID")]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", FutureWarning)
+        result_df = pd.concat(results, ignore_index=True).rename(columns={"ID": "FDZ_ID"})
+    return episodes_pivot.format_result(result_df, berichtsjahr)
+
+
+def original_ids(df):
+    '''
+    IDs whose result has to equal the original implementation. The others differ on purpose: 3 or more overlapping
+    BYAT 5 / BYAT 6 episodes (days counted more than once in the original, see check_overlaps) and status 1 episodes
+    with the same ZREG per day in a month (ties, the original kept a random one of them)
+    :param df: preprocessed episodes (see prepare)
+    :return: array of FDZ_IDs
+    '''
+
+    changed = set()
+    for byat in [5, 6]:
+        status_df = df[df["BYAT"] == byat]
+        # sweep over starts (+1) and ends (-1 on the day after), ends before starts of the same day
+        starts = pd.DataFrame({"FDZ_ID": status_df["FDZ_ID"], "DAY": status_df["VNZR"], "STEP": 1})
+        day_after = status_df["BSZR"] + pd.Timedelta(1, "D")
+        ends = pd.DataFrame({"FDZ_ID": status_df["FDZ_ID"], "DAY": day_after, "STEP": -1})
+        events = pd.concat([starts, ends]).sort_values(["FDZ_ID", "DAY", "STEP"])
+        overlaps = events.groupby("FDZ_ID")["STEP"].cumsum()
+        changed.update(events.loc[overlaps >= 3, "FDZ_ID"])
+
+    status_1_df = df[df["ZUSTAND_1"].notna()]
+    status_1_df = pd.DataFrame({
+        "FDZ_ID": status_1_df["FDZ_ID"],
+        "ZREG_TAG": status_1_df["ZREG"] / ((status_1_df["BSZR"] - status_1_df["VNZR"]).dt.days + 1),
+        "FIRST": status_1_df["VNZR"].dt.year * 12 + status_1_df["VNZR"].dt.month,
+        "LAST": status_1_df["BSZR"].dt.year * 12 + status_1_df["BSZR"].dt.month}).reset_index()
+    pairs = status_1_df.merge(status_1_df, on=["FDZ_ID", "ZREG_TAG"])
+    ties = (pairs["index_x"] < pairs["index_y"]) & (pairs["FIRST_x"] <= pairs["LAST_y"]) & (
+            pairs["FIRST_y"] <= pairs["LAST_x"])
+    changed.update(pairs.loc[ties, "FDZ_ID"])
+
+    ids = df["FDZ_ID"].unique()
+    return ids[~np.isin(ids, list(changed))]
+
+
+def prepare(df, berichtsjahr):
+    '''
+    same preprocessing as load_and_preprocess: dates (YYYYMMDD) to datetime, zustände
+    '''
+
+    return episodes_pivot.classify_episodes(episodes_pivot.convert_dates(df.copy()), berichtsjahr)
+
+
+#######################################################################################################################
+
+
+# comparison
+
+def compare_results(expected, actual, rtol=1e-12, atol=1e-9):
+    '''
+    compares two results cell by cell, rows matched by (FDZ_ID, JAHR, MONAT)
+    :param expected: df, e.g. output of run_reference
+    :param actual: df, output of another engine
+    :param rtol: float, relative tolerance of float columns
+    :param atol: float, absolute tolerance of float columns
+    :return: None if equal, else dict with the first difference (FDZ_ID, JAHR, MONAT, COLUMN, EXPECTED, ACTUAL) and
+             the nr of differing cells per column (DIFFERENCES). Missing (nan) only matches missing.
+    '''
+
+    keys = ["FDZ_ID", "JAHR", "MONAT"]
+    expected = expected.sort_values(keys, kind="stable", ignore_index=True)
+    actual = actual.sort_values(keys, kind="stable", ignore_index=True)
+
+    # rows: same keys in both results
+    merged = expected[keys].merge(actual[keys], on=keys, how="outer", indicator=True)
+    if (merged["_merge"] != "both").any():
+        row = merged[merged["_merge"] != "both"].iloc[0]
+        return {**{key: row[key] for key in keys}, "COLUMN": "row",
+                "EXPECTED": row["_merge"] != "right_only", "ACTUAL": row["_merge"] != "left_only",
+                "DIFFERENCES": {"row": int((merged["_merge"] != "both").sum())}}
+
+    first, differences = None, {}
+    for col in expected.columns:
+        if col in keys:
+            continue
+        if col not in actual:
+            differences[col] = len(expected)
+            continue
+        x, y = expected[col], actual[col]
+        if isinstance(x.dtype, pd.CategoricalDtype) or x.dtype == object:
+            x, y = x.astype(object).values, y.astype(object).values
+            x_missing, y_missing = pd.isna(x), pd.isna(y)
+            equal = (x_missing & y_missing) | (~x_missing & ~y_missing & (x == y))
+        else:
+            x, y = x.to_numpy(dtype="float64"), y.to_numpy(dtype="float64")
+            equal = (np.isnan(x) & np.isnan(y)) | np.isclose(x, y, rtol=rtol, atol=atol)
+        if not equal.all():
+            differences[col] = int((~equal).sum())
+            k = np.flatnonzero(~equal)[0]
+            if first is None or k < first[0]:
+                first = (k, col, x[k], y[k])
+
+    if not differences:
+        return None
+    if first is None:
+        return {"COLUMN": next(iter(differences)), "DIFFERENCES": differences}
+    k, col, x_value, y_value = first
+    return {**{key: expected[key].iloc[k] for key in keys}, "COLUMN": col, "EXPECTED": x_value, "ACTUAL": y_value,
+            "DIFFERENCES": differences}
+
+
+def compare_files(expected_path, actual_path, rtol=1e-12, atol=1e-9):
+    '''
+    compares two saved results (golden output and output of a new version), parquet or dta
+    '''
+
+    def read(file_path):
+        return pd.read_parquet(file_path) if file_path.endswith(".parquet") else pd.read_stata(file_path)
+
+    return compare_results(read(expected_path), read(actual_path), rtol, atol)
+
+
+#######################################################################################################################
+
+
+# randomized edge cases: leap-year Februaries, single-day episodes, fully nested overlaps, 3 or more overlapping
+# episodes, ties, month boundaries, open episodes and IDs without any zustand (empty status branches)
+
+edge_cases = ["leap_february", "single_day", "nested", "overlap", "month_boundary", "tie", "open", "unclassified",
+              "random"]
+
+
+def edge_case_episodes(n_ids, berichtsjahr=2015, seed=0, max_episodes=8):
+    '''
+    :return: VAR dataset (YYYYMMDD dates) with n_ids IDs, each built from random edge cases
+    '''
+
+    rng = np.random.default_rng(seed)
+    leap_years = [year for year in range(1972, berichtsjahr + 1, 4) if year % 100 != 0 or year % 400 == 0]
+    rows = []
+
+    def code(group):
+        return var_codes[group][rng.integers(len(var_codes[group]))]
+
+    def random_day():
+        return np.datetime64("1985-01-01") + rng.integers(0, (np.datetime64(f"{berichtsjahr}-12-31")
+                                                              - np.datetime64("1985-01-01")).astype(int))
+
+    for i in range(n_ids):
+        fdz_id = 1000 + 3 * i
+        for _ in range(rng.integers(1, max_episodes + 1)):
+            case = edge_cases[rng.integers(len(edge_cases))]
+            group = ["status_1", "status_23", "status_4", "status_5"][rng.integers(4)]
+            zreg, egpt = float(np.round(rng.uniform(0, 5000), 2)), float(np.round(rng.uniform(0, 2), 4))
+
+            if case == "leap_february":
+                year = leap_years[rng.integers(len(leap_years))]
+                start = np.datetime64(f"{year}-02-01") + rng.integers(0, 29)
+                end = start + rng.choice([0, 1, 28, 29, 30, 365])
+                episodes = [(start, end, code(group))]
+            elif case == "single_day":
+                start = random_day()
+                episodes = [(start, start, code(group))]
+            elif case == "nested":
+                # outer episode and one fully inside, same BYAT (status 4/5) or both with a status 1 zustand
+                group = ["status_1", "status_4", "status_5"][rng.integers(3)]
+                start = random_day()
+                end = start + rng.integers(30, 900)
+                inner_start = start + rng.integers(0, (end - start).astype(int) + 1)
+                inner_end = inner_start + rng.integers(0, (end - inner_start).astype(int) + 1)
+                episodes = [(start, end, code(group)), (inner_start, inner_end, code(group))]
+            elif case == "overlap":
+                # 3 to 5 episodes of one group overlapping each other (a day counted once per status)
+                start = random_day()
+                starts = start + rng.integers(0, 120, rng.integers(3, 6))
+                episodes = [(first, max(first, start + 120) + rng.integers(0, 400), code(group)) for first in starts]
+            elif case == "month_boundary":
+                start = random_day().astype("datetime64[M]")
+                end = (start + rng.integers(1, 14)).astype("datetime64[D]") - 1
+                episodes = [(start.astype("datetime64[D]"), end, code(group))]
+            elif case == "tie":
+                # two status 1 episodes with the same ZREG per day in the same months
+                start = random_day()
+                end = start + rng.integers(0, 400)
+                episodes = [(start, end, code("status_1")), (start, end, code("status_1"))]
+            elif case == "open":
+                start = random_day()
+                episodes = [(start, np.datetime64(f"{berichtsjahr + 1}-06-30"), code(group))]
+            elif case == "unclassified":
+                start = random_day()
+                episodes = [(start, start + rng.integers(0, 400), code("other"))]
+            else:
+                start = random_day()
+                episodes = [(start, start + rng.integers(0, 1500), code(group))]
+
+            for start, end, (byat, byatso, vsgr, rtvs) in episodes:
+                rows.append((fdz_id, start, end, byat, byatso, vsgr, rtvs, zreg, egpt))
+
+    return var_dataset(rows)
+
+
+def heavy_tie_episodes(n_ids, berichtsjahr=2015, seed=0, max_episodes=16):
+    '''
+    :return: VAR dataset (YYYYMMDD dates) with n_ids IDs, mostly long, overlapping status 1 episodes with the same ZREG
+             per day (0 or 40): most months of an ID have tied STATUS_1 maxima
+    '''
+
+    rng = np.random.default_rng(seed)
+    last_day = np.datetime64(f"{berichtsjahr}-12-31")
+    rows = []
+    for i in range(n_ids):
+        fdz_id = 1000 + 3 * i
+        first_day = last_day - rng.integers(365, 6 * 365)
+        for _ in range(rng.integers(4, max_episodes + 1)):
+            group = "status_1" if rng.random() < 0.8 else ["status_23", "status_4", "status_5"][rng.integers(3)]
+            byat, byatso, vsgr, rtvs = var_codes[group][rng.integers(len(var_codes[group]))]
+            start = first_day + rng.integers(0, 2 * 365)
+            end = start + rng.integers(0, 4 * 365)
+            zreg = float(rng.choice([0, 40]) * ((end - start).astype(int) + 1))
+            rows.append((fdz_id, start, end, byat, byatso, vsgr, rtvs, zreg, float(np.round(rng.uniform(0, 2), 4))))
+
+    return var_dataset(rows)
+
+
+def var_dataset(rows):
+    '''
+    :param rows: list of (FDZ_ID, VNZR, BSZR, BYAT, BYATSO, VSGR, RTVS, ZREG, EGPT), dates as datetime64[D]
+    :return: VAR dataset with dates as YYYYMMDD
+    '''
+
+    df = pd.DataFrame(rows, columns=["FDZ_ID", "VNZR", "BSZR", "BYAT", "BYATSO", "VSGR", "RTVS", "ZREG", "EGPT"])
+    for col in ["VNZR", "BSZR"]:
+        df[col] = pd.DatetimeIndex(df[col].values.astype("datetime64[D]")).strftime("%Y%m%d").astype(np.int64)
+    return df
+
+
+def random_episodes(n_ids, berichtsjahr=2015, seed=0, ties=False):
+    return (heavy_tie_episodes if ties else edge_case_episodes)(n_ids, berichtsjahr, seed)
+
+
+def earlier_episodes(df, berichtsjahr, seed=0):
+    '''
+    :param df: VAR dataset of berichtsjahr (YYYYMMDD dates)
+    :return: VAR dataset of berichtsjahr - 1: the episodes of df starting up to December of berichtsjahr - 1, a third
+             of the IDs without their last episode (IDs changed in berichtsjahr)
+    '''
+
+    rng = np.random.default_rng(seed)
+    df = df[df["VNZR"] <= (berichtsjahr - 1) * 10000 + 1231]
+    ids = df["FDZ_ID"].unique()
+    changed = ids[rng.random(len(ids)) < 1 / 3]
+    last_rows = df.index[~df["FDZ_ID"].duplicated(keep="last") & df["FDZ_ID"].isin(changed)]
+    return df.drop(last_rows).reset_index(drop=True)
+
+
+def sample_episodes(cache_path, n_ids, berichtsjahr=2015, seed=0):
+    '''
+    :param cache_path: Parquet cache of a VAR file (see episodes_pivot.convert_to_parquet)
+    :return: preprocessed episodes of n_ids random IDs of the cache, read by the FDZ_ID index (see
+             episodes_pivot.read_ids)
+    '''
+
+    ids = episodes_pivot.id_index(cache_path)["FDZ_ID"]
+    sample = np.random.default_rng(seed).choice(ids, min(n_ids, len(ids)), replace=False)
+    return episodes_pivot.classify_episodes(episodes_pivot.read_ids(cache_path, sample), berichtsjahr)
+
+
+#######################################################################################################################
+
+
+# overlaps of status 4 and 5: IDs with 3 or more overlapping BYAT 5 / BYAT 6 episodes, compared with a day by day
+# count independent of episodes_pivot (every covered day once, EGPT of all episodes covering the day). The baseline
+# counted days more than once here (ID 1: 36 days in October 2014), since resolve_overlaps every day is counted once.
+
+overlap_cases = {
+    1: [("2014-06-05", "2014-10-07"), ("2014-08-01", "2014-10-12"), ("2014-08-30", "2015-10-15"),
+        ("2014-09-23", "2016-01-10")],
+    2: [("2015-01-01", "2015-12-31"), ("2015-02-01", "2015-06-30"), ("2015-03-10", "2015-03-20")],  # nested
+    3: [("2015-04-01", "2015-04-30"), ("2015-04-01", "2015-05-15"), ("2015-04-01", "2015-04-01"),
+        ("2015-04-01", "2015-07-31"), ("2015-04-01", "2015-04-10")],  # same start
+    4: [("2014-11-15", "2015-02-10"), ("2015-01-20", "2015-03-31"), ("2015-03-01", "2015-06-30"),
+        ("2015-02-01", "2015-02-28")],  # chain
+}
+
+
+def overlap_episodes():
+    '''
+    :return: VAR dataset (YYYYMMDD dates) with the episodes of overlap_cases, once as BYAT 5 and once as BYAT 6
+    '''
+
+    rows = []
+    for fdz_id, episodes in overlap_cases.items():
+        for k, (start, end) in enumerate(episodes):
+            for group in ["status_4", "status_5"]:
+                byat, byatso, vsgr, rtvs = var_codes[group][0]
+                rows.append((fdz_id, np.datetime64(start), np.datetime64(end), byat, byatso, vsgr, rtvs, 0.0,
+                             0.25 * (k + 1)))
+    return var_dataset(rows)
+
+
+def count_overlap_days(df, berichtsjahr):
+    '''
+    :param df: output of overlap_episodes
+    :return: df with FDZ_ID, JAHR, MONAT, STATUS_4_TAGE, STATUS_5_TAGE, STATUS_5_EGPT of the covered months up to
+             December of berichtsjahr, counted day by day
+    '''
+
+    days = {}  # (FDZ_ID, column, day) -> EGPT of the day
+    for row in df.itertuples():
+        dates = pd.date_range(pd.to_datetime(str(row.VNZR)), pd.to_datetime(str(row.BSZR)), freq="D")
+        status = "STATUS_4" if row.BYAT == 5 else "STATUS_5"
+        for day in dates[dates.year <= berichtsjahr]:
+            days[(row.FDZ_ID, status, day)] = days.get((row.FDZ_ID, status, day), 0.0) + row.EGPT / len(dates)
+
+    counts = pd.DataFrame([(fdz_id, day.year, day.month, status, egpt) for (fdz_id, status, day), egpt in days.items()],
+                          columns=["FDZ_ID", "JAHR", "MONAT", "STATUS", "EGPT"])
+    counts = counts.groupby(["FDZ_ID", "JAHR", "MONAT", "STATUS"])["EGPT"].agg(["size", "sum"]).unstack("STATUS")
+    return pd.DataFrame({"STATUS_4_TAGE": counts[("size", "STATUS_4")], "STATUS_5_TAGE": counts[("size", "STATUS_5")],
+                         "STATUS_5_EGPT": counts[("sum", "STATUS_5")]}).reset_index()
+
+
+def check_overlaps(engine, berichtsjahr=2015, anlage10=None, rtol=1e-12, atol=1e-9):
+    '''
+    runs engine on overlap_episodes and compares status 4 and 5 with count_overlap_days
+    :return: None if equal, else the first difference (see compare_results)
+    '''
+
+    anlage10 = generate_anlage10() if anlage10 is None else anlage10
+    df = overlap_episodes()
+    result_df = engines[engine](prepare(df, berichtsjahr), berichtsjahr, anlage10)
+    keys = ["FDZ_ID", "JAHR", "MONAT"]
+    expected = result_df[keys].merge(count_overlap_days(df, berichtsjahr), on=keys, how="left")
+    return compare_results(expected, result_df, rtol, atol)
+
+
+def check(engine="block", n_runs=10, n_ids=30, berichtsjahr=2015, seed=0, anlage10=None, rtol=1e-12, atol=1e-9,
+          cache_path=None, ties=False):
+    '''
+    differential test: runs the reference and engine on random edge case datasets and compares the results, both are
+    checked on overlap_episodes first (see check_overlaps). The reference is compared with the original implementation
+    on the IDs without intended changes (see original_ids)
+    :param engine: str, key of engines
+    :param n_runs: int, nr of random datasets
+    :param n_ids: int, nr of IDs per dataset
+    :param anlage10: output of episodes_pivot.load_anlage10 (optional) - synthetic factors by default
+    :param cache_path: Parquet cache of a VAR file (optional) - random IDs of the cache instead of edge cases
+    :param ties: bool - datasets with heavy ties (see heavy_tie_episodes) instead of edge cases
+    :return: list of failures: dict with seed and the first difference (see compare_results)
+    '''
+
+    anlage10 = generate_anlage10(seed=seed) if anlage10 is None else anlage10
+    failures = []
+    for name in ["reference", engine]:
+        difference = check_overlaps(name, berichtsjahr, anlage10, rtol, atol)
+        if difference is not None:
+            failures.append({"SEED": None, "ENGINE": name, **difference})
+        result = "equal" if difference is None else f"first difference {difference}"
+        print(f" Overlaps of status 4 and 5 ({name}): {result}.")
+
+    for run in range(n_runs):
+        if cache_path is None:
+            df = prepare(random_episodes(n_ids, berichtsjahr, seed + run, ties), berichtsjahr)
+        else:
+            df = sample_episodes(cache_path, n_ids, berichtsjahr, seed + run)
+        expected = engines["reference"](df, berichtsjahr, anlage10)
+        difference = compare_results(expected, engines[engine](df, berichtsjahr, anlage10), rtol, atol)
+        ids = original_ids(df)
+        if difference is None and len(ids) > 0:
+            # the reference itself against the original implementation, IDs without intended changes
+            difference = compare_results(run_original(df[df["FDZ_ID"].isin(ids)], berichtsjahr, anlage10),
+                                         expected[expected["FDZ_ID"].isin(ids)], rtol, atol)
+            difference = None if difference is None else {"ENGINE": "reference vs. original", **difference}
+        if difference is not None:
+            failures.append({"SEED": seed + run, **difference})
+            print(f" Run {run + 1}/{n_runs} (seed {seed + run}): first difference {difference}")
+        else:
+            print(f" Run {run + 1}/{n_runs} (seed {seed + run}): equal.")
+
+    print(f"\n{engine}: {n_runs - sum(failure['SEED'] is not None for failure in failures)} of {n_runs} runs equal to "
+          f"the reference.")
+    return failures
+
+
+#######################################################################################################################
+
+
+# modes: whole runs of episodes_pivot (files, several chunks and blocks) on random datasets, the results are compared
+# with the reference of every berichtsjahr. function(VAR datasets by berichtsjahr, berichtsjahr, anlage10, folder) ->
+# dict berichtsjahr -> result. Small chunks and blocks, so that every dataset is split into many of them.
+
+batch_size = 7
+run_options = {"block_size": 3, "backend": "serial"}
+
+
+def run_incremental(var_by_year, berichtsjahr, anlage10, folder):
+    '''
+    full run of berichtsjahr - 1, then incremental update of berichtsjahr (previous_folder)
+    '''
+
+    previous_folder, update_folder = os.path.join(folder, "previous", ""), os.path.join(folder, "update", "")
+    result_paths = {}
+    for year, destination_folder, previous in [(berichtsjahr - 1, previous_folder, None),
+                                               (berichtsjahr, update_folder, previous_folder)]:
+        os.makedirs(destination_folder)
+        episodes = episodes_pivot.EpisodeArrays.from_df(prepare(var_by_year[year], year))
+        result_paths[year] = episodes_pivot.run_in_batches_and_save_result(
+            episodes, batch_size, destination_folder, year, anlage10=anlage10, previous_folder=previous, stata=False,
+            **run_options)
+    return {year: pd.read_parquet(result_path) for year, result_path in result_paths.items()}
+
+
+def run_years(var_by_year, berichtsjahr, anlage10, folder):
+    '''
+    all berichtsjahre in one run_years run from VAR files (earlier berichtsjahre as truncated views)
+    '''
+
+    data_folder, destination_folder = os.path.join(folder, "data", ""), os.path.join(folder, "result", "")
+    os.makedirs(data_folder)
+    os.makedirs(destination_folder)
+    for year, var_df in var_by_year.items():
+        write_var(var_df, data_folder, year)
+    result_paths = episodes_pivot.run_years(list(var_by_year), data_folder, destination_folder, batch_size,
+                                            anlage10=anlage10, stata=False, **run_options)
+    return {year: pd.read_parquet(result_path) for year, result_path in result_paths.items()}
+
+
+def run_resume(var_by_year, berichtsjahr, anlage10, folder):
+    '''
+    complete run, then every second part file removed and another one modified, resumed run (these chunks redone)
+    '''
+
+    destination_folder = os.path.join(folder, "")
+    episodes = episodes_pivot.EpisodeArrays.from_df(prepare(var_by_year[berichtsjahr], berichtsjahr))
+    episodes_pivot.run_in_batches_and_save_result(episodes, batch_size, destination_folder, berichtsjahr,
+                                                  anlage10=anlage10, stata=False, **run_options)
+
+    with open(episodes_pivot.manifest_path(destination_folder, berichtsjahr)) as f:
+        part_files = [destination_folder + part["file"] for part in json.load(f)["parts"].values()]
+    for file_path in part_files[::2]:
+        os.remove(file_path)
+    if len(part_files) > 1:
+        # last row removed: the result differs if the modified part is reused
+        part_df = pd.read_parquet(part_files[1])
+        part_df.iloc[:-1].to_parquet(part_files[1])
+
+    result_path = episodes_pivot.run_in_batches_and_save_result(episodes, batch_size, destination_folder, berichtsjahr,
+                                                                anlage10=anlage10, stata=False, **run_options)
+    return {berichtsjahr: pd.read_parquet(result_path)}
+
+
+def run_sparse(var_by_year, berichtsjahr, anlage10, folder):
+    '''
+    sparse run, the dense grid restored by read_sparse_result
+    '''
+
+    destination_folder = os.path.join(folder, "")
+    episodes = episodes_pivot.EpisodeArrays.from_df(prepare(var_by_year[berichtsjahr], berichtsjahr))
+    episodes_pivot.run_in_batches_and_save_result(episodes, batch_size, destination_folder, berichtsjahr,
+                                                  anlage10=anlage10, sparse=True, stata=False, **run_options)
+    return {berichtsjahr: episodes_pivot.read_sparse_result(destination_folder, berichtsjahr)}
+
+
+def run_shards(var_by_year, berichtsjahr, anlage10, folder, n_shards=3):
+    '''
+    n_shards shards one after another (as separate jobs with the same input), then merge_shards
+    '''
+
+    destination_folder = os.path.join(folder, "")
+    episodes = episodes_pivot.EpisodeArrays.from_df(prepare(var_by_year[berichtsjahr], berichtsjahr))
+    for shard in range(n_shards):
+        episodes_pivot.run_shard(episodes, shard, n_shards, batch_size, destination_folder, berichtsjahr,
+                                 anlage10=anlage10, **run_options)
+    return {berichtsjahr: pd.read_parquet(episodes_pivot.merge_shards(destination_folder, berichtsjahr, n_shards,
+                                                                      stata=False))}
+
+
+def run_ids(var_by_year, berichtsjahr, anlage10, folder):
+    '''
+    pivot_ids from the Parquet cache: the first half of the IDs as range (pivot_block), the others as list of IDs
+    (per ID, pivot_episodes)
+    '''
+
+    data_folder, cache_folder = os.path.join(folder, "data", ""), os.path.join(folder, "cache")
+    os.makedirs(data_folder)
+    write_var(var_by_year[berichtsjahr], data_folder, berichtsjahr)
+    ids = np.unique(var_by_year[berichtsjahr]["FDZ_ID"].values)
+    half = len(ids) // 2
+    result_df = pd.concat([
+        episodes_pivot.pivot_ids(berichtsjahr, data_folder, cache_folder, id_range=(ids[0], ids[half - 1]),
+                                 anlage10=anlage10) if half else None,
+        episodes_pivot.pivot_ids(berichtsjahr, data_folder, cache_folder, ids=list(ids[half:]), anlage10=anlage10,
+                                 group_free=False)], ignore_index=True)
+    return {berichtsjahr: result_df}
+
+
+def run_cache(var_by_year, berichtsjahr, anlage10, folder):
+    '''
+    Parquet cache converted from an older VAR file (the dataset of berichtsjahr - 1 under the file name of
+    berichtsjahr), then the file replaced by the dataset of berichtsjahr: the outdated cache must be rebuilt
+    '''
+
+    data_folder, cache_folder = os.path.join(folder, "data", ""), os.path.join(folder, "cache")
+    destination_folder = os.path.join(folder, "result", "")
+    os.makedirs(data_folder)
+    os.makedirs(destination_folder)
+    source_path = write_var(var_by_year[berichtsjahr - 1], data_folder, berichtsjahr)
+    episodes_pivot.convert_to_parquet(berichtsjahr, data_folder, cache_folder)
+    mtime_ns = os.stat(source_path).st_mtime_ns
+    write_var(var_by_year[berichtsjahr], data_folder, berichtsjahr)
+    os.utime(source_path, ns=(mtime_ns, mtime_ns))  # same mtime: the content decides
+
+    episodes = episodes_pivot.load_and_preprocess(berichtsjahr, data_folder, cache_folder=cache_folder,
+                                                  group_free=True)
+    result_path = episodes_pivot.run_in_batches_and_save_result(episodes, batch_size, destination_folder, berichtsjahr,
+                                                                anlage10=anlage10, stata=False, **run_options)
+    return {berichtsjahr: pd.read_parquet(result_path)}
+
+
+modes = {"incremental": run_incremental, "years": run_years, "resume": run_resume, "sparse": run_sparse,
+         "shards": run_shards, "ids": run_ids, "cache": run_cache}
+
+
+def check_mode(mode, n_runs=5, n_ids=30, berichtsjahr=2015, seed=0, anlage10=None, rtol=1e-12, atol=1e-9,
+               ties=False):
+    '''
+    differential test of a mode: runs it on random datasets (VAR files of berichtsjahr - 1 and berichtsjahr, see
+    earlier_episodes) in a temporary folder and compares every result with the reference
+    :param mode: str, key of modes
+    :param ties: bool - datasets with heavy ties (see heavy_tie_episodes) instead of edge cases
+    :return: list of failures: dict with seed, berichtsjahr and the first difference (see compare_results)
+    '''
+
+    anlage10 = generate_anlage10(seed=seed) if anlage10 is None else anlage10
+    failures = []
+    for run in range(n_runs):
+        df = random_episodes(n_ids, berichtsjahr, seed + run, ties)
+        var_by_year = {berichtsjahr - 1: earlier_episodes(df, berichtsjahr, seed + run), berichtsjahr: df}
+        with tempfile.TemporaryDirectory(prefix="episodes_pivot_check_") as folder:
+            with contextlib.redirect_stdout(io.StringIO()):  # progress messages of the runs
+                results = modes[mode](var_by_year, berichtsjahr, anlage10, folder)
+        for year, result_df in results.items():
+            difference = compare_results(engines["reference"](prepare(var_by_year[year], year), year, anlage10),
+                                         result_df, rtol, atol)
+            if difference is not None:
+                failures.append({"SEED": seed + run, "BERICHTSJAHR": year, **difference})
+                print(f" Run {run + 1}/{n_runs} (seed {seed + run}), {year}: first difference {difference}")
+            else:
+                print(f" Run {run + 1}/{n_runs} (seed {seed + run}), {year}: equal.")
+
+    print(f"\n{mode}: {n_runs - len({failure['SEED'] for failure in failures})} of {n_runs} runs equal to the "
+          f"reference.")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares an engine of episodes_pivot with the per-ID reference "
+                                                 "pivot_episodes on random edge cases, or two saved results.")
+    parser.add_argument("--engine", default="block", choices=[name for name in engines if name != "reference"])
+    parser.add_argument("--mode", choices=list(modes), help="check a whole run (files, chunks) instead of an engine")
+    parser.add_argument("--ties", action="store_true", help="datasets with heavy ties of the STATUS_1 maxima")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--ids", type=int, default=30)
+    parser.add_argument("--berichtsjahr", type=int, default=2015)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--anlage10", help="path of Anlage_10.dta (default: synthetic factors)")
+    parser.add_argument("--rtol", type=float, default=1e-12)
+    parser.add_argument("--atol", type=float, default=1e-9)
+    parser.add_argument("--cache", help="Parquet cache of a VAR file: random real IDs instead of edge cases")
+    parser.add_argument("--files", nargs=2, metavar=("EXPECTED", "ACTUAL"), help="compare two saved results instead")
+    args = parser.parse_args()
+
+    anlage10 = episodes_pivot.load_anlage10(args.anlage10) if args.anlage10 else None
+    if args.files:
+        print(compare_files(*args.files, rtol=args.rtol, atol=args.atol) or "equal")
+    elif args.mode:
+        failures = check_mode(args.mode, args.runs, args.ids, args.berichtsjahr, args.seed, anlage10, args.rtol,
+                              args.atol, args.ties)
+        raise SystemExit(1 if failures else 0)
+    else:
+        failures = check(args.engine, args.runs, args.ids, args.berichtsjahr, args.seed, anlage10, args.rtol,
+                         args.atol, args.cache, args.ties)
+        raise SystemExit(1 if failures else 0)